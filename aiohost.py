@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+'''
+asyncio のイベントループ上で多数の PyComet2 を時分割で実行する (Python 3.4 以降)
+
+    scheduler = Scheduler(slice_steps=1000)
+    machine = PyComet2()
+    machine.load('prog.com', True)
+    job = scheduler.spawn(machine, max_steps=10 ** 6)
+    job.input.feed('hello\\n')
+    line = await job.output.readline()
+    reason = await job.result
+
+各機械は slice_steps ステップ実行するごとにイベントループへ制御を返し、
+実行可能な機械が順番に (ラウンドロビンで) 実行される。
+IN 命令で入力が届いていない機械は、入力が届くまで実行されない。
+'''
+import time
+import asyncio
+from collections import deque
+
+from errors import BudgetExceeded
+
+
+class AsyncInput(object):
+    ''' IN 命令の入力。feed() で渡した文字列を1行ずつ返す '''
+
+    def __init__(self):
+        self.lines = deque()
+        self.buffer = ''
+        self.eof = False
+        self.waiters = []
+
+    def feed(self, data):
+        parts = (self.buffer + data).split('\n')
+        self.buffer = parts.pop()
+        for line in parts:
+            self.lines.append(line + '\n')
+        if parts:
+            self.wake()
+
+    def feed_eof(self):
+        if self.buffer:
+            self.lines.append(self.buffer)
+            self.buffer = ''
+        self.eof = True
+        self.wake()
+
+    def readline(self):
+        if self.lines:
+            return self.lines.popleft()
+        if self.eof:
+            return ''
+        return None
+
+    def wait(self, callback):
+        ''' 読み込める行が届いたら callback を呼ぶ '''
+        if self.lines or self.eof:
+            callback()
+        else:
+            self.waiters.append(callback)
+
+    def wake(self):
+        waiters, self.waiters = self.waiters, []
+        for callback in waiters:
+            callback()
+
+
+class AsyncOutput(object):
+    ''' OUT 命令の出力。readline() で1行ずつ受け取る (終了後は '') '''
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    def write(self, data):
+        for line in data.splitlines(True):
+            self.queue.put_nowait(line)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put_nowait('')
+
+    def readline(self):
+        ''' 次の1行を返すコルーチン '''
+        return self.queue.get()
+
+
+class Job(object):
+    ''' スケジューラが実行する1台の機械 '''
+
+    # 停止した理由 (result の値)
+    HALTED = 'halted'
+    INVALID = 'invalid'
+    CANCELLED = 'cancelled'
+    STEPS = BudgetExceeded.STEPS
+    TIME = BudgetExceeded.TIME
+    LOOP = BudgetExceeded.LOOP
+
+    def __init__(self, machine, max_steps=None, timeout=None, loop=None):
+        self.machine = machine
+        self.input = AsyncInput()
+        self.output = AsyncOutput()
+        machine.input = self.input
+        machine.output = self.output
+        self.limit = None
+        if max_steps is not None:
+            self.limit = machine.step_count + max_steps
+        # timeout は実際に実行していた時間の合計に対する上限
+        self.timeout = timeout
+        self.elapsed = 0.0
+        self.reason = None
+        self.error = None
+        self.result = loop.create_future()
+
+    def run_slice(self, n):
+        '''
+        最大 n ステップ実行し、入力待ちになったら True を返す
+        停止したときは finish() を呼ぶ
+        '''
+        m = self.machine
+        if self.limit is not None:
+            n = min(n, self.limit - m.step_count)
+            if n <= 0:
+                self.finish(self.STEPS)
+                return False
+        start = time.time()
+        try:
+            stop = m.run_until(n)
+        finally:
+            self.elapsed += time.time() - start
+        if stop.reason == stop.HALTED:
+            self.finish(self.HALTED)
+        elif stop.reason == stop.INVALID:
+            self.finish(self.INVALID, stop.error)
+        elif stop.reason == stop.INPUT:
+            return True
+        elif stop.reason == stop.BUDGET and stop.error.reason == self.LOOP:
+            # loopcheck.detecting() のエンジンが終わらないループを検出した
+            self.finish(self.LOOP)
+        if self.timeout is not None and self.timeout <= self.elapsed \
+                and self.reason is None:
+            self.finish(self.TIME)
+        return False
+
+    def finish(self, reason, error=None):
+        self.reason = reason
+        self.error = error
+        self.output.close()
+        if not self.result.done():
+            self.result.set_result(reason)
+
+    @property
+    def done(self):
+        return self.reason is not None
+
+    def cancel(self):
+        if not self.done:
+            self.finish(self.CANCELLED)
+
+
+class Scheduler(object):
+    '''
+    登録された機械を slice_steps ステップずつ順番に実行する
+    1回の呼び出しで1台分のスライスだけを実行し、すぐに制御を返す
+    '''
+
+    def __init__(self, slice_steps=1000, loop=None):
+        self.slice_steps = slice_steps
+        self.loop = loop
+        self.ready = deque()
+        self.jobs = set()
+        self.scheduled = False
+
+    def spawn(self, machine, max_steps=None, timeout=None):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        job = Job(machine, max_steps, timeout, self.loop)
+        self.jobs.add(job)
+        self.wake(job)
+        return job
+
+    def wake(self, job):
+        self.ready.append(job)
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.tick)
+
+    def tick(self):
+        self.scheduled = False
+        if not self.ready:
+            return
+        job = self.ready.popleft()
+        if not job.done:
+            waiting = job.run_slice(self.slice_steps)
+            if job.done:
+                self.jobs.discard(job)
+            elif waiting:
+                job.input.wait(lambda: self.wake(job))
+            else:
+                self.ready.append(job)
+        if self.ready and not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.tick)
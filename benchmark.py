@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+'''
+pycasl2 / pycomet2 のベンチマーク
+
+  python benchmark.py [-e ENGINE] [-o result.json] [-b baseline.json]
+  python benchmark.py -S -b baseline.json -t 0.1    (起動時間だけ計測)
+
+benchmarks/*.cas の各プログラムについて PyComet2.run の命令数/秒、
+生成した大きなソースについて CASL2.assemble の行数/秒、
+各コマンドの起動時間、ピークメモリ (最大 RSS) を計測し JSON で出力する。
+各計測は fork した子プロセスで行うので、互いに影響しない。
+-t を指定すると、基準の結果より悪化した割合が閾値を超えた場合に
+終了ステータス 1 で終了する。
+'''
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import platform
+import tempfile
+import subprocess
+from optparse import OptionParser
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(HERE, 'benchmarks')
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def reverse_input():
+    ''' reverse.cas 用の入力 (2000 行, 最後は空行) '''
+    letters = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    lines = [''.join(letters[(i * 7 + j * 13) % len(letters)]
+                     for j in range(20 + i % 60))
+             for i in range(2000)]
+    return '\n'.join(lines) + '\n\n'
+
+
+# (名前, ソース, 標準入力を返す関数)
+WORKLOADS = [
+    ('bubble', 'bubble.cas', None),
+    ('qsort', 'qsort.cas', None),
+    ('mult', 'mult.cas', None),
+    ('reverse', 'reverse.cas', reverse_input),
+    ('recursion', 'recursion.cas', None),
+]
+
+
+def generate_source(lines):
+    ''' アセンブラ用に、およそ lines 行のソースを生成する '''
+    body = ['GEN     START']
+    n = 0
+    while len(body) < lines - 3:
+        body.append('L%05d   LAD     GR1, %d' % (n, n % 1000))
+        body.append('        ADDA    GR1, =%d' % (n % 97))
+        body.append('        LD      GR2, V%d, GR1' % (n % 100))
+        body.append('        ST      GR2, V%d' % ((n + 1) % 100))
+        body.append('        CPA     GR1, GR2')
+        body.append('        JMI     L%05d' % n)
+        body.append('        SLL     GR2, 3')
+        body.append('        PUSH    0, GR2')
+        body.append('        POP     GR3')
+        body.append('        CALL    L%05d' % n)
+        n += 1
+    body.append('        RET')
+    for i in range(100):
+        body.append("V%d      DC      %d" % (i, i))
+    body.append('        END')
+    return '\n'.join(body) + '\n'
+
+
+def in_child(func, *args):
+    '''
+    fork した子プロセスで func を実行し、(戻り値, 最大 RSS [KiB]) を返す
+    戻り値は JSON にできるものに限る
+    '''
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 0
+        try:
+            result = json.dumps(func(*args))
+        except BaseException as e:
+            result = json.dumps({'error': repr(e)})
+            status = 1
+        os.write(w, result.encode('utf-8'))
+        os.close(w)
+        os._exit(status)
+    os.close(w)
+    chunks = []
+    while True:
+        chunk = os.read(r, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(r)
+    _, status, usage = os.wait4(pid, 0)
+    result = json.loads(b''.join(chunks).decode('utf-8'))
+    if status != 0:
+        raise RuntimeError(result.get('error'))
+    return result, usage.ru_maxrss
+
+
+def assemble(src, com):
+    from pycasl2 import CASL2
+    casl2 = CASL2()
+    casl2.write(com, casl2.assemble(src))
+
+
+def run_machine(engine, com, input_data, repeat):
+    from errors import MachineExit
+    from engines import engines
+    from channels import BufferOutput
+    best = None
+    for i in range(repeat):
+        machine = engines[engine]()
+        machine.load(com, True)
+        machine.input = StringIO(input_data)
+        machine.output = BufferOutput()
+        start = timer()
+        try:
+            machine.run()
+        except MachineExit:
+            pass
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return {'steps': machine.step_count,
+            'seconds': best,
+            'steps_per_sec': machine.step_count / best}
+
+
+def run_assembler(lines, repeat):
+    from pycasl2 import CASL2
+    fd, src = tempfile.mkstemp(suffix='.cas')
+    os.write(fd, generate_source(lines).encode('ascii'))
+    os.close(fd)
+    try:
+        best = None
+        for i in range(repeat):
+            start = timer()
+            CASL2().assemble(src)
+            elapsed = timer() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        os.remove(src)
+    return {'lines': lines, 'seconds': best, 'lines_per_sec': lines / best}
+
+
+def startup_time(argv, repeat):
+    ''' コマンドを repeat 回起動し、最短時間と平均時間を返す '''
+    times = []
+    devnull = open(os.devnull, 'w')
+    try:
+        for i in range(repeat):
+            start = timer()
+            subprocess.call([sys.executable] + argv,
+                            stdout=devnull, stderr=devnull)
+            times.append(timer() - start)
+    finally:
+        devnull.close()
+    return {'min': min(times), 'mean': sum(times) / len(times)}
+
+
+def benchmark(engine='reference', repeat=3, asm_lines=100000,
+              startup_repeat=20, names=None, workloads=True):
+    tmpdir = tempfile.mkdtemp()
+    result = {'python': platform.python_version(),
+              'implementation': platform.python_implementation(),
+              'engine': engine,
+              'workloads': {}}
+    try:
+        for name, src, make_input in WORKLOADS:
+            if not workloads or names and name not in names:
+                continue
+            com = os.path.join(tmpdir, name + '.com')
+            in_child(assemble, os.path.join(BENCH_DIR, src), com)
+            input_data = make_input() if make_input else ''
+            r, rss = in_child(run_machine, engine, com, input_data, repeat)
+            r['peak_rss_kb'] = rss
+            result['workloads'][name] = r
+            report('%-12s %10d steps %8.3f s %12.0f steps/s %8d KiB'
+                   % (name, r['steps'], r['seconds'],
+                      r['steps_per_sec'], rss))
+
+        if asm_lines:
+            r, rss = in_child(run_assembler, asm_lines, repeat)
+            r['peak_rss_kb'] = rss
+            result['assembler'] = r
+            report('%-12s %10d lines %8.3f s %12.0f lines/s %8d KiB'
+                   % ('assemble', r['lines'], r['seconds'],
+                      r['lines_per_sec'], rss))
+
+        if startup_repeat:
+            com = os.path.join(tmpdir, 'ret.com')
+            src = os.path.join(HERE, 'tests', 'ret.cas')
+            in_child(assemble, src, com)
+            result['startup'] = {
+                'pycomet2': startup_time(
+                    [os.path.join(HERE, 'pycomet2.py'), '-r', com],
+                    startup_repeat),
+                'pycasl2': startup_time(
+                    [os.path.join(HERE, 'pycasl2.py'), src,
+                     os.path.join(tmpdir, 'out.com')],
+                    startup_repeat),
+            }
+            for name, r in sorted(result['startup'].items()):
+                report('%-12s startup %8.4f s (mean %.4f s)'
+                       % (name, r['min'], r['mean']))
+    finally:
+        for f in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, f))
+        os.rmdir(tmpdir)
+    return result
+
+
+def metrics(result):
+    ''' 比較する値 -> (値, 大きい方が良いか) '''
+    m = {}
+    for name, r in result.get('workloads', {}).items():
+        m[name + '.steps_per_sec'] = (r['steps_per_sec'], True)
+        m[name + '.peak_rss_kb'] = (r['peak_rss_kb'], False)
+    if 'assembler' in result:
+        m['assemble.lines_per_sec'] = (
+            result['assembler']['lines_per_sec'], True)
+    for name, r in result.get('startup', {}).items():
+        m[name + '.startup'] = (r['min'], False)
+    return m
+
+
+def compare(base, result, threshold=None):
+    '''
+    基準の結果に対する比 (>1 なら改善) を表示する
+    threshold を指定すると、それを超える割合で悪化した値の名前のリストを返す
+    '''
+    old, new = metrics(base), metrics(result)
+    regressions = []
+    for key in sorted(set(old) & set(new)):
+        (a, higher), (b, _) = old[key], new[key]
+        if a == 0 or b == 0:
+            continue
+        ratio = b / float(a) if higher else a / float(b)
+        mark = ''
+        if threshold is not None and ratio < 1 / (1 + threshold):
+            regressions.append(key)
+            mark = '  REGRESSION'
+        report('%-28s %14.4f -> %14.4f  x%.3f%s' % (key, a, b, ratio, mark))
+    return regressions
+
+
+def report(s):
+    print(s, file=sys.stderr)
+
+
+def main():
+    from engines import add_engine_option
+    usage = 'usage: %prog [options] [workload ...]'
+    parser = OptionParser(usage)
+    add_engine_option(parser)
+    parser.add_option('-n', '--repeat', type='int',
+                      dest='repeat', default=3,
+                      help='take the best of N runs.')
+    parser.add_option('-l', '--asm-lines', type='int',
+                      dest='asm_lines', default=100000,
+                      help='lines of generated assembler source. '
+                           '(0 to skip)')
+    parser.add_option('-s', '--startup-repeat', type='int',
+                      dest='startup_repeat', default=20,
+                      help='number of launches to measure startup time. '
+                           '(0 to skip)')
+    parser.add_option('-o', '--output', type='string',
+                      dest='output', default=None,
+                      help='write results to the JSON file.')
+    parser.add_option('-b', '--baseline', type='string',
+                      dest='baseline', default=None,
+                      help='compare results with the JSON file.')
+    parser.add_option('-t', '--threshold', type='float',
+                      dest='threshold', default=None,
+                      help='exit with status 1 if a result is worse than '
+                           'the baseline by more than RATIO. (ex. 0.1)')
+    parser.add_option('-S', '--startup-only', action='store_true',
+                      dest='startup_only', default=False,
+                      help='measure startup time only.')
+    options, args = parser.parse_args()
+
+    asm_lines = options.asm_lines
+    if options.startup_only:
+        asm_lines = 0
+    result = benchmark(options.engine, options.repeat, asm_lines,
+                       options.startup_repeat, args,
+                       not options.startup_only)
+    if options.output:
+        fp = open(options.output, 'w')
+        json.dump(result, fp, indent=2, sort_keys=True)
+        fp.close()
+    else:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    if options.baseline:
+        fp = open(options.baseline)
+        regressions = compare(json.load(fp), result, options.threshold)
+        fp.close()
+        if regressions:
+            report('regressed: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
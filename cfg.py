@@ -0,0 +1,380 @@
+# ~*~ coding:utf-8 ~*~
+'''
+読み込んだプログラムの制御フローグラフ (CFG) とスタックの深さの静的解析
+
+  python cfg.py [-b] input.com|input.cas
+
+CFG は実行開始番地と CALL 先から到達できる命令だけをデコードして作る。
+基本ブロックは分岐先・CALL 先・制御命令の直後で区切る。
+番地に指標レジスタを使う JUMP / 条件分岐 / CALL は行き先が分からないので、
+そのブロックを indirect として扱う。
+
+スタックの深さは、サブルーチンの入口での SP を 0 として、
+PUSH / POP / RPUSH / RPOP と CALL (戻り番地と呼び出し先の深さ) から
+サブルーチンごとの最大の深さを求める。ループの中で積み続ける場合や
+再帰呼び出しがある場合は上限なし (None) とする。
+プログラム全体の最大の深さがスタックの初期値からプログラムの末尾までに
+収まらなければ、スタックがプログラムやデータを上書きしうる。
+'''
+from __future__ import print_function
+import sys
+
+from errors import InvalidOperation
+
+# 条件分岐命令
+BRANCHES = ('JMI', 'JNZ', 'JZE', 'JPL', 'JOV')
+# 命令ごとのスタックに積む語数 (RPUSH / RPOP は GR1〜GR8 の 8 語)
+STACK_EFFECT = {'PUSH': 1, 'POP': -1, 'RPUSH': 8, 'RPOP': -8}
+
+# 解析の結果
+OK = 'ok'
+OVERFLOW = 'overflow'
+UNBOUNDED = 'unbounded'
+
+
+def flow(adr, inst, args):
+    '''
+    命令の制御の流れを (分岐先のリスト, 次の命令へ進むか, 種類) で返す
+    種類は None (通常の命令), 'jump', 'branch', 'call', 'ret', 'svc',
+    'indirect' (行き先が分からない)
+    '''
+    name = inst.opname
+    if name == 'JUMP' or name in BRANCHES:
+        target, x = args
+        falls = name != 'JUMP'
+        if x != 0:
+            return [], falls, 'indirect'
+        return [target], falls, 'jump' if name == 'JUMP' else 'branch'
+    if name == 'CALL':
+        return [], True, 'call'
+    if name == 'RET':
+        return [], False, 'ret'
+    if name == 'SVC':
+        # instructions.svc は同じ番地に戻る
+        return [adr], False, 'svc'
+    return [], True, None
+
+
+def call_target(inst, args):
+    ''' CALL の呼び出し先 (指標レジスタを使うなら None) '''
+    target, x = args
+    return target if x == 0 else None
+
+
+class Block(object):
+    ''' 基本ブロック [start, end) '''
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        # (番地, 命令, 引数) のリスト
+        self.insts = []
+        self.succs = []
+        self.preds = []
+        # 最後の命令の種類 (flow() を参照), 不正な命令で終わるなら 'invalid'
+        self.kind = None
+
+    def __repr__(self):
+        return '<Block #%04x-#%04x %s>' % (self.start, self.end, self.kind)
+
+
+class Subroutine(object):
+    ''' サブルーチン (入口から CALL の先をたどらずに到達できるブロック) '''
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.blocks = []
+        # 直接呼び出すサブルーチンの入口
+        self.calls = set()
+        # RET の番地 -> その時点の深さ
+        self.returns = {}
+        # 入口を 0 とした最大の深さ (上限なしなら None) と最小の深さ
+        self.max_depth = 0
+        self.min_depth = 0
+        self.recursive = False
+        self.indirect = False
+
+    @property
+    def balanced(self):
+        ''' どの RET でも入口と同じ深さに戻るか '''
+        return all(d == 0 for d in self.returns.values())
+
+
+class CFG(object):
+    '''
+    machine に読み込まれたプログラムの CFG
+    entries を省略すると PR を実行開始番地とする
+    '''
+
+    def __init__(self, machine, entries=None):
+        self.machine = machine
+        if entries is None:
+            entries = [machine.PR]
+        self.entry = entries[0]
+        # 番地 -> (命令, 引数)
+        self.insts = {}
+        # 先頭番地 -> Block
+        self.blocks = {}
+        # CALL の番地 -> 呼び出し先 (不明なら None)
+        self.calls = {}
+        # 不正な命令の番地
+        self.invalid = set()
+        self.leaders = set(entries)
+        self.entries = list(entries)
+        self.discover(entries)
+        self.split()
+        self.subroutines = {}
+        for entry in self.entries:
+            self.subroutine(entry)
+
+    def decode(self, adr):
+        m = self.machine
+        inst = m.get_instruction(adr)
+        return inst, inst.argtype(m, adr)
+
+    def discover(self, entries):
+        ''' 到達できる命令をデコードし、ブロックの先頭を集める '''
+        work = list(entries)
+        while work:
+            adr = work.pop()
+            while adr not in self.insts and adr not in self.invalid:
+                try:
+                    inst, args = self.decode(adr)
+                except (InvalidOperation, IndexError):
+                    self.invalid.add(adr)
+                    break
+                self.insts[adr] = (inst, args)
+                targets, falls, kind = flow(adr, inst, args)
+                nxt = adr + inst.argtype.size
+                for t in targets:
+                    self.leaders.add(t)
+                    work.append(t)
+                if kind == 'call':
+                    target = call_target(inst, args)
+                    self.calls[adr] = target
+                    if target is not None:
+                        if target not in self.entries:
+                            self.entries.append(target)
+                        self.leaders.add(target)
+                        work.append(target)
+                if kind is not None:
+                    self.leaders.add(nxt)
+                if not falls or 0xffff < nxt:
+                    break
+                adr = nxt
+
+    def split(self):
+        ''' 集めた命令を基本ブロックに分ける '''
+        for start in sorted(self.leaders):
+            if start not in self.insts and start not in self.invalid:
+                continue
+            block = Block(start)
+            adr = start
+            while True:
+                if adr in self.invalid:
+                    block.kind = 'invalid'
+                    break
+                inst, args = self.insts[adr]
+                block.insts.append((adr, inst, args))
+                targets, falls, kind = flow(adr, inst, args)
+                adr += inst.argtype.size
+                if kind is not None:
+                    block.kind = kind
+                    block.succs = list(targets)
+                    if falls:
+                        block.succs.append(adr)
+                    break
+                if adr in self.leaders or adr not in self.insts:
+                    if adr in self.insts or adr in self.invalid:
+                        block.succs = [adr]
+                    break
+            block.end = adr
+            self.blocks[start] = block
+        for block in self.blocks.values():
+            block.succs = [s for s in block.succs if s in self.blocks]
+            for s in block.succs:
+                self.blocks[s].preds.append(block.start)
+
+    def subroutine(self, entry, active=None):
+        ''' entry を入口とするサブルーチンを解析して返す '''
+        if entry in self.subroutines:
+            return self.subroutines[entry]
+        if active is None:
+            active = set()
+        sub = Subroutine(entry)
+        if entry not in self.blocks:
+            self.subroutines[entry] = sub
+            return sub
+        active.add(entry)
+        # ブロックの先頭 -> 入口での深さ (その時点までの最大)
+        depth_in = {entry: 0}
+        raised = {}
+        work = [entry]
+        unbounded = False
+        limit = len(self.blocks) + 1
+        while work:
+            block = self.blocks[work.pop()]
+            d = depth_in[block.start]
+            for adr, inst, args in block.insts:
+                name = inst.opname
+                if name in STACK_EFFECT:
+                    d += STACK_EFFECT[name]
+                elif name == 'CALL':
+                    target = self.calls.get(adr)
+                    if target is None:
+                        sub.indirect = True
+                        continue
+                    sub.calls.add(target)
+                    if target in active:
+                        # 再帰呼び出し
+                        sub.recursive = True
+                        unbounded = True
+                        continue
+                    callee = self.subroutine(target, active)
+                    if callee.max_depth is None:
+                        unbounded = True
+                    else:
+                        sub.max_depth = max(sub.max_depth,
+                                            d + 1 + callee.max_depth)
+                    sub.recursive = sub.recursive or callee.recursive
+                    # 戻ったときの深さは呼び出し先の RET での深さの分ずれる
+                    if callee.returns:
+                        d += max(callee.returns.values())
+                elif name == 'RET':
+                    sub.returns[adr] = d
+                sub.max_depth = max(sub.max_depth, d)
+                sub.min_depth = min(sub.min_depth, d)
+            if block.kind == 'indirect':
+                sub.indirect = True
+            if block.start not in sub.blocks:
+                sub.blocks.append(block.start)
+            for s in block.succs:
+                if s not in depth_in:
+                    depth_in[s] = d
+                    work.append(s)
+                elif depth_in[s] < d:
+                    # 深さが増え続けるなら、積み続けるループがある
+                    raised[s] = raised.get(s, 0) + 1
+                    if limit < raised[s]:
+                        unbounded = True
+                        continue
+                    depth_in[s] = d
+                    work.append(s)
+        active.discard(entry)
+        sub.blocks.sort()
+        if unbounded:
+            sub.max_depth = None
+        self.subroutines[entry] = sub
+        return sub
+
+    def max_stack_depth(self):
+        ''' 実行開始から使いうるスタックの最大語数 (上限なしなら None) '''
+        return self.subroutines[self.entry].max_depth
+
+
+def image_end(machine):
+    '''
+    読み込んだプログラムの末尾の次の番地
+    (ファイルから読み込んでいなければ 0 でない最後の語の次)
+    '''
+    if machine.image_end:
+        return machine.image_end
+    memory = machine.memory
+    for adr in range(len(memory) - 1, -1, -1):
+        if memory[adr] != 0:
+            return adr + 1
+    return 0
+
+
+def check_stack(machine, end=None):
+    '''
+    スタックがプログラムやデータに届きうるかを調べ、
+    (OK / OVERFLOW / UNBOUNDED, 最大の深さ) を返す
+    end を省略すると image_end() までをプログラムとみなす
+    '''
+    cfg = CFG(machine)
+    depth = cfg.max_stack_depth()
+    if depth is None:
+        return UNBOUNDED, None
+    if end is None:
+        end = image_end(machine)
+    if machine.SP - depth < end:
+        return OVERFLOW, depth
+    return OK, depth
+
+
+def address_names(symbols):
+    '''
+    シンボル表から 番地 -> ラベル の辞書を作る
+    (START のラベルより、その中のラベルを優先する)
+    '''
+    labels = {}
+    for name, adr in symbols.items():
+        if '.' in name:
+            scope, label = name.split('.')
+            key = (scope == '', label)
+            labels[adr] = min(labels.get(adr, key), key)
+    return dict((adr, key[1]) for adr, key in labels.items())
+
+
+def main():
+    from optparse import OptionParser
+    from pycomet2 import PyComet2, load_program
+    usage = 'usage: %prog [options] input.com|input.cas'
+    parser = OptionParser(usage)
+    parser.add_option('-b', '--blocks', action='store_true',
+                      dest='blocks', default=False,
+                      help='print the basic blocks with disassembly.')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(2)
+
+    machine = PyComet2()
+    load_program(machine, args[0], True)
+    names = address_names(machine.symbols)
+    cfg = CFG(machine)
+
+    if options.blocks:
+        for start in sorted(cfg.blocks):
+            block = cfg.blocks[start]
+            print('block #%04x %s  -> %s' % (
+                start, names.get(start, ''),
+                ' '.join('#%04x' % s for s in block.succs)))
+            for adr, inst, inst_args in block.insts:
+                print('  #%04x  %s' % (adr, machine.dis.dis_inst(adr)))
+        for adr in sorted(cfg.invalid):
+            print('invalid #%04x' % adr)
+        print()
+
+    print('entry  name      blocks  depth  calls')
+    for entry in cfg.entries:
+        sub = cfg.subroutines[entry]
+        depth = '-' if sub.max_depth is None else str(sub.max_depth)
+        notes = []
+        if sub.recursive:
+            notes.append('recursive')
+        if sub.indirect:
+            notes.append('indirect')
+        for adr, d in sorted(sub.returns.items()):
+            if d != 0 and entry != cfg.entry:
+                notes.append('RET at #%04x with depth %d' % (adr, d))
+        if sub.min_depth < 0:
+            notes.append('pops %d word(s) of the caller' % -sub.min_depth)
+        print('#%04x  %-8s  %6d  %5s  %s%s' % (
+            entry, names.get(entry, ''), len(sub.blocks), depth,
+            ' '.join('#%04x' % c for c in sorted(sub.calls)),
+            ''.join('  (%s)' % n for n in notes)))
+
+    status, depth = check_stack(machine)
+    if status == UNBOUNDED:
+        print('stack: unbounded (recursion or a loop that pushes)')
+    else:
+        print('stack: at most %d words (down to #%04x), program ends at '
+              '#%04x: %s' % (depth, machine.SP - depth, image_end(machine),
+                             status))
+    sys.exit(1 if status == OVERFLOW else 0)
+
+
+if __name__ == '__main__':
+    main()
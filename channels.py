@@ -0,0 +1,164 @@
+# ~*~ coding:utf-8 ~*~
+'''
+IN/OUT 命令の入出力先
+
+PyComet2.input には readline() を持つもの、
+PyComet2.output には write() を持つものなら何でも指定できる
+(通常のファイルオブジェクトや StringIO もそのまま使える)。
+'''
+import sys
+
+
+class StdinInput(object):
+    ''' 標準入力。prompt が None でなければ読み込む前に表示する '''
+
+    def __init__(self, prompt='-> ', stream=None, prompt_stream=None):
+        self.prompt = prompt
+        self.stream = stream
+        self.prompt_stream = prompt_stream
+
+    def readline(self):
+        if self.prompt is not None:
+            out = self.prompt_stream or sys.stderr
+            out.write(self.prompt)
+            out.flush()
+        return (self.stream or sys.stdin).readline()
+
+
+class LinesInput(object):
+    ''' 行のリストを順に返す (各行の末尾の改行は省略できる) '''
+
+    def __init__(self, lines):
+        self.lines = [line if line.endswith('\n') else line + '\n'
+                      for line in lines]
+        self.position = 0
+
+    def readline(self):
+        if len(self.lines) <= self.position:
+            return ''
+        line = self.lines[self.position]
+        self.position += 1
+        return line
+
+
+class BytesInput(LinesInput):
+    ''' バイト列を1行ずつ返す '''
+
+    def __init__(self, data, encoding='latin-1'):
+        if not isinstance(data, str):
+            data = data.decode(encoding)
+        LinesInput.__init__(self, data.splitlines(True))
+
+
+def open_input(filename):
+    ''' ファイルから読み込む入力先を返す '''
+    return open(filename, 'r')
+
+
+class BufferOutput(object):
+    ''' 出力をメモリ上に溜めておく '''
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        value = ''.join(self.chunks)
+        self.chunks = [value]
+        return value
+
+    def lines(self):
+        return self.getvalue().splitlines()
+
+
+class OutputMismatch(BaseException):
+    '''
+    OUT 命令の出力が期待した出力と食い違った
+    line は食い違った行の番号 (1 から数える)
+    出力が期待した出力より短ければ actual が、長ければ expected が None
+    '''
+
+    def __init__(self, line, expected, actual):
+        self.line = line
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        def show(s):
+            return 'end of output' if s is None else repr(s)
+        return 'Output mismatch at line %d: expected %s, got %s.' % (
+            self.line, show(self.expected), show(self.actual))
+
+
+class ExpectedOutput(object):
+    '''
+    出力を1行ずつ期待した出力 expected (文字列) と照合する
+    食い違った行か、期待した出力を超えた行を書き込んだ時点で
+    OutputMismatch を送出して実行を止める
+    照合した行は output (省略すると標準出力, False なら捨てる) にも書き込む
+    '''
+
+    def __init__(self, expected, output=None):
+        self.expected = expected.splitlines()
+        self.output = output
+        # 照合した行数
+        self.position = 0
+        self.buffer = ''
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        if self.output is None:
+            sys.stdout.write(data)
+        elif self.output is not False:
+            self.output.write(data)
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.compare(line)
+
+    def compare(self, line):
+        n = self.position
+        expected = self.expected[n] if n < len(self.expected) else None
+        if line != expected:
+            raise OutputMismatch(n + 1, expected, line)
+        self.position = n + 1
+
+    def finish(self):
+        '''
+        実行が終わった後に呼び、期待した出力の残りがあれば
+        その OutputMismatch を返す (なければ None)
+        '''
+        if self.buffer:
+            line, self.buffer = self.buffer, ''
+            try:
+                self.compare(line)
+            except OutputMismatch as e:
+                return e
+        if self.position < len(self.expected):
+            return OutputMismatch(self.position + 1,
+                                  self.expected[self.position], None)
+        return None
+
+    def flush(self):
+        if self.output:
+            self.output.flush()
+
+    def close(self):
+        if self.output:
+            self.output.close()
+
+    def getvalue(self):
+        value = ''.join(self.chunks)
+        self.chunks = [value]
+        return value
+
+
+def open_output(filename, buffering=1 << 16):
+    ''' ブロック単位でバッファリングしてファイルに書き出す出力先を返す '''
+    return open(filename, 'w', buffering)
@@ -0,0 +1,314 @@
+# ~*~ coding:utf-8 ~*~
+'''
+命令ごとのコストによる実行の重さ (pycomet2.py --cost, --stats, --cost-model)
+
+  python pycomet2.py -r --cost [--cost-model model.json] prog.com
+  python cost.py [-e ENGINE] [-m model.json] [-i case.in] prog.com|prog.cas
+
+step_count はどの命令も 1 と数えるが、ここでは命令ごとのコストを
+次の和として数える。
+
+  基本      引数の形ごとのコスト (既定では命令の語数)
+            命令名ごと ('RPUSH') または命令名と引数の形ごと ('ADDA radrx')
+            に指定すると、引数の形のコストの代わりに使う
+  主記憶    データとして読み書きする語数 (stats.READS, WRITES) x memory
+            IN / OUT は長さの語と文字の語を実行時に数える
+  指標      指標レジスタを使う adrx / radrx 形式の命令なら index
+
+コストは命令の1語目だけで決まるので、1語目 -> コストの表 (65536 語) を
+あらかじめ作り、実行のたびに表を引いて machine.cost に足す。
+ネイティブルーチン (natives.py) を呼ぶ CALL は CALL 1命令分だけを数える。
+
+コストのファイルは次の形の JSON (省略した項目は既定の値)
+
+  {"argtypes": {"adrx": 2}, "opcodes": {"RPUSH": 4, "ADDA radrx": 3},
+   "memory": 1, "index": 1}
+
+サブルーチンごとのコストは CALL で呼び出し先に入ってから RET で戻るまでを
+そのサブルーチンのものとし、呼び出し先の分を含む値 (cost, steps) と
+含まない値 (self_cost, self_steps) を数える。CALL はその呼び出し元の、
+RET はそのサブルーチンのものとする。再帰呼び出しでは一番外側の呼び出し
+だけを含む値に足すので、同じコストを2重には数えない。
+'''
+from __future__ import print_function
+import sys
+import json
+
+from instructions import Jump, instruction
+from stats import READS, WRITES
+
+# 引数の形 -> 既定のコスト (命令の語数)
+ARGTYPES = {'noarg': 1, 'r': 1, 'r1r2': 1, 'adrx': 2, 'radrx': 2, 'strlen': 3}
+# 1語目の下位4ビットが指標レジスタである引数の形
+INDEXED = ('adrx', 'radrx')
+
+
+class CostModel(object):
+    '''
+    命令ごとのコストの決め方
+    opcodes のキーは命令名 ('RPUSH') または命令名と引数の形 ('ADDA radrx')
+    '''
+
+    def __init__(self, argtypes=None, opcodes=None, memory=1, index=1):
+        self.argtypes = dict(ARGTYPES)
+        self.argtypes.update(argtypes or {})
+        self.opcodes = dict(opcodes or {})
+        self.memory = memory
+        self.index = index
+
+    @classmethod
+    def load(cls, filename):
+        ''' JSON のファイルから読み込む '''
+        fp = open(filename)
+        try:
+            data = json.load(fp)
+        finally:
+            fp.close()
+        unknown = set(data) - set(('argtypes', 'opcodes', 'memory', 'index'))
+        if unknown:
+            raise ValueError('unknown key: %s' % ', '.join(sorted(unknown)))
+        return cls(data.get('argtypes'), data.get('opcodes'),
+                   data.get('memory', 1), data.get('index', 1))
+
+    def check(self, inst_table):
+        ''' 命令表にない命令名・引数の形があれば ValueError を送出する '''
+        names = set(inst.opname for inst in inst_table.values())
+        kinds = set(kind(inst) for inst in inst_table.values())
+        for name in self.argtypes:
+            if name not in ARGTYPES:
+                raise ValueError('unknown argtype: %s' % name)
+        for name in self.opcodes:
+            if name not in names and name not in kinds:
+                raise ValueError('unknown instruction: %s' % name)
+
+    def cost(self, inst):
+        ''' 指標レジスタを使わないときの inst のコスト '''
+        base = self.opcodes.get(kind(inst),
+                                self.opcodes.get(inst.opname))
+        if base is None:
+            base = self.argtypes[inst.argtype.__name__]
+        accesses = READS.get(inst.opcode, 0) + WRITES.get(inst.opcode, 0)
+        return base + self.memory * accesses
+
+    def table(self, inst_table):
+        ''' 1語目 -> コストの表 (不正な命令は 0) '''
+        self.check(inst_table)
+        table = []
+        for opcode in range(256):
+            inst = inst_table.get(opcode)
+            if inst is None:
+                table += [0] * 256
+                continue
+            c = self.cost(inst)
+            if inst.argtype.__name__ in INDEXED:
+                table += ([c] + [c + self.index] * 15) * 16
+            else:
+                table += [c] * 256
+        return table
+
+
+def kind(inst):
+    ''' 命令名と引数の形 (例: 'ADDA radrx') '''
+    return inst.opname + ' ' + inst.argtype.__name__
+
+
+def charge(inst, table, memory_cost):
+    ''' inst を、コストを machine.cost に足す命令にする '''
+    ir = inst.ir
+    name = inst.opname
+
+    if name == 'CALL':
+        def charging(machine, *args):
+            machine.cost += table[machine.memory[machine.PR]]
+            level = machine.call_level
+            try:
+                return ir(machine, *args)
+            except Jump as jump:
+                if machine.call_level != level:
+                    machine.enter_subroutine(jump.addr)
+                raise
+    elif name == 'RET':
+        def charging(machine, *args):
+            machine.cost += table[machine.memory[machine.PR]]
+            try:
+                return ir(machine, *args)
+            except Jump:
+                machine.leave_subroutine()
+                raise
+    elif name in ('IN', 'OUT'):
+        def charging(machine, s, l):
+            machine.cost += table[machine.memory[machine.PR]]
+            result = ir(machine, s, l)
+            # 長さの語と文字の語
+            machine.cost += memory_cost * (1 + machine.memory[l])
+            return result
+    else:
+        def charging(machine, *args):
+            machine.cost += table[machine.memory[machine.PR]]
+            return ir(machine, *args)
+    return instruction(inst.opcode, inst.opname, inst.argtype)(charging)
+
+
+def close_frame(records, active, frame, parent, cost, steps):
+    '''
+    サブルーチンの呼び出し frame を、コスト cost, ステップ数 steps の
+    時点で終えたものとして records に足す
+    '''
+    entry, start_cost, start_steps, child_cost, child_steps = frame
+    cost -= start_cost
+    steps -= start_steps
+    record = records.get(entry)
+    if record is None:
+        # [呼び出し回数, cost, self_cost, steps, self_steps]
+        record = records[entry] = [0, 0, 0, 0, 0]
+    record[0] += 1
+    record[2] += cost - child_cost
+    record[4] += steps - child_steps
+    active[entry] -= 1
+    if not active[entry]:
+        record[1] += cost
+        record[3] += steps
+    if parent is not None:
+        parent[3] += cost
+        parent[4] += steps
+
+
+def costed(engine, model=None):
+    '''
+    エンジン engine に命令ごとのコストの記録を加えたサブクラスを返す
+    コストは machine.cost に、サブルーチンごとの内訳は
+    cost_by_subroutine() で得られる
+    '''
+    model = model or CostModel()
+    table = model.table(engine.inst_table)
+
+    class CostedEngine(engine):
+
+        cost_model = model
+        cost_table = table
+        inst_table = dict((code, charge(inst, table, model.memory))
+                          for code, inst in engine.inst_table.items())
+
+        def __init__(self):
+            self.reset_cost()
+            engine.__init__(self)
+
+        def load(self, filename, quiet=False):
+            engine.load(self, filename, quiet)
+            self.reset_cost()
+
+        def reset_cost(self):
+            ''' 現在の PR を入口として数え直す '''
+            self.cost = 0
+            entry = getattr(self, 'PR', 0)
+            # [入口, 入ったときの cost, step_count, 呼び出し先の cost, steps]
+            self.cost_frames = [[entry, 0, getattr(self, 'step_count', 0),
+                                 0, 0]]
+            # 入口 -> [呼び出し回数, cost, self_cost, steps, self_steps]
+            self.cost_records = {}
+            # 入口 -> 実行中の呼び出しの数
+            self.cost_active = {entry: 1}
+
+        def enter_subroutine(self, entry):
+            # CALL 自身のステップはこの後で数えられ、呼び出し元のものとする
+            self.cost_frames.append([entry, self.cost, self.step_count + 1,
+                                     0, 0])
+            self.cost_active[entry] = self.cost_active.get(entry, 0) + 1
+
+        def leave_subroutine(self):
+            frames = self.cost_frames
+            if len(frames) < 2:
+                return
+            frame = frames.pop()
+            # RET 自身のステップはこの後で数えられる
+            close_frame(self.cost_records, self.cost_active, frame,
+                        frames[-1], self.cost, self.step_count + 1)
+
+        def cost_by_subroutine(self):
+            '''
+            サブルーチンごとのコストを cost の大きい順に dict のリストで返す
+            実行中の呼び出しは現在の時点で終えたものとして数える
+            '''
+            from cfg import address_names
+            records = dict((entry, list(record))
+                           for entry, record in self.cost_records.items())
+            active = dict(self.cost_active)
+            frames = [list(frame) for frame in self.cost_frames]
+            for i in range(len(frames) - 1, -1, -1):
+                close_frame(records, active, frames[i],
+                            frames[i - 1] if i else None,
+                            self.cost, self.step_count)
+            names = address_names(self.symbols)
+            result = []
+            for entry, record in records.items():
+                calls, cost, self_cost, steps, self_steps = record
+                result.append({'entry': entry, 'name': names.get(entry),
+                               'calls': calls,
+                               'cost': cost, 'self_cost': self_cost,
+                               'steps': steps, 'self_steps': self_steps})
+            result.sort(key=lambda r: (-r['cost'], r['entry']))
+            return result
+
+        def report_exit(self):
+            engine.report_exit(self)
+            if self.is_count_step:
+                print('Cost:', self.cost)
+
+        if hasattr(engine, 'fast_forwarded'):
+            def fast_forwarded(self, head, branch, iterations):
+                engine.fast_forwarded(self, head, branch, iterations)
+                # 早送りしたループの命令のコストを繰り返し回数分足す
+                from idioms import decode_loop
+                memory = self.memory
+                c = 0
+                adr = head
+                for inst, args in decode_loop(self, head, branch):
+                    c += table[memory[adr]]
+                    adr += inst.argtype.size
+                self.cost += c * iterations
+
+    CostedEngine.__name__ = 'Costed' + engine.__name__
+    return CostedEngine
+
+
+def report(machine, fp=sys.stdout):
+    ''' 全体とサブルーチンごとのコストを表にして出力する '''
+    print('cost: %d in %d steps' % (machine.cost, machine.step_count),
+          file=fp)
+    print('entry  name        calls        cost   self_cost       steps'
+          '  self_steps', file=fp)
+    for r in machine.cost_by_subroutine():
+        print('#%04x  %-8s  %7d  %10d  %10d  %10d  %10d' % (
+            r['entry'], r['name'] or '', r['calls'], r['cost'],
+            r['self_cost'], r['steps'], r['self_steps']), file=fp)
+
+
+def main():
+    from optparse import OptionParser
+    from engines import engines, add_engine_option, add_run_options, \
+        run_file
+    usage = 'usage: %prog [options] input.com|input.cas'
+    parser = OptionParser(usage)
+    add_engine_option(parser)
+    parser.add_option('-m', '--model', type='string',
+                      dest='model', default=None,
+                      help='read the cost model from the JSON file.')
+    add_run_options(parser)
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(2)
+
+    try:
+        model = None
+        if options.model is not None:
+            model = CostModel.load(options.model)
+        engine = costed(engines[options.engine], model)
+    except (IOError, ValueError) as e:
+        parser.error('%s: %s' % (options.model, e))
+    machine, result = run_file(engine, args[0], options)
+    report(machine)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+# ~*~ coding:utf-8 ~*~
+'''
+命令の網羅率 (カバレッジ) の記録と報告
+
+  python pycomet2.py -r --coverage prog.cov prog.com < case.in
+  python cover.py [options] prog.cas [prog.cov ...] [-i case.in ...]
+
+実行した番地と、条件分岐命令 (JMI, JNZ, JZE, JPL, JOV) が分岐したか・
+しなかったかを 65536 ビットのビットマップに記録する。
+1命令ごとではなく、制御を移す命令 (分岐, CALL, RET, SVC) の実行時に
+直前の分岐先からその命令までをまとめて記録するので、分岐の少ない部分は
+ほとんど速度が落ちない。
+
+記録したファイル (JSON) は同じプログラムについてのものなら OR で
+併合できる。pycomet2.py --coverage は既存のファイルに追記する。
+cover.py はソースをアセンブルし、ByteCode.line_number を使って
+行ごとの網羅率を表示する。
+'''
+from __future__ import print_function
+import sys
+import os
+import json
+import zlib
+import base64
+import hashlib
+import tempfile
+
+from instructions import Jump, instruction
+
+# 条件分岐命令
+CONDITIONAL = ('JMI', 'JNZ', 'JZE', 'JPL', 'JOV')
+# 制御を移すことがある命令
+CONTROL = CONDITIONAL + ('JUMP', 'CALL', 'RET', 'SVC')
+
+FORMAT = 'pycomet2-coverage'
+VERSION = 1
+
+
+def program_digest(memory):
+    ''' 読み込んだ直後の主記憶から、プログラムを識別する値を作る '''
+    return hashlib.sha1(memory).hexdigest()
+
+
+class Coverage(object):
+    ''' 実行した番地, 分岐した番地, 分岐しなかった番地のビットマップ '''
+
+    def __init__(self, program=None):
+        self.program = program
+        self.executed = bytearray(0x2000)
+        self.taken = bytearray(0x2000)
+        self.not_taken = bytearray(0x2000)
+        # 記録済みのブロック (lo << 17 | hi)
+        self.blocks = set()
+
+    def cover(self, lo, hi):
+        ''' 番地 [lo, hi) を実行したものとして記録する '''
+        key = lo << 17 | hi
+        if key in self.blocks:
+            return
+        self.blocks.add(key)
+        executed = self.executed
+        for adr in range(lo, min(hi, 0x10000)):
+            executed[adr >> 3] |= 1 << (adr & 7)
+
+    def branch(self, adr, taken):
+        bitmap = self.taken if taken else self.not_taken
+        bitmap[adr >> 3] |= 1 << (adr & 7)
+
+    def is_executed(self, adr):
+        return self.executed[adr >> 3] >> (adr & 7) & 1
+
+    def is_taken(self, adr):
+        return self.taken[adr >> 3] >> (adr & 7) & 1
+
+    def is_not_taken(self, adr):
+        return self.not_taken[adr >> 3] >> (adr & 7) & 1
+
+    def merge(self, other):
+        if (self.program is not None and other.program is not None
+                and self.program != other.program):
+            raise ValueError('Coverage of a different program.')
+        self.program = self.program or other.program
+        for name in ('executed', 'taken', 'not_taken'):
+            a, b = getattr(self, name), getattr(other, name)
+            setattr(self, name, bytearray(x | y for x, y in zip(a, b)))
+        self.blocks.clear()
+
+    def to_dict(self):
+        result = {'format': FORMAT, 'version': VERSION,
+                  'program': self.program}
+        for name in ('executed', 'taken', 'not_taken'):
+            data = zlib.compress(bytes(getattr(self, name)))
+            result[name] = base64.b64encode(data).decode('ascii')
+        return result
+
+    def save(self, filename):
+        fp = open(filename, 'w')
+        json.dump(self.to_dict(), fp)
+        fp.close()
+
+
+def from_dict(data):
+    if data.get('format') != FORMAT or data.get('version') != VERSION:
+        raise ValueError('Unknown coverage format.')
+    coverage = Coverage(data['program'])
+    for name in ('executed', 'taken', 'not_taken'):
+        bitmap = zlib.decompress(base64.b64decode(data[name]))
+        setattr(coverage, name, bytearray(bitmap))
+    return coverage
+
+
+def load(filename):
+    fp = open(filename)
+    data = json.load(fp)
+    fp.close()
+    return from_dict(data)
+
+
+def wrap(inst):
+    ''' 制御を移す命令 inst を、実行のたびに網羅率を記録する命令にする '''
+    ir = inst.ir
+    size = inst.argtype.size
+    conditional = inst.opname in CONDITIONAL
+
+    def control(machine, *args):
+        adr = machine.PR
+        coverage = machine.coverage
+        # 直前の分岐先からこの命令までを1つのブロックとして記録する
+        start, end = machine.block_start, adr + size
+        if (start << 17 | end) not in coverage.blocks:
+            coverage.cover(start, end)
+        machine.block_start = end
+        try:
+            result = ir(machine, *args)
+        except Jump as jump:
+            if conditional:
+                coverage.branch(adr, True)
+            machine.block_start = jump.addr
+            raise
+        if conditional:
+            coverage.branch(adr, False)
+        return result
+    return instruction(inst.opcode, inst.opname, inst.argtype)(control)
+
+
+def covered(engine):
+    ''' エンジン engine に網羅率の記録を加えたサブクラスを返す '''
+
+    class CoveredEngine(engine):
+
+        inst_table = dict((code, wrap(inst) if inst.opname in CONTROL
+                           else inst)
+                          for code, inst in engine.inst_table.items())
+
+        def __init__(self, coverage=None):
+            self.coverage = coverage or Coverage()
+            self.block_start = 0
+            engine.__init__(self)
+
+        def load(self, filename, quiet=False):
+            engine.load(self, filename, quiet)
+            digest = program_digest(self.memory)
+            if self.coverage.program is None:
+                self.coverage.program = digest
+            elif self.coverage.program != digest:
+                raise ValueError('Coverage of a different program.')
+            self.block_start = self.PR
+
+        def jump(self, addr):
+            # 対話モードの j: ここまでを記録し、飛び先から新しいブロックにする
+            self.finish_coverage()
+            engine.jump(self, addr)
+            self.block_start = self.PR
+
+        def finish_coverage(self):
+            ''' 最後の制御命令から停止した番地の手前までを記録する '''
+            if self.block_start < self.PR:
+                self.coverage.cover(self.block_start, self.PR)
+            self.block_start = self.PR
+            return self.coverage
+
+        if hasattr(engine, 'fast_forwarded'):
+            def fast_forwarded(self, head, branch, iterations):
+                engine.fast_forwarded(self, head, branch, iterations)
+                if self.PR != head:
+                    # ループを早送りして抜けた
+                    self.coverage.branch(branch, False)
+
+    CoveredEngine.__name__ = 'Covered' + engine.__name__
+    return CoveredEngine
+
+
+def record(machine, filename):
+    ''' machine の網羅率を filename に追記する '''
+    coverage = machine.finish_coverage()
+    if os.path.exists(filename):
+        merged = load(filename)
+        merged.merge(coverage)
+        coverage = merged
+    coverage.save(filename)
+
+
+def assemble(filename, com):
+    ''' .cas をアセンブルして com に書き出し、(CASL2, ByteCode のリスト) を返す '''
+    from pycasl2 import CASL2
+    casl2 = CASL2()
+    bytecodes = casl2.assemble(filename)
+    casl2.write(com, bytecodes)
+    return casl2, bytecodes
+
+
+def line_coverage(casl2, bytecodes, coverage):
+    '''
+    命令を含む行ごとの網羅率を
+    {line, source, executed[, taken, not_taken]} のリストで返す
+    '''
+    from pycomet2 import inst_list
+    opnames = set(inst.opname for inst in inst_list)
+    lines = []
+    for bc in bytecodes:
+        if not bc.code:
+            continue
+        op = casl2.split_line(bc.src, bc.line_number).op
+        if op not in opnames:
+            continue
+        entry = {'line': bc.line_number, 'source': bc.src,
+                 'executed': bool(coverage.is_executed(bc.addr))}
+        if op in CONDITIONAL:
+            entry['taken'] = bool(coverage.is_taken(bc.addr))
+            entry['not_taken'] = bool(coverage.is_not_taken(bc.addr))
+        lines.append(entry)
+    lines.sort(key=lambda x: x['line'])
+    return lines
+
+
+def summarize(lines):
+    ''' (実行した行数, 行数, 通った分岐の向き, 分岐の向きの数) '''
+    executed = len([x for x in lines if x['executed']])
+    branches = [x for x in lines if 'taken' in x]
+    directions = sum(int(x['taken']) + int(x['not_taken'])
+                     for x in branches)
+    return executed, len(lines), directions, 2 * len(branches)
+
+
+def percent(n, total):
+    return 100.0 * n / total if total else 100.0
+
+
+def report(filename, lines, fp=sys.stdout):
+    '''
+    行ごとの網羅率を表示する
+    分岐の列は、分岐した (T) / しなかった (N) ことがあるかを示す
+    '''
+    print('Coverage of %s' % filename, file=fp)
+    print('  line  exec  branch  source', file=fp)
+    for x in lines:
+        branch = ''
+        if 'taken' in x:
+            branch = '%s %s' % ('T' if x['taken'] else '-',
+                                'N' if x['not_taken'] else '-')
+        print('%6d  %4s  %-6s  %s' % (x['line'],
+                                      'yes' if x['executed'] else '###',
+                                      branch, x['source'].rstrip()), file=fp)
+    executed, total, taken, branches = summarize(lines)
+    print('lines: %d/%d (%.1f%%)  branches: %d/%d (%.1f%%)'
+          % (executed, total, percent(executed, total),
+             taken, branches, percent(taken, branches)), file=fp)
+
+
+def run_cases(com, coverage, inputs, engine, max_steps=None, timeout=None):
+    ''' 各入力について com を実行し、網羅率を coverage に加える '''
+    from engines import engines
+    from forkserver import run_case
+    machine = covered(engines[engine])(coverage)
+    for case in inputs:
+        machine.load(com, True)
+        fp = open(case)
+        result = run_case(machine, fp.read(), max_steps, timeout)
+        fp.close()
+        machine.finish_coverage()
+        print('%-8s %10s steps  %s' % (result['status'], result['steps'],
+                                       case), file=sys.stderr)
+
+
+def main():
+    from optparse import OptionParser
+    from engines import engines, add_engine_option
+    usage = 'usage: %prog [options] input.cas [coverage.cov ...]'
+    parser = OptionParser(usage)
+    parser.add_option('-i', '--input', type='string', action='append',
+                      dest='inputs', default=[],
+                      help='run the program with the input file and add its '
+                           'coverage. (can be given more than once)')
+    add_engine_option(parser, 'cache', 'execution engine for -i.')
+    parser.add_option('--max-steps', type='int',
+                      dest='max_steps', default=None,
+                      help='stop each run after executing N steps.')
+    parser.add_option('--timeout', type='float',
+                      dest='timeout', default=None,
+                      help='stop each run after running for SEC seconds.')
+    parser.add_option('-o', '--output', type='string',
+                      dest='output', default=None,
+                      help='write the merged coverage to the file.')
+    parser.add_option('-j', '--json', action='store_true',
+                      dest='json', default=False,
+                      help='print the coverage of each line in JSON.')
+    parser.add_option('--check', action='store_true',
+                      dest='check', default=False,
+                      help='exit with status 1 unless every line and both '
+                           'directions of every branch are covered.')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(2)
+
+    fd, com = tempfile.mkstemp(suffix='.com')
+    os.close(fd)
+    try:
+        casl2, bytecodes = assemble(args[0], com)
+        machine = covered(engines[options.engine])()
+        machine.load(com, True)
+        coverage = machine.coverage
+        for filename in args[1:]:
+            try:
+                coverage.merge(load(filename))
+            except ValueError as e:
+                print('%s: %s' % (filename, e), file=sys.stderr)
+                sys.exit(1)
+        if options.inputs:
+            run_cases(com, coverage, options.inputs, options.engine,
+                      options.max_steps, options.timeout)
+    finally:
+        os.remove(com)
+    if options.output:
+        coverage.save(options.output)
+
+    lines = line_coverage(casl2, bytecodes, coverage)
+    if options.json:
+        executed, total, taken, branches = summarize(lines)
+        json.dump({'source': args[0], 'lines': lines,
+                   'summary': {'lines': executed, 'total_lines': total,
+                               'branches': taken,
+                               'total_branches': branches}},
+                  sys.stdout, indent=1, sort_keys=True)
+        print()
+    else:
+        report(args[0], lines)
+    if options.check:
+        executed, total, taken, branches = summarize(lines)
+        sys.exit(0 if executed == total and taken == branches else 1)
+
+
+if __name__ == '__main__':
+    main()
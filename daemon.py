@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+'''
+Unix ドメインソケットで実行要求を受け付ける PyComet2 のデーモンとクライアント
+
+  python pycomet2.py --serve [--socket PATH] [--workers N]
+                            [--max-steps N] [--timeout SEC]
+  python daemon.py [options] input.com|input.cas     (pycomet2.py -r の代わり)
+
+デーモンは起動時に worker を fork しておき、各 worker が同じソケットで
+accept() して要求を処理する。worker はエンジンごとに PyComet2 を1つ持ち、
+要求のたびに読み込み直して使い回す。
+
+要求と応答は、4 バイトのビッグエンディアンの長さに続く JSON で送る。
+
+  要求  source (CASL2 のソース) または image (.com の内容を base64),
+        input, max_steps, timeout, engine, natives (["MULT", "MULT@#0012"]),
+        dump ([[開始番地, 語数], ...]), expected (期待した出力)
+  応答  status (halted, invalid, steps, time, mismatch, error), error, steps,
+        PR, SP, GR, OF, SF, ZF, output, dump ([[開始番地, [値, ...]], ...])
+
+文字列 (source, input, expected, output) は latin-1 として送る。
+
+max_steps と timeout にはデーモン側の上限 (serve() の引数) があり、
+要求で指定しなかったときはその値を、上限より大きい値はその上限を使う。
+終わらないプログラムが worker を占有し続けることはない。
+'''
+from __future__ import print_function
+import sys
+import os
+import json
+import struct
+import signal
+import socket
+import base64
+import tempfile
+from array import array
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+HALTED = 'halted'
+INVALID = 'invalid'
+MISMATCH = 'mismatch'
+ERROR = 'error'
+
+# 既定のソケットのパス
+DEFAULT_SOCKET = os.environ.get('PYCOMET2_SOCKET') or \
+    os.path.join(tempfile.gettempdir(), 'pycomet2-%d.sock' % os.getuid())
+
+# 1つの要求の大きさの上限
+MAX_MESSAGE = 64 << 20
+
+# 1つの要求の実行のステップ数と時間 [秒] の既定の上限
+DEFAULT_MAX_STEPS = 100000000
+DEFAULT_TIMEOUT = 60.0
+
+
+def send_message(sock, obj):
+    data = json.dumps(obj).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def recv_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    ''' 受け取った JSON を返す (接続が閉じられていれば None) '''
+    header = recv_exactly(sock, 4)
+    if header is None:
+        return None
+    n, = struct.unpack('>I', header)
+    if MAX_MESSAGE < n:
+        raise ValueError('Message is too large.')
+    data = recv_exactly(sock, n)
+    if data is None:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+if str is bytes:
+    # Python 2 では str をそのまま JSON にできないので latin-1 で変換する
+    def to_json(s):
+        return s.decode('latin-1')
+
+    def from_json(s):
+        return s.encode('latin-1')
+else:
+    def to_json(s):
+        return s
+
+    def from_json(s):
+        return s
+
+
+class AssembleError(Exception):
+    pass
+
+
+def clamp(value, limit):
+    ''' 要求の値 value を上限 limit 以下にする (None は指定なし・上限なし) '''
+    if limit is None:
+        return value
+    if value is None:
+        return limit
+    return min(value, limit)
+
+
+class Worker(object):
+    '''
+    要求を処理する。PyComet2 はエンジンごとに1つだけ作って使い回す
+    max_steps, timeout は1つの要求の実行の上限 (None なら上限なし)
+    '''
+
+    def __init__(self, max_steps=DEFAULT_MAX_STEPS, timeout=DEFAULT_TIMEOUT):
+        self.machines = {}
+        self.max_steps = max_steps
+        self.timeout = timeout
+
+    def machine(self, engine):
+        if engine not in self.machines:
+            from engines import engines
+            self.machines[engine] = engines[engine]()
+        m = self.machines[engine]
+        m.break_points = {}
+        m.natives = {}
+        m.call_level = 0
+        m.step_count = 0
+        return m
+
+    def load(self, m, request):
+        ''' 要求のプログラムを読み込み、シンボル表を返す '''
+        fd, com = tempfile.mkstemp(suffix='.com')
+        os.close(fd)
+        try:
+            symbols = {}
+            if 'source' in request:
+                symbols = self.assemble(request['source'].encode('latin-1'),
+                                        com)
+            else:
+                fp = open(com, 'wb')
+                fp.write(base64.b64decode(request['image']))
+                fp.close()
+            m.load(com, True)
+        finally:
+            os.remove(com)
+        return symbols
+
+    def assemble(self, source, com):
+        from pycasl2 import CASL2
+        fd, src = tempfile.mkstemp(suffix='.cas')
+        os.write(fd, source)
+        os.close(fd)
+        # pycasl2 はエラーを標準エラー出力に書いて sys.exit() する
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            casl2 = CASL2()
+            casl2.write(com, casl2.assemble(src))
+            return casl2.symbols
+        except SystemExit:
+            raise AssembleError(sys.stderr.getvalue().strip())
+        finally:
+            sys.stderr = stderr
+            os.remove(src)
+
+    def bind_natives(self, m, specs, symbols):
+        from natives import Natives, library
+        natives = Natives()
+        for spec in specs:
+            if '@' in spec:
+                name, addr = spec.split('@')
+                natives.bind(m.cast_int(addr), library[name])
+            else:
+                natives.bind(spec, library[spec])
+        m.natives = natives.resolve(symbols)
+
+    def handle(self, request):
+        from forkserver import run_case
+        try:
+            m = self.machine(request.get('engine', 'reference'))
+            symbols = self.load(m, request)
+            if request.get('natives'):
+                self.bind_natives(m, request['natives'], symbols)
+        except AssembleError as e:
+            return {'status': ERROR, 'error': str(e)}
+        except Exception as e:
+            return {'status': ERROR, 'error': repr(e)}
+        expected = request.get('expected')
+        if expected is not None:
+            expected = from_json(expected)
+        result = run_case(m, from_json(request.get('input', '')),
+                          clamp(request.get('max_steps'), self.max_steps),
+                          clamp(request.get('timeout'), self.timeout),
+                          expected)
+        result['output'] = to_json(result['output'])
+        result.update({'PR': m.PR, 'SP': m.SP, 'GR': list(m.GR),
+                       'OF': m.OF, 'SF': m.SF, 'ZF': m.ZF})
+        regions = request.get('dump') or []
+        if result['status'] == INVALID:
+            # pycomet2.py と同じく、不正な命令の番地から 128 語を返す
+            regions = regions + [[m.PR, 128]]
+        result['dump'] = [[start, list(m.memory[start:start + length])]
+                          for start, length in regions]
+        return result
+
+    def serve_forever(self, listener):
+        while True:
+            conn, _ = listener.accept()
+            try:
+                while True:
+                    request = recv_message(conn)
+                    if request is None:
+                        break
+                    send_message(conn, self.handle(request))
+            except (socket.error, ValueError):
+                pass
+            finally:
+                conn.close()
+
+
+def serve(path=DEFAULT_SOCKET, workers=4, max_steps=DEFAULT_MAX_STEPS,
+          timeout=DEFAULT_TIMEOUT):
+    '''
+    path で要求を待ち受け、workers 個の worker プロセスで処理する
+    max_steps, timeout は1つの要求の実行の上限 (Worker を参照)
+    SIGTERM / SIGINT を受け取るまで戻らない
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    # 要求の処理に使うモジュールを読み込んでから fork する
+    import engines, forkserver, pycasl2
+    children = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            status = 0
+            try:
+                Worker(max_steps, timeout).serve_forever(listener)
+            except BaseException:
+                status = 1
+            os._exit(status)
+        children.add(pid)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print('pycomet2: listening on %s' % path, file=sys.stderr)
+    try:
+        for i in range(workers):
+            spawn()
+        while True:
+            try:
+                pid, status = os.wait()
+            except OSError:
+                continue
+            children.discard(pid)
+            # 異常終了した worker は作り直す
+            spawn()
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        listener.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class Client(object):
+    ''' デーモンに実行を依頼する '''
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def request(self, **request):
+        send_message(self.sock, request)
+        response = recv_message(self.sock)
+        if response is None:
+            raise socket.error('Connection is closed by the daemon.')
+        return response
+
+    def run(self, filename, input_data='', **options):
+        ''' .cas または .com を実行し、応答を返す '''
+        fp = open(filename, 'rb')
+        data = fp.read()
+        fp.close()
+        if os.path.splitext(filename)[1] == '.cas':
+            options['source'] = data.decode('latin-1')
+        else:
+            options['image'] = base64.b64encode(data).decode('ascii')
+        options['input'] = to_json(input_data)
+        return self.request(**options)
+
+    def close(self):
+        self.sock.close()
+
+
+def restore(response):
+    ''' 応答から PyComet2 を作る (表示用) '''
+    from pycomet2 import PyComet2
+    m = PyComet2()
+    for start, words in response.get('dump', []):
+        m.memory[start:start + len(words)] = array('H', words)
+    for i, v in enumerate(response['GR']):
+        m.GR[i] = v
+    m.PR = response['PR']
+    m.OF, m.SF, m.ZF = response['OF'], response['SF'], response['ZF']
+    m.step_count = response['steps']
+    return m
+
+
+def main():
+    from optparse import OptionParser
+    from engines import add_engine_option
+    from errors import BudgetExceeded
+    usage = 'usage: %prog [options] input.com|input.cas'
+    parser = OptionParser(usage)
+    parser.add_option('-c', '--count-step', action='store_true',
+                      dest='count_step', default=False, help='count step.')
+    parser.add_option('-d', '--dump', action='store_true',
+                      dest='dump', default=False,
+                      help='dump last status to last_state.txt.')
+    parser.add_option('-r', '--run', action='store_true',
+                      dest='run', default=True,
+                      help='run (always on; for compatibility with '
+                           'pycomet2.py)')
+    parser.add_option('--max-steps', type='int',
+                      dest='max_steps', default=None,
+                      help='stop after executing N steps.')
+    parser.add_option('--timeout', type='float',
+                      dest='timeout', default=None,
+                      help='stop after running for SEC seconds.')
+    parser.add_option('-i', '--input', type='string',
+                      dest='input', default=None,
+                      help='read input of IN from the file. '
+                           '(- for the standard input)')
+    parser.add_option('-o', '--output', type='string',
+                      dest='output', default=None,
+                      help='write output of OUT to the file.')
+    parser.add_option('--expect', type='string',
+                      dest='expect', default=None,
+                      help='compare output of OUT with the file line by line '
+                           'and stop at the first difference.')
+    parser.add_option('--no-prompt', action='store_true',
+                      dest='no_prompt', default=False,
+                      help='accepted for compatibility with pycomet2.py.')
+    parser.add_option('--native', type='string', action='append',
+                      dest='natives', default=[],
+                      help='run the subroutine at ADDR (or NAME) with the '
+                           'native routine NAME. (ex. --native MULT@#0012)')
+    add_engine_option(parser)
+    parser.add_option('-s', '--socket', type='string',
+                      dest='socket', default=DEFAULT_SOCKET,
+                      help='path of the socket. (default: %default)')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit()
+
+    # 入力はまとめて送る (対話的な入力には対応しない)
+    # 標準入力は -i - で明示したときだけ読む。指定しなければ入力は空で、
+    # IN は入力の終わりを読む
+    input_data = ''
+    if options.input == '-':
+        input_data = sys.stdin.read()
+    elif options.input is not None:
+        fp = open(options.input)
+        input_data = fp.read()
+        fp.close()
+
+    expected = None
+    if options.expect is not None:
+        fp = open(options.expect)
+        expected = to_json(fp.read())
+        fp.close()
+
+    client = Client(options.socket)
+    try:
+        response = client.run(args[0], input_data, expected=expected,
+                              max_steps=options.max_steps,
+                              timeout=options.timeout,
+                              engine=options.engine,
+                              natives=options.natives,
+                              dump=[[0, 0x10000]] if options.dump else [])
+    finally:
+        client.close()
+
+    status = response['status']
+    if status == ERROR and 'PR' not in response:
+        print(response['error'], file=sys.stderr)
+        sys.exit(1)
+    output = from_json(response['output'])
+    if options.output is not None:
+        fp = open(options.output, 'w')
+        fp.write(output)
+        fp.close()
+    else:
+        sys.stdout.write(output)
+    m = restore(response)
+    m.is_count_step = options.count_step
+    m.is_auto_dump = options.dump
+    if status == INVALID:
+        print(response['error'], file=sys.stderr)
+        m.dump(m.PR)
+    elif status == ERROR:
+        print(response['error'], file=sys.stderr)
+    elif status == MISMATCH:
+        print(response['error'], file=sys.stderr)
+        m.report_exit()
+        sys.exit(1)
+    else:
+        if status != HALTED:
+            print(BudgetExceeded(m, status), file=sys.stderr)
+        m.report_exit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+# ~*~ coding:utf-8 ~*~
+'''
+PyComet2 の実行エンジン
+
+どのエンジンも PyComet2 のサブクラスで、step() を差し替えている。
+step() は1回の呼び出しで step_count を1以上進め、
+PyComet2.step() と同じ結果にならなければならない (verify.py で検証する)。
+
+add_engine_option(), add_run_options(), run_file() は、エンジンを選んで
+1つのプログラムを実行するコマンド (hostprof.py, cost.py など) で共通の部分。
+'''
+from __future__ import print_function
+import sys
+
+from pycomet2 import PyComet2, load_program
+from errors import InvalidOperation
+from instructions import Jump
+import idioms
+
+# 1つの手順として実行する命令の組 (1命令目, 2命令目)
+# 1命令目は分岐しない命令に限る
+FUSIONS = set([(cmp, jcc) for cmp in ('CPA', 'CPL') for jcc in idioms.BRANCH]
+              + [('LD', op) for op in ('ADDA', 'ADDL', 'SUBA', 'SUBL')]
+              + [('LAD', 'JUMP'), ('PUSH', 'CALL'), ('PUSH', 'PUSH'),
+                 ('POP', 'POP')])
+
+# 分岐命令 -> フラグ (ZF, SF, OF) から分岐するかを返す関数
+CONDITIONS = dict(idioms.BRANCH, JUMP=lambda ZF, SF, OF: True)
+
+# instructions.py の命令の本体 (cover.py などで包んだものは含まない)
+PLAIN = set(inst.ir for inst in PyComet2.inst_list)
+
+
+def fuse(ir1, args1, second, inst2, args2, words):
+    '''
+    1命令目 (ir1, args1) に続けて、second 番地の命令 inst2 を実行する関数
+    fused(machine, PR) を返す
+    2命令目の語 words が書き換えられていたら融合をやめてキャッシュから外し、
+    2命令目の番地がブレークポイントのときや step_limit に達したときは
+    1命令目だけで止める
+    '''
+    ir2 = inst2.ir
+    end = second + len(words)
+    v0 = words[0]
+    v1 = words[1] if 1 < len(words) else None
+    # 指標レジスタを使わない分岐は Jump を送出せずに行き先を決める
+    cond = None
+    if ir2 in PLAIN and inst2.opname in CONDITIONS and args2[1] == 0:
+        cond = CONDITIONS[inst2.opname]
+        target = args2[0]
+
+    def fused(machine, PR):
+        result = ir1(machine, *args1)
+        if result is not None:
+            ZF, SF, OF = result
+            if ZF is not None: machine.ZF = ZF
+            if SF is not None: machine.SF = SF
+            if OF is not None: machine.OF = OF
+        machine.PR = second
+        machine.step_count += 1
+        memory = machine.memory
+        if v0 != memory[second] or (v1 is not None
+                                    and v1 != memory[second + 1]):
+            del machine.decode_cache[PR]
+            return
+        if (second in machine.break_points or second in machine.stop_at
+                or (machine.step_limit is not None
+                    and machine.step_limit <= machine.step_count)):
+            return
+        if cond is not None:
+            machine.step_count += 1
+            if cond(machine.ZF, machine.SF, machine.OF):
+                machine.PR = target
+                if target <= second:
+                    machine.jumped_back(second)
+            else:
+                machine.PR = end
+            return
+        backward = False
+        try:
+            result = ir2(machine, *args2)
+        except Jump as jump:
+            machine.PR = jump.addr
+            result = jump.result
+            backward = jump.addr <= second
+        else:
+            machine.PR = end
+        if result is not None:
+            ZF, SF, OF = result
+            if ZF is not None: machine.ZF = ZF
+            if SF is not None: machine.SF = SF
+            if OF is not None: machine.OF = OF
+        machine.step_count += 1
+        if backward:
+            machine.jumped_back(second)
+    return fused
+
+
+class DecodeCacheComet2(PyComet2):
+    '''
+    命令のデコード結果を番地ごとにキャッシュするエンジン
+    キャッシュした語と主記憶の内容を実行のたびに照合するので、
+    自己書き換えや write_memory() にもそのまま対応する
+    fusion が真なら、FUSIONS の組の2命令を1回の step() で実行する
+    (step_count は2進む)
+    '''
+
+    fusion = True
+
+    def initialize(self):
+        PyComet2.initialize(self)
+        self.invalidate()
+
+    def invalidate(self):
+        # 番地 -> (ir, 引数, 語数, 1語目, 2語目, 3語目)
+        self.decode_cache = {}
+
+    def predecode(self, adr):
+        inst = self.get_instruction(adr)
+        size = inst.argtype.size
+        words = [self.memory[adr + i] for i in range(size)]
+        words += [None] * (3 - size)
+        entry = (inst.ir, inst.argtype(self, adr), size) + tuple(words)
+        if self.fusion:
+            fused = self.fuse(adr, inst, entry)
+            if fused is not None:
+                # 引数の代わりに None を置いて融合したことを示す
+                entry = (fused, None) + entry[2:]
+        self.decode_cache[adr] = entry
+        return entry
+
+    def fuse(self, adr, inst, entry):
+        ''' adr の命令と次の命令が FUSIONS の組なら、融合した関数を返す '''
+        second = adr + entry[2]
+        try:
+            inst2 = self.get_instruction(second)
+            size = inst2.argtype.size
+            if (inst.opname, inst2.opname) not in FUSIONS \
+                    or 0x10000 < second + size:
+                return None
+            args = inst2.argtype(self, second)
+        except (InvalidOperation, IndexError):
+            return None
+        return fuse(entry[0], entry[1], second, inst2, args,
+                    self.memory[second:second + size])
+
+    def step(self):
+        PR = self.PR
+        memory = self.memory
+        try:
+            ir, args, size, w0, w1, w2 = self.decode_cache[PR]
+            if (w0 != memory[PR]
+                    or (1 < size and (w1 != memory[PR + 1]
+                                      or (2 < size
+                                          and w2 != memory[PR + 2])))):
+                raise KeyError(PR)
+        except KeyError:
+            ir, args, size, w0, w1, w2 = self.predecode(PR)
+        if args is None:
+            ir(self, PR)
+            return
+        backward = False
+        try:
+            result = ir(self, *args)
+        except Jump as jump:
+            self.PR = jump.addr
+            result = jump.result
+            backward = jump.addr <= PR
+        else:
+            self.PR = PR + size
+        if result is not None:
+            ZF, SF, OF = result
+            if ZF is not None: self.ZF = ZF
+            if SF is not None: self.SF = SF
+            if OF is not None: self.OF = OF
+        self.step_count += 1
+        if backward:
+            self.jumped_back(PR)
+
+    def jumped_back(self, branch):
+        ''' branch 番地の命令で後方へ分岐した直後に呼ばれる '''
+        pass
+
+
+class IdiomComet2(DecodeCacheComet2):
+    '''
+    何度も後方へ分岐するループを調べ、idioms.py で認識できるものは
+    残りの繰り返しをまとめて実行するエンジン
+    '''
+
+    # この回数だけ後方へ分岐したループを調べる
+    hot_threshold = 8
+
+    def invalidate(self):
+        DecodeCacheComet2.invalidate(self)
+        # (先頭, 分岐命令の番地) -> 後方へ分岐した回数
+        self.loop_counts = {}
+        # (先頭, 分岐命令の番地) -> (ループの語, idioms.Loop または None)
+        self.loops = {}
+
+    def jumped_back(self, branch):
+        head = self.PR
+        key = (head, branch)
+        entry = self.loops.get(key)
+        if entry is None:
+            count = self.loop_counts.get(key, 0) + 1
+            self.loop_counts[key] = count
+            if count < self.hot_threshold:
+                return
+            entry = self.analyze(head, branch)
+        words, loop = entry
+        if words != self.memory[head:branch + 2]:
+            # 書き換えられていたら調べ直す
+            words, loop = self.analyze(head, branch)
+        if loop is None:
+            return
+        for bp in self.break_points:
+            if head <= bp < branch + 2:
+                return
+        for bp in self.stop_at:
+            if head <= bp < branch + 2:
+                return
+        max_iterations = idioms.MAX_ITERATIONS
+        if self.step_limit is not None:
+            max_iterations = (self.step_limit - self.step_count) // loop.size
+        k = loop.run(self, max_iterations)
+        if k:
+            self.fast_forwarded(head, branch, k)
+
+    def fast_forwarded(self, head, branch, iterations):
+        '''
+        head から branch までのループを iterations 回分早送りした直後に
+        呼ばれる (記録を取るサブクラスが、早送りした命令を数えるのに使う)
+        '''
+        pass
+
+    def analyze(self, head, branch):
+        entry = (self.memory[head:branch + 2],
+                 idioms.match(self, head, branch))
+        self.loops[(head, branch)] = entry
+        return entry
+
+
+# 名前 -> エンジン
+engines = {
+    'reference': PyComet2,
+    'cache': DecodeCacheComet2,
+    'idiom': IdiomComet2,
+}
+
+
+def add_engine_option(parser, default='reference', help='execution engine.'):
+    ''' OptionParser に、エンジンを選ぶ -e/--engine を加える '''
+    names = sorted(engines.keys())
+    parser.add_option('-e', '--engine', type='choice', choices=names,
+                      dest='engine', default=default,
+                      help='%s (%s)' % (help, ', '.join(names)))
+
+
+def add_run_options(parser):
+    ''' OptionParser に、run_file() が使う -i/--input, --max-steps を加える '''
+    parser.add_option('-i', '--input', type='string',
+                      dest='input', default=None,
+                      help='read input of IN from the file.')
+    parser.add_option('--max-steps', type='int',
+                      dest='max_steps', default=None,
+                      help='stop after executing N steps.')
+
+
+def run_file(engine, filename, options):
+    '''
+    filename のプログラムを engine のインスタンスに読み込み、
+    options.input の入力について forkserver.run_case() で実行する
+    止まった理由を標準エラー出力に表示し、(機械, 結果の辞書) を返す
+    '''
+    from forkserver import run_case
+    input_data = ''
+    if options.input is not None:
+        fp = open(options.input)
+        input_data = fp.read()
+        fp.close()
+    machine = engine()
+    load_program(machine, filename, True)
+    result = run_case(machine, input_data, options.max_steps)
+    print('%s: %s %s steps' % (options.engine, result['status'],
+                               result['steps']), file=sys.stderr)
+    if result['error']:
+        print(result['error'], file=sys.stderr)
+    return machine, result
@@ -0,0 +1,92 @@
+# ~*~ coding:utf-8 ~*~
+'''
+機械を止める例外と run_until() が止まった理由
+
+pycomet2.py をスクリプトとして実行したときも、他のモジュール
+(loopcheck.py など) が送出する例外と main() が捕まえる例外が
+同じクラスになるように、pycomet2.py とは別のモジュールに置く。
+'''
+
+
+class InvalidOperation(BaseException):
+    def __init__(self, address):
+        self.address = address
+
+    def __str__(self):
+        return 'Invalid operation is found at #%04x.' % self.address
+
+
+class MachineExit(BaseException):
+    def __init__(self, machine):
+        self.machine = machine
+
+
+class InputNeeded(BaseException):
+    '''
+    IN 命令の入力がまだ届いていない
+    主記憶やレジスタを変更する前に送出されるので、
+    入力が届いてから同じ命令を実行し直せばよい
+    '''
+    def __init__(self, address):
+        self.address = address
+
+    def __str__(self):
+        return 'Input is needed at #%04x.' % self.address
+
+
+class BudgetExceeded(BaseException):
+    '''
+    ステップ数または実行時間の上限に達した
+    (または終わらないループを検出した (loopcheck.py))
+    '''
+
+    STEPS = 'steps'
+    TIME = 'time'
+    LOOP = 'loop'
+
+    def __init__(self, machine, reason):
+        self.machine = machine
+        self.reason = reason
+        self.address = machine.PR
+
+    def __str__(self):
+        if self.reason == self.STEPS:
+            return 'Step limit is exceeded at #%04x.' % self.address
+        elif self.reason == self.LOOP:
+            return 'Non-terminating loop is found at #%04x.' % self.address
+        else:
+            return 'Time limit is exceeded at #%04x.' % self.address
+
+
+class StopReason(object):
+    '''
+    run_until() が止まった理由
+    reason は HALTED, BREAKPOINT, BUDGET, INVALID, INPUT, MISMATCH のどれか
+    (MISMATCH は出力先が channels.ExpectedOutput のときだけ)
+    address は止まったときの PR (INVALID なら不正な命令の番地),
+    steps はその時点の step_count,
+    error は止まる原因になった例外 (HALTED, BREAKPOINT では None)
+    '''
+
+    HALTED = 'halted'
+    BREAKPOINT = 'breakpoint'
+    BUDGET = 'budget'
+    INVALID = 'invalid'
+    INPUT = 'input'
+    MISMATCH = 'mismatch'
+
+    def __init__(self, machine, reason, error=None):
+        self.reason = reason
+        self.error = error
+        self.address = getattr(error, 'address', machine.PR)
+        self.steps = machine.step_count
+
+    def __repr__(self):
+        return '<StopReason %s at #%04x>' % (self.reason, self.address)
+
+    def __str__(self):
+        if self.error is not None:
+            return str(self.error)
+        if self.reason == self.HALTED:
+            return 'Halted at #%04x.' % self.address
+        return 'Break point at #%04x.' % self.address
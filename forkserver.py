@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+'''
+1つのプログラムを多数の入力で実行する fork サーバ
+
+  python forkserver.py [-j JOBS] [-o DIR] prog.com case1.in case2.in ...
+
+プログラムの読み込みとデコードキャッシュの準備は親プロセスで一度だけ行い、
+入力ごとに os.fork() した子プロセスで実行する。
+主記憶やインタプリタの状態は copy-on-write で共有されるので、
+入力1つあたりの起動はほぼ fork のコストだけで済む。
+'''
+from __future__ import print_function
+import sys
+import os
+import gc
+import select
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from optparse import OptionParser
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from errors import InvalidOperation, MachineExit, BudgetExceeded
+from channels import BufferOutput, ExpectedOutput, OutputMismatch
+from engines import engines, add_engine_option
+
+# 実行結果の status
+HALTED = 'halted'
+INVALID = 'invalid'
+STEPS = BudgetExceeded.STEPS
+TIME = BudgetExceeded.TIME
+LOOP = BudgetExceeded.LOOP
+# 出力が期待した出力と食い違った
+MISMATCH = 'mismatch'
+ERROR = 'error'
+# 子プロセスが結果を返さずに終了した
+CRASHED = 'crashed'
+
+
+def warm(machine):
+    ''' 読み込まれたプログラムの命令をデコードキャッシュに載せておく '''
+    if not hasattr(machine, 'predecode'):
+        return
+    from cfg import image_end
+    for adr in range(image_end(machine)):
+        try:
+            machine.predecode(adr)
+        except (InvalidOperation, IndexError):
+            pass
+
+
+def run_case(machine, input_data, max_steps=None, timeout=None,
+             expected=None):
+    '''
+    読み込み済みの machine で1つの入力について実行し、
+    結果の辞書 (status, error, steps, output) を返す
+    expected (期待した出力) を指定すると出力を1行ずつ照合し、
+    食い違ったらその時点で止めて status を MISMATCH にする
+    '''
+    m = machine
+    m.input = StringIO(input_data)
+    if expected is None:
+        m.output = BufferOutput()
+    else:
+        m.output = ExpectedOutput(expected, False)
+    result = {'status': HALTED, 'error': None}
+    try:
+        m.run(max_steps, timeout)
+    except MachineExit:
+        if expected is not None:
+            mismatch = m.output.finish()
+            if mismatch is not None:
+                result['status'] = MISMATCH
+                result['error'] = str(mismatch)
+    except OutputMismatch as e:
+        result['status'] = MISMATCH
+        result['error'] = str(e)
+    except InvalidOperation as e:
+        result['status'] = INVALID
+        result['error'] = str(e)
+    except BudgetExceeded as e:
+        result['status'] = e.reason
+    except Exception as e:
+        result['status'] = ERROR
+        result['error'] = repr(e)
+    result['steps'] = m.step_count
+    result['output'] = m.output.getvalue()
+    return result
+
+
+class ForkServer(object):
+    '''
+    読み込み済みの machine を fork して入力ごとに実行する
+    同時に実行する子プロセスは jobs 個まで
+    '''
+
+    def __init__(self, machine, jobs=None, max_steps=None, timeout=None):
+        self.machine = machine
+        self.jobs = jobs or cpu_count()
+        self.max_steps = max_steps
+        self.timeout = timeout
+
+    def run_case(self, input_data):
+        '''
+        現在のプロセスで1つの入力について実行し、結果の辞書を返す
+        input_data が (入力, 期待した出力) の組なら出力を照合する
+        '''
+        expected = None
+        if isinstance(input_data, tuple):
+            input_data, expected = input_data
+        return run_case(self.machine, input_data,
+                        self.max_steps, self.timeout, expected)
+
+    def spawn(self, input_data):
+        ''' 子プロセスで run_case() を実行し、(pid, 読み込み側の fd) を返す '''
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                os.close(r)
+                data = pickle.dumps(self.run_case(input_data), 2)
+                while data:
+                    n = os.write(w, data)
+                    data = data[n:]
+            except BaseException:
+                status = 1
+            os._exit(status)
+        os.close(w)
+        return pid, r
+
+    def imap(self, cases):
+        '''
+        cases の各入力について実行し、終わったものから
+        (番号, 結果) を返す
+        '''
+        # fork 後に参照カウントや GC が共有ページに書き込まないようにする
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        pending = iter(enumerate(cases))
+        running = {}
+        chunks = {}
+        try:
+            while True:
+                while len(running) < self.jobs:
+                    try:
+                        index, input_data = next(pending)
+                    except StopIteration:
+                        break
+                    pid, fd = self.spawn(input_data)
+                    running[fd] = (index, pid)
+                    chunks[fd] = []
+                if not running:
+                    break
+                readable, _, _ = select.select(list(running), [], [])
+                for fd in readable:
+                    chunk = os.read(fd, 65536)
+                    if chunk:
+                        chunks[fd].append(chunk)
+                        continue
+                    os.close(fd)
+                    index, pid = running.pop(fd)
+                    os.waitpid(pid, 0)
+                    data = b''.join(chunks.pop(fd))
+                    if data:
+                        result = pickle.loads(data)
+                    else:
+                        result = {'status': CRASHED, 'error': None,
+                                  'steps': None, 'output': ''}
+                    yield index, result
+        finally:
+            for fd, (index, pid) in running.items():
+                os.close(fd)
+                os.waitpid(pid, 0)
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
+
+    def map(self, cases):
+        ''' cases の各入力についての結果を、入力の順に並べたリストを返す '''
+        results = {}
+        for index, result in self.imap(cases):
+            results[index] = result
+        return [results[i] for i in sorted(results)]
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def main():
+    usage = 'usage: %prog [options] input.com|input.cas case.in ...'
+    parser = OptionParser(usage)
+    add_engine_option(parser, 'cache')
+    parser.add_option('-j', '--jobs', type='int',
+                      dest='jobs', default=None,
+                      help='run at most N cases at once. '
+                           '(default: number of CPUs)')
+    parser.add_option('--max-steps', type='int',
+                      dest='max_steps', default=None,
+                      help='stop each case after executing N steps.')
+    parser.add_option('--timeout', type='float',
+                      dest='timeout', default=None,
+                      help='stop each case after running for SEC seconds.')
+    parser.add_option('-L', '--detect-loops', action='store_true',
+                      dest='detect_loops', default=False,
+                      help='stop a case when it returns to the same state '
+                           'at a backward branch.')
+    parser.add_option('-x', '--expected-dir', type='string',
+                      dest='expected_dir', default=None,
+                      help='compare output of each case with DIR/CASE.out '
+                           'and stop the case at the first difference.')
+    parser.add_option('-o', '--output-dir', type='string',
+                      dest='output_dir', default=None,
+                      help='write output of each case to DIR/CASE.out.')
+    parser.add_option('-N', '--native', type='string', action='append',
+                      dest='natives', default=[],
+                      help='replace the subroutine NAME with the native '
+                           'routine of the same name. (ex. -N MULT)')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(2)
+
+    from verify import load_program
+    engine = engines[options.engine]
+    if options.detect_loops:
+        from loopcheck import detecting
+        engine = detecting(engine)
+    machine = engine()
+    symbols = load_program(machine, args[0])
+    if options.natives:
+        from natives import Natives, library
+        natives = Natives()
+        for name in options.natives:
+            natives.bind(name, library[name])
+        machine.natives = natives.resolve(symbols)
+    warm(machine)
+
+    cases = args[1:]
+    inputs = []
+    for filename in cases:
+        fp = open(filename)
+        input_data = fp.read()
+        fp.close()
+        if options.expected_dir:
+            base = os.path.splitext(os.path.basename(filename))[0]
+            fp = open(os.path.join(options.expected_dir, base + '.out'))
+            input_data = (input_data, fp.read())
+            fp.close()
+        inputs.append(input_data)
+
+    server = ForkServer(machine, options.jobs,
+                        options.max_steps, options.timeout)
+    failed = 0
+    for index, result in server.imap(inputs):
+        name = cases[index]
+        if result['status'] != HALTED:
+            failed += 1
+        if options.output_dir:
+            base = os.path.splitext(os.path.basename(name))[0]
+            fp = open(os.path.join(options.output_dir, base + '.out'), 'w')
+            fp.write(result['output'])
+            fp.close()
+        print('%-8s %10s steps  %s' % (result['status'], result['steps'],
+                                       name))
+        if result['error']:
+            print(result['error'], file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+# ~*~ coding:utf-8 ~*~
+'''
+シミュレータ自身の実行時間の内訳 (pycomet2.py --host-profile)
+
+  python pycomet2.py -r --host-profile prog.com
+  python hostprof.py [-e ENGINE] [-i case.in] prog.com|prog.cas
+
+プログラムではなく、シミュレータがどこで時間を使っているかを
+次の段階に分けて命令コードごとに計測する。
+
+  fetch     get_instruction (命令表の参照)
+  decode    引数の解釈 (argtypes.py)
+  execute   命令の本体 (flags と入出力を除く)
+  flags     instructions.flags
+  io        read_line / write_line
+  dispatch  step() の残り (instruction の PR・フラグの更新, キャッシュの照合)
+  idiom     ループの早送り (idiom エンジン)
+  loop      run() の残り (ブレークポイントの確認, 実行の予算)
+
+instrumented(engine) は、計時する命令に置き換えたサブクラスをクラスを
+作るときに組み立てる。命令の本体は flags だけを計時するものに差し替えた
+グローバル変数で複製するので、instructions.py には手を加えない。
+計測しないときはこのサブクラスを使わないので、通常の実行は変わらない。
+
+計時そのものにかかる時間は HostProfile を作るときに calibrate() で測り、
+計時した区間からはその内側の分を、外側の段階からは残りの分を差し引く。
+差し引いた後の時間は、計測しないで実行したときのおよその内訳になる。
+差し引きすぎて負になった段階・命令コードの時間は 0 にして、
+0 にした分は clamped として別に表示する。
+'''
+from __future__ import print_function
+import sys
+import time
+import types
+from functools import wraps
+
+from instructions import instruction
+
+if hasattr(time, 'perf_counter_ns'):
+    clock = time.perf_counter_ns
+else:
+    _timer = getattr(time, 'perf_counter', time.time)
+
+    def clock():
+        return int(_timer() * 1e9)
+
+# 命令コードごとに計測する段階
+PHASES = ('fetch', 'decode', 'execute', 'flags', 'io', 'dispatch', 'idiom')
+
+
+def timer_overhead(n=10000):
+    ''' clock() を1回呼ぶのにかかる時間 [ns] '''
+    t = clock()
+    for i in range(n):
+        clock()
+    return (clock() - t) // n
+
+
+def calibrate(n=20000, repeat=5):
+    '''
+    計時1回にかかる時間 [ns] を (区間の内側に入る分, 外側に残る分) で返す
+    中身のない関数を計時して、計時しないで呼んだときとの差を測る
+    '''
+    def nothing():
+        pass
+    inner = outer = None
+    for i in range(repeat):
+        p = HostProfile((0, 0))
+        timed = timed_flags(nothing, p)
+        t = clock()
+        for j in range(n):
+            nothing()
+        base = clock() - t
+        t = clock()
+        for j in range(n):
+            timed()
+        total = clock() - t - base
+        measured = sum(p.times['flags'])
+        if inner is None or total < inner + outer:
+            inner = measured // n
+            outer = max(0, total // n - inner)
+    return inner, outer
+
+
+class HostProfile(object):
+    '''
+    段階ごと・命令コードごとの時間 [ns]
+    計時した区間の合計を accounted に足していき、外側の区間は
+    内側で計時した分を差し引いた残りを自分の時間とする
+    overhead は calibrate() の値 (省略すると測る)
+    '''
+
+    def __init__(self, overhead=None):
+        if overhead is None:
+            overhead = calibrate()
+        # 計時1回で区間の内側に入る時間と外側に残る時間
+        self.inner, self.outer = overhead
+        # 段階 -> 命令コード -> 時間
+        self.times = dict((phase, [0] * 256) for phase in PHASES)
+        # 命令コード -> 実行回数 (早送りした分は含まない)
+        self.counts = [0] * 256
+        # 実行中の命令コード
+        self.opcode = 0
+        self.accounted = 0
+        self.steps = 0
+        self.loop = 0
+
+    def add(self, phase, elapsed, before):
+        '''
+        区間の時間から、内側で計時した時間と計時そのものの時間を除いて
+        phase に加える
+        '''
+        self.times[phase][self.opcode] += (elapsed - self.inner
+                                           - (self.accounted - before))
+        self.accounted = before + elapsed + self.outer
+
+    def clamped(self):
+        '''
+        負になった時間を 0 にした (段階 -> 命令コード -> 時間, loop の時間) と
+        0 にした分の合計 (計時の時間を差し引きすぎた分) を返す
+        '''
+        times = {}
+        residue = 0
+        for phase in PHASES:
+            times[phase] = [max(0, t) for t in self.times[phase]]
+            residue += sum(times[phase]) - sum(self.times[phase])
+        loop = max(0, self.loop)
+        residue += loop - self.loop
+        return times, loop, residue
+
+    def report(self, machine, fp=sys.stderr):
+        times, loop, residue = self.clamped()
+        phases = PHASES + ('loop',)
+        totals = dict((phase, sum(times[phase])) for phase in PHASES)
+        totals['loop'] = loop
+        total = sum(totals.values())
+        steps = self.steps or 1
+
+        def percent(t):
+            return 100.0 * t / total if total else 0.0
+
+        print('host profile: %d steps, %.1f ms, %d ns/step '
+              '(timer %d ns/call, %d ns/measurement subtracted)' % (
+                  self.steps, total / 1e6, total // steps,
+                  timer_overhead(), self.inner + self.outer), file=fp)
+        print('  ' + ', '.join('%s %.0f%%' % (phase, percent(totals[phase]))
+                               for phase in phases if totals[phase]), file=fp)
+        print('  phase          ms      %  ns/step', file=fp)
+        for phase in phases:
+            print('  %-8s  %8.1f  %5.1f  %7d' % (
+                phase, totals[phase] / 1e6, percent(totals[phase]),
+                totals[phase] // steps), file=fp)
+        if residue:
+            print('  (clamped %.1f ms subtracted beyond zero, not included '
+                  'above)' % (residue / 1e6), file=fp)
+
+        print('  opcode       count      %  ns/inst ' + ' '.join(
+            '%8s' % phase for phase in PHASES), file=fp)
+        rows = []
+        for opcode in range(256):
+            t = sum(times[phase][opcode] for phase in PHASES)
+            if t or self.counts[opcode]:
+                rows.append((t, opcode))
+        rows.sort(reverse=True)
+        for t, opcode in rows:
+            n = self.counts[opcode] or 1
+            inst = machine.inst_table.get(opcode)
+            name = inst.opname if inst is not None else '?'
+            print('  %02x %-5s %10d  %5.1f  %7d ' % (
+                opcode, name, self.counts[opcode], percent(t), t // n)
+                + ' '.join('%8d' % (times[phase][opcode] // n)
+                           for phase in PHASES), file=fp)
+
+
+def timed_argtype(argtype, opcode, profile):
+    ''' 引数の解釈を計時する argtype '''
+    @wraps(argtype)
+    def decode(machine, addr=None):
+        p = profile
+        p.opcode = opcode
+        before = p.accounted
+        t = clock()
+        try:
+            return argtype(machine, addr)
+        finally:
+            p.add('decode', clock() - t, before)
+    decode.size = argtype.size
+    return decode
+
+
+def timed_ir(ir, opcode, profile, flags):
+    ''' flags を差し替えて複製した命令の本体を計時する '''
+    g = dict(ir.__globals__)
+    g['flags'] = flags
+    body = types.FunctionType(ir.__code__, g, ir.__name__,
+                              ir.__defaults__, ir.__closure__)
+
+    @wraps(ir)
+    def execute(machine, *args):
+        p = profile
+        p.opcode = opcode
+        p.counts[opcode] += 1
+        before = p.accounted
+        t = clock()
+        try:
+            return body(machine, *args)
+        finally:
+            p.add('execute', clock() - t, before)
+    return execute
+
+
+def timed_flags(flags, profile):
+    @wraps(flags)
+    def timed(*args, **kwargs):
+        p = profile
+        before = p.accounted
+        t = clock()
+        try:
+            return flags(*args, **kwargs)
+        finally:
+            p.add('flags', clock() - t, before)
+    return timed
+
+
+def instrument(inst, profile):
+    ''' inst を、段階ごとに計時する命令にする '''
+    flags = inst.ir.__globals__.get('flags')
+    if flags is not None:
+        flags = timed_flags(flags, profile)
+    ir = timed_ir(inst.ir, inst.opcode, profile, flags)
+    argtype = timed_argtype(inst.argtype, inst.opcode, profile)
+    return instruction(inst.opcode, inst.opname, argtype)(ir)
+
+
+def instrumented(engine, profile=None):
+    '''
+    エンジン engine にシミュレータ自身の計時を加えたサブクラスを返す
+    計測結果はクラスの host_profile に溜まる
+    (他の記録 (stats.counted, cover.covered) と組み合わせるときは、
+    これを一番内側にすると命令の本体の flags も計時できる)
+    '''
+    profile = profile or HostProfile()
+
+    class InstrumentedEngine(engine):
+
+        host_profile = profile
+        inst_table = dict((code, instrument(inst, profile))
+                          for code, inst in engine.inst_table.items())
+
+        def get_instruction(self, adr=None):
+            p = self.host_profile
+            before = p.accounted
+            t = clock()
+            inst = engine.get_instruction(self, adr)
+            p.opcode = inst.opcode
+            p.add('fetch', clock() - t, before)
+            return inst
+
+        def step(self):
+            p = self.host_profile
+            count = self.step_count
+            before = p.accounted
+            t = clock()
+            try:
+                engine.step(self)
+            finally:
+                p.add('dispatch', clock() - t, before)
+                p.steps += self.step_count - count
+
+        def run(self, max_steps=None, timeout=None):
+            p = self.host_profile
+            before = p.accounted
+            t = clock()
+            try:
+                engine.run(self, max_steps, timeout)
+            finally:
+                elapsed = clock() - t
+                p.loop += elapsed - p.inner - (p.accounted - before)
+                p.accounted = before + elapsed + p.outer
+
+        def read_line(self):
+            p = self.host_profile
+            before = p.accounted
+            t = clock()
+            try:
+                return engine.read_line(self)
+            finally:
+                p.add('io', clock() - t, before)
+
+        def write_line(self, line):
+            p = self.host_profile
+            before = p.accounted
+            t = clock()
+            try:
+                engine.write_line(self, line)
+            finally:
+                p.add('io', clock() - t, before)
+
+        if hasattr(engine, 'jumped_back'):
+            def jumped_back(self, branch):
+                p = self.host_profile
+                opcode = p.opcode
+                before = p.accounted
+                t = clock()
+                try:
+                    engine.jumped_back(self, branch)
+                finally:
+                    # 早送りの時間は分岐命令のものとする
+                    p.opcode = opcode
+                    p.add('idiom', clock() - t, before)
+
+    InstrumentedEngine.__name__ = 'Instrumented' + engine.__name__
+    return InstrumentedEngine
+
+
+def main():
+    from optparse import OptionParser
+    from engines import engines, add_engine_option, add_run_options, \
+        run_file
+    usage = 'usage: %prog [options] input.com|input.cas'
+    parser = OptionParser(usage)
+    add_engine_option(parser)
+    add_run_options(parser)
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(2)
+
+    machine, result = run_file(instrumented(engines[options.engine]),
+                               args[0], options)
+    machine.host_profile.report(machine)
+
+
+if __name__ == '__main__':
+    main()
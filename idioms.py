@@ -0,0 +1,334 @@
+# ~*~ coding:utf-8 ~*~
+'''
+よく現れるループ (イディオム) を認識し、残りの繰り返しをまとめて実行する
+
+認識するループ (ループの先頭を HEAD とする)
+
+  主記憶の埋め尽くし      HEAD ST GRv, ADR, GRi / LAD GRi, ±1, GRi /
+                               CPA|CPL GRi, (GRn|ADR2) / Jcc HEAD
+  ブロック転送            HEAD LD GRt, SRC, GRi / ST GRt, DST, GRi /
+                               LAD GRi, ±1, GRi /
+                               CPA|CPL GRi, (GRn|ADR2) / Jcc HEAD
+  カウントダウン          HEAD ADDA|SUBA|ADDL|SUBL GRc, (ADR|GRk) / Jcc HEAD
+                          HEAD LAD GRc, d, GRc / LD GRc, GRc / Jcc HEAD
+
+どのループも、早送りした結果 (レジスタ, フラグ, 主記憶, PR, step_count) が
+1命令ずつ実行した場合と完全に一致する場合に限って早送りする。
+条件を満たさないものは match() が None を返し、通常どおり解釈実行される。
+'''
+from array import array
+
+from utils import l2a, a2l
+from errors import InvalidOperation
+from instructions import flags
+
+# 条件分岐命令が分岐する条件 (instructions.py の実装に合わせる)
+BRANCH = {
+    'JMI': lambda ZF, SF, OF: SF == 1,
+    'JNZ': lambda ZF, SF, OF: ZF == 0,
+    'JZE': lambda ZF, SF, OF: ZF == 1,
+    'JPL': lambda ZF, SF, OF: ZF == 0 and SF == 0,
+    'JOV': lambda ZF, SF, OF: OF == 0,
+}
+
+# 1回の早送りで調べる繰り返し回数の上限
+MAX_ITERATIONS = 0x10000
+
+
+def decode_loop(machine, head, branch):
+    ''' head から branch までの命令を (命令, 引数) のリストにする '''
+    body = []
+    addr = head
+    try:
+        while addr <= branch:
+            inst = machine.get_instruction(addr)
+            body.append((inst, inst.argtype(machine, addr)))
+            addr += inst.argtype.size
+    except (InvalidOperation, IndexError):
+        return None
+    if addr != branch + 2:
+        return None
+    return body
+
+
+def kind(inst):
+    ''' 命令名と引数の形 (例: 'CPA r1r2') '''
+    return inst.opname + ' ' + inst.argtype.__name__
+
+
+class Loop(object):
+    '''
+    認識したループ
+    iterate() は k 回目の繰り返しの終わりのフラグ (ZF, SF, OF) を返し、
+    check() は k 回分をまとめて実行してよいかを確かめ、
+    apply() は k 回分の結果を機械に反映する
+    '''
+
+    def __init__(self, head, branch, size, cond):
+        self.head = head
+        self.branch = branch
+        # 1回の繰り返しで実行する命令数
+        self.size = size
+        self.cond = cond
+
+    def run(self, machine, max_iterations):
+        '''
+        ループが終わるまで (最大 max_iterations 回) 早送りし、
+        早送りした繰り返しの回数を返す
+        途中で打ち切った場合は、PR はループの先頭のままになる
+        早送りできなければ 0 を返し、機械の状態は変更しない
+        '''
+        state = self.start(machine)
+        limit = min(max_iterations, MAX_ITERATIONS)
+        k = 0
+        last = None
+        done = False
+        while k < limit:
+            k += 1
+            last = self.iterate(state, k)
+            if not self.cond(*last):
+                done = True
+                break
+        if k == 0 or not self.check(machine, state, k):
+            return 0
+        self.apply(machine, state, k)
+        machine.ZF, machine.SF, machine.OF = last
+        if done:
+            machine.PR = self.branch + 2
+        machine.step_count += k * self.size
+        return k
+
+
+class Compare(object):
+    ''' ループの終了判定に使う CPA / CPL '''
+
+    def __init__(self, inst, args, i):
+        self.signed = inst.opname == 'CPA'
+        if inst.argtype.__name__ == 'r1r2':
+            r1, r2 = args
+            self.reg, self.adr = r2, None
+        else:
+            r1, adr, x = args
+            self.reg, self.adr = None, adr
+            if x != 0:
+                raise ValueError
+        if r1 != i or self.reg == i:
+            raise ValueError
+
+    def bound(self, machine):
+        if self.reg is not None:
+            return machine.GR[self.reg]
+        return machine.memory[self.adr]
+
+    def flags(self, value, bound):
+        if self.signed:
+            diff = l2a(value) - l2a(bound)
+        else:
+            diff = value - bound
+        return int(diff == 0), int(diff < 0), 0
+
+
+class IndexedLoop(Loop):
+    ''' 指標レジスタを ±1 ずつ動かしながら主記憶を書き換えるループ '''
+
+    def __init__(self, head, branch, size, cond, i, d, compare):
+        Loop.__init__(self, head, branch, size, cond)
+        self.i = i
+        self.d = d
+        self.compare = compare
+
+    def start(self, machine):
+        return {'i': machine.GR[self.i],
+                'bound': self.compare.bound(machine)}
+
+    def iterate(self, state, k):
+        value = (state['i'] + k * self.d) & 0xffff
+        return self.compare.flags(value, state['bound'])
+
+    def span(self, machine, adr, k):
+        ''' k 回の繰り返しで参照する番地の範囲 [lo, hi) (折り返すなら None) '''
+        first = (adr + machine.GR[self.i]) & 0xffff
+        last = first + (k - 1) * self.d
+        if not 0 <= last <= 0xffff:
+            return None
+        return min(first, last), max(first, last) + 1
+
+    def protected(self, machine, lo, hi):
+        ''' 書き込み先 [lo, hi) にループ自身や比較対象が含まれないか '''
+        if lo < self.branch + 2 and self.head < hi:
+            return False
+        adr = self.compare.adr
+        return adr is None or not lo <= adr < hi
+
+    def advance_index(self, machine, state, k):
+        machine.GR[self.i] = (state['i'] + k * self.d) & 0xffff
+
+
+class FillLoop(IndexedLoop):
+
+    def __init__(self, head, branch, size, cond, i, d, compare, v, adr):
+        IndexedLoop.__init__(self, head, branch, size, cond, i, d, compare)
+        self.v = v
+        self.adr = adr
+
+    def check(self, machine, state, k):
+        span = self.span(machine, self.adr, k)
+        if span is None:
+            return False
+        state['dst'] = span
+        return self.protected(machine, *span)
+
+    def apply(self, machine, state, k):
+        lo, hi = state['dst']
+        machine.memory[lo:hi] = array('H', [machine.GR[self.v]]) * (hi - lo)
+        self.advance_index(machine, state, k)
+
+
+class CopyLoop(IndexedLoop):
+
+    def __init__(self, head, branch, size, cond, i, d, compare, t, src, dst):
+        IndexedLoop.__init__(self, head, branch, size, cond, i, d, compare)
+        self.t = t
+        self.src = src
+        self.dst = dst
+
+    def check(self, machine, state, k):
+        src = self.span(machine, self.src, k)
+        dst = self.span(machine, self.dst, k)
+        if src is None or dst is None:
+            return False
+        if src[0] < dst[1] and dst[0] < src[1]:
+            return False
+        state['src'], state['dst'] = src, dst
+        return self.protected(machine, *dst)
+
+    def apply(self, machine, state, k):
+        (slo, shi), (dlo, dhi) = state['src'], state['dst']
+        last = (self.src + machine.GR[self.i] + (k - 1) * self.d) & 0xffff
+        machine.GR[self.t] = machine.memory[last]
+        machine.memory[dlo:dhi] = machine.memory[slo:shi]
+        self.advance_index(machine, state, k)
+
+
+class CountdownLoop(Loop):
+    ''' レジスタを一定量ずつ増減させるだけのループ '''
+
+    def __init__(self, head, branch, size, cond, c, step):
+        Loop.__init__(self, head, branch, size, cond)
+        self.c = c
+        # step(値, オペランド) -> (新しい値, フラグ)
+        self.step = step
+
+    def start(self, machine):
+        return {'c': machine.GR[self.c], 'operand': self.operand(machine)}
+
+    def iterate(self, state, k):
+        state['c'], result = self.step(state['c'], state['operand'])
+        return result
+
+    def check(self, machine, state, k):
+        return True
+
+    def apply(self, machine, state, k):
+        machine.GR[self.c] = state['c']
+
+
+class ArithmeticCountdown(CountdownLoop):
+
+    def __init__(self, head, branch, size, cond, inst, args):
+        r = args[0]
+        if inst.argtype.__name__ == 'r1r2':
+            self.reg, self.adr = args[1], None
+            if self.reg == r:
+                raise ValueError
+        else:
+            if args[2] != 0:
+                raise ValueError
+            self.reg, self.adr = None, args[1]
+        op = inst.opname
+
+        def step(c, v):
+            if op == 'ADDA':
+                result = l2a(c) + l2a(v)
+                return a2l(result), tuple(flags(result))
+            elif op == 'SUBA':
+                result = l2a(c) - l2a(v)
+                return a2l(result), tuple(flags(result))
+            elif op == 'ADDL':
+                result = c + v
+                return result & 0xffff, tuple(flags(result, logical=True))
+            else:
+                result = c - v
+                return result & 0xffff, tuple(flags(result, logical=True))
+        CountdownLoop.__init__(self, head, branch, size, cond, r, step)
+
+    def operand(self, machine):
+        if self.reg is not None:
+            return machine.GR[self.reg]
+        return machine.memory[self.adr]
+
+
+class LoadCountdown(CountdownLoop):
+    ''' LAD GRc, d, GRc / LD GRc, GRc '''
+
+    def __init__(self, head, branch, size, cond, c, d):
+        def step(c, d):
+            c = a2l(d + c)
+            return c, tuple(flags(c, OF=0))
+        CountdownLoop.__init__(self, head, branch, size, cond, c, step)
+        self.d = d
+
+    def operand(self, machine):
+        return self.d
+
+
+def match(machine, head, branch):
+    ''' head から branch までのループを認識して Loop を返す (無ければ None) '''
+    body = decode_loop(machine, head, branch)
+    if body is None:
+        return None
+    kinds = [kind(inst) for inst, args in body]
+    jinst, (jadr, jx) = body[-1]
+    if jinst.opname not in BRANCH or jadr != head or jx != 0:
+        return None
+    cond = BRANCH[jinst.opname]
+    size = len(body)
+    try:
+        if kinds[:-1] in (['ST radrx', 'LAD radrx', 'CPA r1r2'],
+                          ['ST radrx', 'LAD radrx', 'CPL r1r2'],
+                          ['ST radrx', 'LAD radrx', 'CPA radrx'],
+                          ['ST radrx', 'LAD radrx', 'CPL radrx']):
+            (v, adr, x), (i, d, i2), cmp = [a for _, a in body[:3]]
+            if x != i or i2 != i or i == 0 or v == i \
+                    or d not in (1, 0xffff):
+                return None
+            d = l2a(d)
+            compare = Compare(body[2][0], cmp, i)
+            return FillLoop(head, branch, size, cond, i, d, compare, v, adr)
+        if kinds[:-1] in (['LD radrx', 'ST radrx', 'LAD radrx', 'CPA r1r2'],
+                          ['LD radrx', 'ST radrx', 'LAD radrx', 'CPL r1r2'],
+                          ['LD radrx', 'ST radrx', 'LAD radrx', 'CPA radrx'],
+                          ['LD radrx', 'ST radrx', 'LAD radrx',
+                           'CPL radrx']):
+            (t, src, x1), (t2, dst, x2), (i, d, i2), cmp = \
+                [a for _, a in body[:4]]
+            if x1 != i or x2 != i or i2 != i or i == 0 or t2 != t \
+                    or t == i or d not in (1, 0xffff):
+                return None
+            d = l2a(d)
+            compare = Compare(body[3][0], cmp, i)
+            if compare.reg == t:
+                return None
+            return CopyLoop(head, branch, size, cond, i, d, compare,
+                            t, src, dst)
+        if len(body) == 2 and body[0][0].opname in ('ADDA', 'SUBA',
+                                                    'ADDL', 'SUBL'):
+            return ArithmeticCountdown(head, branch, size, cond, *body[0])
+        if kinds[:-1] == ['LAD radrx', 'LD r1r2']:
+            (c, d, c2), (c3, c4) = body[0][1], body[1][1]
+            if c2 != c or c3 != c or c4 != c or c == 0:
+                return None
+            return LoadCountdown(head, branch, size, cond, c, d)
+    except ValueError:
+        return None
+    return None
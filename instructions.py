@@ -1,6 +1,6 @@
 # ~*~ coding:utf-8 ~*~
 
-import sys
+from array import array
 from functools import wraps
 
 from utils import l2a, a2l, get_bit
@@ -29,7 +29,7 @@ def flags(result, logical=False, ZF=None, SF=None, OF=None):
             OF = (result < 0 or 0xffff < result)
         else:
             OF = (result < -32768 or 0x7fff < result)
-    return map(int, (ZF, SF, OF))
+    return [int(ZF), int(SF), int(OF)]
 
 
 class Jump(Exception):
@@ -56,6 +56,8 @@ def instruction(opcode, opname, argtype):
         __.opcode = opcode
         __.opname = opname
         __.argtype = argtype
+        # オペランドを解釈済みの引数で直接呼び出すための本体
+        __.ir = ir
         return __
     return _
 
@@ -314,20 +316,31 @@ def jov(machine, adr, x):
 
 @instruction(0x70, 'PUSH', adrx)
 def push(machine, adr, x):
-    machine.SP -= 1
-    machine.memory[machine.SP] = get_effective_address(machine, adr, x)
+    GR = machine.GR
+    sp = GR[8] - 1
+    GR[8] = sp
+    machine.memory[sp] = get_effective_address(machine, adr, x)
 
 
 @instruction(0x71, 'POP', r)
 def pop(machine, r):
-    machine.GR[r] = machine.memory[machine.SP]
-    machine.SP += 1
+    GR = machine.GR
+    # POP GR8 では取り出した値に 1 を足すので、書き込んだ後の GR[8] を読む
+    GR[r] = machine.memory[GR[8]]
+    GR[8] += 1
 
 
 @instruction(0x80, 'CALL', adrx)
 def call(machine, adr, x):
-    machine.SP -= 1
-    machine.memory[machine.SP] = machine.PR
+    if machine.natives:
+        target = get_effective_address(machine, adr, x)
+        # step_limit を超えるときは元のサブルーチンを実行する
+        if target in machine.natives and machine.natives[target](machine):
+            raise Jump(machine.PR + 2)
+    GR = machine.GR
+    sp = GR[8] - 1
+    GR[8] = sp
+    machine.memory[sp] = machine.PR
     machine.call_level += 1
     raise Jump(get_effective_address(machine, adr, x))
 
@@ -337,8 +350,10 @@ def ret(machine):
     if machine.call_level == 0:
         machine.step_count += 1
         machine.exit()
-    adr = machine.memory[machine.SP]
-    machine.SP += 1
+    GR = machine.GR
+    sp = GR[8]
+    adr = machine.memory[sp]
+    GR[8] = sp + 1
     machine.call_level -= 1
     raise Jump(adr + 2)
 
@@ -350,35 +365,43 @@ def svc(machine, adr, x):
 
 @instruction(0x90, 'IN', strlen)
 def in_(machine, s, l):
-    sys.stderr.write('-> ')
-    sys.stderr.flush()
-    line = sys.stdin.readline()
+    line = machine.read_line()
     line = line[:-1]
     if 256 < len(line):
         line = line[0:256]
     machine.memory[l] = len(line)
-    for i, ch in enumerate(line):
-        machine.memory[s + i] = ord(ch)
+    if s + len(line) <= len(machine.memory):
+        machine.memory[s:s + len(line)] = array('H', map(ord, line))
+    else:
+        for i, ch in enumerate(line):
+            machine.memory[s + i] = ord(ch)
 
 
 @instruction(0x91, 'OUT', strlen)
 def out(machine, s, l):
     length = machine.memory[l]
-    ch = ''
-    for i in range(s, s + length):
-        ch += chr(machine.memory[i])
-    print ch
+    if len(machine.memory) < s + length:
+        # スライスでは切り詰められてしまうので、主記憶の外を読むなら
+        # 1語ずつ読んでいたときと同じく IndexError にする
+        raise IndexError('OUT reads beyond the end of the memory.')
+    machine.write_line(''.join(map(chr, machine.memory[s:s + length])))
 
 
 @instruction(0xa0, 'RPUSH', noarg)
 def rpush(machine):
+    GR = machine.GR
+    memory = machine.memory
+    sp = GR[8]
     for i in range(1, 9):
-        machine.SP -= 1
-        machine.memory[machine.SP] = machine.GR[i]
+        sp -= 1
+        GR[8] = sp
+        memory[sp] = GR[i]
 
 
 @instruction(0xa1, 'RPOP', noarg)
 def rpop(machine):
-    for i in range(1, 9)[::-1]:
-        machine.GR[i] = machine.memory[machine.SP]
-        machine.SP += 1
+    GR = machine.GR
+    memory = machine.memory
+    for i in range(8, 0, -1):
+        GR[i] = memory[GR[8]]
+        GR[8] += 1
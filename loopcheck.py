@@ -0,0 +1,197 @@
+# ~*~ coding:utf-8 ~*~
+'''
+終わらないループの検出 (pycomet2.py --detect-loops)
+
+  python pycomet2.py -r --detect-loops prog.com
+
+後方への分岐のたびに、機械の状態 (PR, GR0〜GR8, フラグ, 呼び出しの深さ,
+主記憶) の指紋を取り、以前の状態とまったく同じ状態に戻っていれば、
+その先も同じことを繰り返すだけなので BudgetExceeded (LOOP) を送出して
+止める。
+
+主記憶の指紋には verify.HashedMemory を使い、書き込みのたびに
+ハッシュ値を更新するので、確認のたびに 65536 語を読む必要はない。
+比べる状態は Brent の方法で 1, 2, 4, 8, ... 回目の分岐のものだけを残し、
+指紋が一致したときは保存した主記憶とレジスタを照合するので誤検出はない。
+繰り返しの周期と、ループに入るまでの分岐の回数のおよそ2倍以内で検出する。
+
+IN 命令で入力を読むと、以後の実行は入力によって変わるので比較をやり直す。
+
+  python loopcheck.py [-e ENGINE] [--max-steps N] [prog.cas ...]
+
+は、検出を有効にしてプログラムを run_case() と run_until() の両方で実行し、
+止まった理由が期待したものかを確かめる。引数を省略すると tests/*.cas
+(どれも止まるはず) と tests/loopcheck/*.cas を確かめる。
+期待する理由は '; expect: loop' のような行で書く (無ければ halted)。
+prog.cas と同じ名前の prog.in があれば、それを入力として与える。
+'''
+from __future__ import print_function
+import sys
+import os
+import glob
+from array import array
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from errors import BudgetExceeded, StopReason
+from instructions import Jump, instruction
+from verify import HashedMemory
+
+# 後方へ分岐しうる命令
+BRANCHES = ('JMI', 'JNZ', 'JZE', 'JPL', 'JOV', 'JUMP', 'CALL', 'RET', 'SVC')
+
+
+def wrap(inst):
+    ''' 分岐命令 inst を、後方へ分岐するたびに状態を確かめる命令にする '''
+    ir = inst.ir
+
+    def branch(machine, *args):
+        try:
+            return ir(machine, *args)
+        except Jump as jump:
+            if jump.addr <= machine.PR:
+                machine.check_loop()
+            raise
+    return instruction(inst.opcode, inst.opname, inst.argtype)(branch)
+
+
+def detecting(engine):
+    ''' エンジン engine に終わらないループの検出を加えたサブクラスを返す '''
+
+    class DetectingEngine(engine):
+
+        inst_table = dict((code, wrap(inst) if inst.opname in BRANCHES
+                           else inst)
+                          for code, inst in engine.inst_table.items())
+
+        def initialize(self):
+            engine.initialize(self)
+            self.memory = HashedMemory(self.memory)
+            self.reset_loop()
+
+        def reset_loop(self):
+            # (指紋, 主記憶, レジスタ, 呼び出しの深さ) または None
+            self.loop_saved = None
+            self.loop_count = 0
+            self.loop_power = 1
+
+        def check_loop(self):
+            ''' 保存した状態に戻っていれば BudgetExceeded を送出する '''
+            GR = self.GR
+            key = hash((self.PR, self.OF, self.SF, self.ZF, self.call_level,
+                        self.memory.digest, GR[0], GR[1], GR[2], GR[3],
+                        GR[4], GR[5], GR[6], GR[7], GR[8]))
+            saved = self.loop_saved
+            if (saved is not None and saved[0] == key
+                    and saved[3] == self.call_level
+                    and saved[2] == self.save_registers()
+                    and saved[1] == self.memory):
+                raise BudgetExceeded(self, BudgetExceeded.LOOP)
+            self.loop_count += 1
+            if self.loop_count == self.loop_power:
+                self.loop_saved = (key, array('H', self.memory),
+                                   self.save_registers(), self.call_level)
+                self.loop_power *= 2
+                self.loop_count = 0
+
+        def read_line(self):
+            line = engine.read_line(self)
+            self.reset_loop()
+            return line
+
+    DetectingEngine.__name__ = 'Detecting' + engine.__name__
+    return DetectingEngine
+
+
+def expected_status(filename):
+    ''' ファイルの '; expect: STATUS' の行の STATUS (無ければ halted) '''
+    fp = open(filename)
+    try:
+        for line in fp:
+            line = line.lstrip(';').strip()
+            if line.startswith('expect:'):
+                return line.split(':', 1)[1].strip()
+    finally:
+        fp.close()
+    return 'halted'
+
+
+def check(filename, engine, max_steps=1000000, slice_steps=1000):
+    '''
+    filename を検出を有効にした engine で実行し、止まった理由を
+    (run_case() の status, run_until() を slice_steps ずつ呼んだときの status)
+    で返す (status は forkserver.run_case() のもの)
+    '''
+    from forkserver import run_case
+    from channels import BufferOutput
+    from pycomet2 import load_program
+    input_data = ''
+    infile = os.path.splitext(filename)[0] + '.in'
+    if os.path.exists(infile):
+        fp = open(infile)
+        input_data = fp.read()
+        fp.close()
+    machine = detecting(engine)()
+    load_program(machine, filename, True)
+    case = run_case(machine, input_data, max_steps)['status']
+
+    machine = detecting(engine)()
+    load_program(machine, filename, True)
+    machine.input = StringIO(input_data)
+    machine.output = BufferOutput()
+    while True:
+        if max_steps <= machine.step_count:
+            status = BudgetExceeded.STEPS
+            break
+        stop = machine.run_until(min(slice_steps,
+                                     max_steps - machine.step_count))
+        if stop.reason == StopReason.BUDGET:
+            if stop.error.reason == BudgetExceeded.STEPS:
+                # 1回分の上限に達しただけなので続きから実行する
+                continue
+            status = stop.error.reason
+        else:
+            status = stop.reason
+        break
+    return case, status
+
+
+def main():
+    from optparse import OptionParser
+    from engines import engines, add_engine_option
+    usage = 'usage: %prog [options] [input.cas|input.com ...]'
+    parser = OptionParser(usage)
+    add_engine_option(parser)
+    parser.add_option('--max-steps', type='int',
+                      dest='max_steps', default=1000000,
+                      help='stop after executing N steps. (default: %default)')
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        tests = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'tests')
+        args = (sorted(glob.glob(os.path.join(tests, '*.cas')))
+                + sorted(glob.glob(os.path.join(tests, 'loopcheck', '*.cas'))))
+
+    failed = 0
+    for filename in args:
+        expected = expected_status(filename)
+        try:
+            statuses = check(filename, engines[options.engine],
+                             options.max_steps)
+        except SystemExit:
+            # アセンブルできないプログラムは対象外
+            print('skipped %s' % filename, file=sys.stderr)
+            continue
+        if statuses == (expected, expected):
+            print('ok      %s (%s)' % (filename, expected), file=sys.stderr)
+        else:
+            failed += 1
+            print('FAILED  %s (expected %s, run_case %s, run_until %s)'
+                  % ((filename, expected) + statuses), file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# ~*~ coding:utf-8 ~*~
+'''
+CALL 先のサブルーチンを Python で実装したもの (ネイティブルーチン) に置き換える
+
+    natives = Natives()
+    natives.bind('MULT', mult)           # シンボル名で指定
+    natives.bind(0x0012, mult)           # 番地で指定
+    machine.natives = natives.resolve(casl2.symbols)
+
+ネイティブルーチンは func(machine) の形の関数で、
+CALL 直後から RET 直前までの処理 (GR, 主記憶, フラグの変更) を行い、
+元のサブルーチンを実行した場合のステップ数 (CALL, RET を含む) を返す。
+戻り番地は CALL と同じく SP - 1 番地に書き込まれ、SP は変化しない。
+
+ステップ数の上限 (machine.step_limit) があるときは、そのステップ数を
+実行前に求める関数 (func.steps または bind() の steps) で上限を超えないか
+確かめ、超えるなら元のサブルーチンを CALL で実行する。
+ステップ数を求める関数がなければ、上限があるときは常に元のサブルーチンを
+実行する。
+'''
+from instructions import flags
+
+
+class NativeRoutine(object):
+    ''' 番地に結び付けたネイティブルーチン '''
+
+    def __init__(self, func, count_steps=True, steps=None):
+        self.func = func
+        # True なら元のサブルーチンと同じだけ step_count を進める
+        self.count_steps = count_steps
+        # 実行前にステップ数を求める関数 steps(machine)
+        self.steps = steps or getattr(func, 'steps', None)
+
+    def __call__(self, machine):
+        '''
+        ネイティブルーチンを実行して True を返す
+        step_limit を超えてしまうなら何もせずに False を返す
+        '''
+        if self.count_steps and machine.step_limit is not None:
+            if self.steps is None or (machine.step_limit <
+                                      machine.step_count
+                                      + self.steps(machine)):
+                return False
+        machine.memory[(machine.SP - 1) & 0xffff] = machine.PR
+        steps = self.func(machine)
+        if self.count_steps and steps is not None:
+            # CALL 自体の1ステップは step() で数えられる
+            machine.step_count += steps - 1
+        return True
+
+
+class Natives(object):
+    ''' シンボル名または番地 -> ネイティブルーチンの登録簿 '''
+
+    def __init__(self):
+        self.routines = {}
+
+    def bind(self, target, func, count_steps=True, steps=None):
+        self.routines[target] = NativeRoutine(func, count_steps, steps)
+
+    def resolve(self, symbols=None):
+        '''
+        番地 -> ネイティブルーチン の辞書を返す
+        symbols は CASL2.symbols または シンボル名 -> 番地 の辞書
+        '''
+        addrs = {}
+        for name, value in (symbols or {}).items():
+            addr = getattr(value, 'addr', value)
+            addrs[name] = addr
+            addrs.setdefault(name.split('.')[-1], addr)
+        table = {}
+        for target, routine in self.routines.items():
+            if not isinstance(target, str):
+                table[target] = routine
+            elif target in addrs:
+                table[addrs[target]] = routine
+            else:
+                raise KeyError('Undefined symbol "%s".' % target)
+        return table
+
+
+def mult(machine):
+    '''
+    benchmarks/mult.cas の MULT と同じ規約のシフト加算乗算
+    GR0 <- GR1 * GR2 (下位 16 ビット), GR3 は破壊される
+    '''
+    m = machine
+    a, b = m.GR[1], m.GR[2]
+    sp = m.SP
+    m.memory[(sp - 2) & 0xffff] = a
+    m.memory[(sp - 3) & 0xffff] = b
+    m.GR[0] = (a * b) & 0xffff
+    if b:
+        m.GR[3] = 1
+    # 最後に実行される LD GR2, GR2 (GR2 = 0) によるフラグ
+    m.ZF, m.SF, m.OF = flags(0, OF=0)
+    return mult_steps(m)
+
+
+def mult_steps(machine):
+    ''' MULT のステップ数 (GR2 のビット数と 1 のビットの数で決まる) '''
+    b = machine.GR[2]
+    bits = 0
+    while b >> bits:
+        bits += 1
+    # CALL, PUSH x2, LAD, ループ, LD, JZE, POP x2, RET
+    return 9 + 8 * bits + bin(b).count('1')
+
+
+mult.steps = mult_steps
+
+
+# 名前で指定できるネイティブルーチン
+library = {
+    'MULT': mult,
+}
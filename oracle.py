@@ -0,0 +1,131 @@
+# ~*~ coding:utf-8 ~*~
+'''
+採点用に、機械の状態と期待値を numpy でまとめて比較する
+'''
+import numpy
+
+from utils import l2a
+
+
+# 比較対象とする汎用レジスタ (GR_view でまとめて比較する) とその他のレジスタ
+GR_NAMES = tuple('GR%d' % i for i in range(9))
+REGISTERS = ('PR', 'SP', 'OF', 'SF', 'ZF')
+
+
+def as_words(x):
+    ''' PyComet2 / array('H') / シーケンスを uint16 の配列にする '''
+    if hasattr(x, 'memory_view'):
+        return x.memory_view
+    if isinstance(x, numpy.ndarray):
+        return x
+    try:
+        return numpy.frombuffer(x, dtype=numpy.uint16)
+    except (TypeError, ValueError, AttributeError):
+        return numpy.asarray(x, dtype=numpy.uint16)
+
+
+def address_ranges(addrs):
+    '''
+    アドレスの列を連続する区間ごとにまとめ、
+    (開始, 終了) のリストで返す (終了番地は含まない)
+    '''
+    addrs = numpy.unique(numpy.asarray(addrs, dtype=numpy.int64))
+    if len(addrs) == 0:
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(addrs) != 1) + 1
+    starts = addrs[numpy.concatenate(([0], breaks))]
+    ends = addrs[numpy.concatenate((breaks - 1, [len(addrs) - 1]))] + 1
+    return [(int(s), int(e)) for s, e in zip(starts, ends)]
+
+
+def mismatch_ranges(a, b, base=0):
+    ''' 2つの配列が異なる区間を返す '''
+    a, b = as_words(a), as_words(b)
+    return address_ranges(numpy.flatnonzero(a != b) + base)
+
+
+def compare_regions(memory, regions):
+    '''
+    複数の期待値領域をまとめて比較し、一致しない区間を返す
+    regions は {開始番地: 値の列} または (開始番地, 値の列) のリスト
+    '''
+    if hasattr(regions, 'items'):
+        regions = regions.items()
+    addrs, values = [], []
+    for start, expected in regions:
+        expected = numpy.asarray(expected, dtype=numpy.int64) & 0xffff
+        addrs.append(numpy.arange(start, start + len(expected)))
+        values.append(expected)
+    if not addrs:
+        return []
+    addrs = numpy.concatenate(addrs)
+    values = numpy.concatenate(values)
+    if len(addrs) and (addrs.min() < 0 or 0xffff < addrs.max()):
+        raise ValueError('Region is out of memory.')
+    actual = as_words(memory)[addrs]
+    return address_ranges(addrs[actual != values])
+
+
+def compare_registers(machine, expected):
+    '''
+    {'GR1': 3, 'PR': 0x10, 'ZF': 1, ...} の形の期待値と比較し、
+    一致しないレジスタ名のリストを返す
+    '''
+    names = sorted(expected.keys())
+    for n in names:
+        if n not in GR_NAMES and n not in REGISTERS:
+            raise ValueError('Unknown register %s (expected one of GR0-GR8, '
+                             '%s).' % (n, ', '.join(REGISTERS)))
+    gr = [n for n in names if n in GR_NAMES]
+    mismatches = []
+    if gr:
+        index = numpy.array([int(n[2:]) for n in gr])
+        want = numpy.array([expected[n] & 0xffff for n in gr])
+        got = machine.GR_view[index]
+        mismatches.extend(gr[i] for i in numpy.flatnonzero(got != want))
+    for n in names:
+        if n in gr:
+            continue
+        if getattr(machine, n) != expected[n] & 0xffff:
+            mismatches.append(n)
+    return mismatches
+
+
+class StateDiff(object):
+    ''' 2つの機械の状態の差分 '''
+
+    def __init__(self, registers, memory):
+        # (レジスタ名, aの値, bの値) のリスト
+        self.registers = registers
+        # 一致しない主記憶の区間 (開始, 終了) のリスト
+        self.memory = memory
+
+    def __nonzero__(self):
+        return bool(self.registers or self.memory)
+
+    __bool__ = __nonzero__
+
+    def __str__(self):
+        st = []
+        for name, a, b in self.registers:
+            st.append('%-4s #%04x(%6d) != #%04x(%6d)'
+                      % (name, a, l2a(a), b, l2a(b)))
+        for start, end in self.memory:
+            if end - start == 1:
+                st.append('#%04x' % start)
+            else:
+                st.append('#%04x-#%04x' % (start, end - 1))
+        return '\n'.join(st)
+
+
+def diff_states(a, b):
+    ''' 2つの機械の GR, PR, SP, フラグ, 主記憶を比較する '''
+    registers = []
+    ga, gb = a.GR_view, b.GR_view
+    for i in numpy.flatnonzero(ga[:8] != gb[:8]):
+        registers.append(('GR%d' % i, int(ga[i]), int(gb[i])))
+    for name in REGISTERS:
+        va, vb = getattr(a, name), getattr(b, name)
+        if va != vb:
+            registers.append((name, va, vb))
+    return StateDiff(registers, mismatch_ranges(a, b))
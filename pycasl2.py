@@ -23,15 +23,11 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 '''
 
-import warnings
-warnings.simplefilter('ignore', DeprecationWarning)
-
+from __future__ import print_function
 import sys, os, string, array, re
-from optparse import OptionParser, OptionValueError
-from sets import Set
 
 
-op_tokens = Set(['NOP', 'LD', 'ST', 'LAD', 'ADDA', 'SUBA', 'ADDL', 'SUBL',
+op_tokens = set(['NOP', 'LD', 'ST', 'LAD', 'ADDA', 'SUBA', 'ADDL', 'SUBL',
               'AND', 'OR','XOR', 'CPA', 'CPL', 'SLA', 'SRA', 'SLL', 'SRL',
               'JMI', 'JNZ', 'JZE', 'JUMP', 'JPL', 'JOV', 'PUSH', 'POP',
               'CALL', 'RET', 'SVC', 'START', 'END', 'DC', 'DS',
@@ -183,7 +179,7 @@ class CASL2:
             self.message = message
 
         def report(self):
-            print >> sys.stderr, "Error: %s\nLine %d: %s" % (self.message, self.line_num, self.src)
+            print("Error: %s\nLine %d: %s" % (self.message, self.line_num, self.src), file=sys.stderr)
 
 
     def __init__(self, filename=""):
@@ -201,12 +197,12 @@ class CASL2:
 
     def dump(self, a_code):
         addr = 0
-        print 'Addr\tOp\t\tLine\tSource code'
+        print('Addr\tOp\t\tLine\tSource code')
         for c in a_code:
             if c.code != []:
                 if c.code[0] == 0x4341:
                     continue
-            print c
+            print(c)
 ##             print '%04x\t%04x\t\t%d\t%s' % (c.addr, c.code[0], c.line_number, c.src)
 ##             if 1 < len(c.code):
 ##                 print '%04x\t%04x' % (c.addr+1, c.code[1])
@@ -214,17 +210,20 @@ class CASL2:
 ##                 print '%04x\t%04x' % (c.addr+2, c.code[2])
 ##             addr += len(c.code)
 
-        print '\nDefined labels'
-        labels = self.symbols.values()
-        labels.sort(lambda x, y: cmp(x.lines, y.lines))
+        print('\nDefined labels')
+        labels = sorted(self.symbols.values(), key=lambda x: x.lines)
         for i in labels:
-            print i
+            print(i)
 
     def assemble(self, filename):
         self.filename = filename
         self.addr = 0
 
-        self.fp = file(filename, 'r')
+        if sys.version_info[0] < 3:
+            self.fp = open(filename, 'r')
+        else:
+            # Python 2 と同じくバイト単位で読み、同じ .com を生成する
+            self.fp = open(filename, 'r', encoding='latin-1', newline='')
         self.current_line_number = -1
         self.next_line = self.Instruction(None, "", None, -1, "")
         self.next_src = ""
@@ -233,7 +232,7 @@ class CASL2:
         try:
             self.get_line()
             self.is_valid_program()
-        except self.Error, e:
+        except self.Error as e:
             e.report()
             sys.exit()
 
@@ -246,7 +245,7 @@ class CASL2:
         # ラベルをアドレスに置換。
         try:
             code_list = [self.replace_label(code) for code in self.tmp_code if code != None]
-        except self.Error, e:
+        except self.Error as e:
             e.report()
             sys.exit()
 
@@ -376,7 +375,7 @@ class CASL2:
                 #
                 # スコープ内にないときは、スコープ名なしのラベルを探す
                 elif global_name in self.symbols.keys():
-                    if self.symbols[global_name].goto is '':
+                    if self.symbols[global_name].goto == '':
                         return self.symbols[global_name].addr
                     # サブルーチンの実行開始番地が指定されていた場合、gotoに書かれているラベルの番地にする
                     else:
@@ -417,8 +416,8 @@ class CASL2:
         result = re.match(pattern, line)
 
         if result == None:
-            print >> sys.stderr, 'Line %d: Invalid line was found.' % line_number
-            print >> sys.stderr,  line
+            print('Line %d: Invalid line was found.' % line_number, file=sys.stderr)
+            print(line, file=sys.stderr)
             sys.exit()
 
 ##        print result.group('label'), result.group('op'), result.group('arg1'), result.group('arg2'), result.group('arg3')
@@ -439,7 +438,7 @@ class CASL2:
         if inst.label != None:
             label_name = self.current_scope + '.' + inst.label
             if label_name in self.symbols.keys():
-                print >> sys.stderr, 'Line %d: Label "%s" is already defined.' % (inst.line_number, inst.label)
+                print('Line %d: Label "%s" is already defined.' % (inst.line_number, inst.label), file=sys.stderr)
                 sys.exit()
             #
             self.symbols[label_name] = self.Label(label_name, inst.line_number, self.filename, self.addr)
@@ -580,7 +579,7 @@ class CASL2:
             #
             if op_table[inst.op][0] == -100:
                 if inst.label == None:
-                    print >> sys.stderr, 'Line %d: Label should be defined for START.' % inst.line_number
+                    print('Line %d: Label should be defined for START.' % inst.line_number, file=sys.stderr)
                     sys.exit()
                 self.current_scope = inst.label
                 if self.start_found:
@@ -602,7 +601,7 @@ class CASL2:
 
             return bcode
         except KeyError:
-            print >> sys.stderr, 'Line %d: Invalid instruction "%s" was found.' % (inst.line_number, inst.op)
+            print('Line %d: Invalid instruction "%s" was found.' % (inst.line_number, inst.op), file=sys.stderr)
             sys.exit()
 
     def is_arg_register(self, arg):
@@ -618,10 +617,13 @@ class CASL2:
                 codelist.append(i)
         obj = array.array('H', codelist)
         obj.byteswap()
-        obj.tofile(file(filename, 'wb'))
+        fp = open(filename, 'wb')
+        obj.tofile(fp)
+        fp.close()
 
 
 def main():
+    from optparse import OptionParser
     usage = '%prog [options] input.cas [output.com]'
     parser = OptionParser(usage)
     parser.add_option('-a', None, action='store_true', dest='dump', default=False, help='turn on verbose listings')
@@ -629,10 +631,10 @@ def main():
     options, args = parser.parse_args()
 
     if options.version:
-        print 'PyCASL2 version 1.1.4'
-        print '$Revision: 42606859abf2 $'
-        print 'Copyright (c) 2009,2011, Masahiko Nakamoto.'
-        print 'All rights reserved.'
+        print('PyCASL2 version 1.1.4')
+        print('$Revision: 42606859abf2 $')
+        print('Copyright (c) 2009,2011, Masahiko Nakamoto.')
+        print('All rights reserved.')
         sys.exit()
 
     if len(args) < 1:
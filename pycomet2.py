@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
+from __future__ import print_function
 import sys
+import time
 import string
 import array
-import logging
-from optparse import OptionParser
-from types import MethodType
 
 from utils import l2a, i2bin
+from channels import StdinInput, open_input, open_output, \
+    ExpectedOutput, OutputMismatch
+from errors import InvalidOperation, MachineExit, InputNeeded, \
+    BudgetExceeded, StopReason
 from instructions import (nop, ld2, st, lad, ld1,
                           adda2, suba2, addl2, subl2,
                           adda1, suba1, addl1, subl1,
@@ -17,6 +20,24 @@ from instructions import (nop, ld2, st, lad, ld1,
                           push, pop, call, ret, svc,
                           in_, out, rpush, rpop)
 
+try:
+    input_line = raw_input
+except NameError:
+    input_line = input
+
+# 命令の一覧と、命令コード -> 命令 の表
+# (インスタンスごとに束縛メソッドを作らず、step() で機械を渡して呼び出す)
+inst_list = [nop, ld2, st, lad, ld1,
+             adda2, suba2, addl2, subl2,
+             adda1, suba1, addl1, subl1,
+             and2, or2, xor2, and1, or1, xor1,
+             cpa2, cpl2, cpa1, cpl1,
+             sla, sra, sll, srl,
+             jmi, jnz, jze, jump, jpl, jov,
+             push, pop, call, ret, svc,
+             in_, out, rpush, rpop]
+inst_table = dict((ir.opcode, ir) for ir in inst_list)
+
 
 class Disassembler(object):
 
@@ -24,7 +45,7 @@ class Disassembler(object):
         self.m = machine
 
     def disassemble(self, addr, num=16):
-        for i in xrange(num):
+        for i in range(num):
             try:
                 inst = self.m.get_instruction(addr)
                 yield addr, self.dis_inst(addr)
@@ -72,22 +93,35 @@ class Disassembler(object):
 class StatusMonitor:
     def __init__(self, machine):
         self.m = machine
+        # (書式, 値を取り出す式) のリスト
         self.vars = []
         self.watch('%04d: ', 'step_count')
         self.decimalFlag = False
+        self.format = None
+        self.values = None
 
     def __str__(self):
-        return ' '.join([v() for v in self.vars])
+        return self.compile()(self.m)
 
     def watch(self, fmt, attr, index=None):
-        def _():
-            if index is None:
-                return fmt % getattr(self.m, attr)
-            else:
-                return fmt % getattr(self.m, attr)[index]
-        _.__name__ = 'watcher_' + attr
-        if index is not None: _.__name__ += '[' + str(index) + ']'
-        self.vars.append(_)
+        expr = 'm.' + attr
+        if index is not None:
+            expr += '[%d]' % index
+        self.vars.append((fmt, expr))
+        self.format = None
+
+    def compile(self):
+        '''
+        監視対象をまとめて1回の % で整形する関数 format(machine) と、
+        ステップ数以外の値の組を返す関数 values(machine) を作る
+        '''
+        if self.format is None:
+            fmt = ' '.join(f for f, expr in self.vars)
+            exprs = ''.join(expr + ', ' for f, expr in self.vars)
+            self.format = eval('lambda m: %r %% (%s)' % (fmt, exprs), {})
+            exprs = ''.join(expr + ', ' for f, expr in self.vars[1:])
+            self.values = eval('lambda m: (%s)' % exprs, {})
+        return self.format
 
     def append(self, s):
         try:
@@ -96,64 +130,147 @@ class StatusMonitor:
             elif s == 'SF': self.watch("SF=#%01d", 'SF')
             elif s == 'ZF': self.watch("ZF=#%01d", 'ZF')
             elif s[0:2] == 'GR':
-                reg = int(s[2])
+                reg = int(s[2:])
                 if reg < 0 or 8 < reg:
-                    raise
+                    raise ValueError(s)
                 if self.decimalFlag:
                     self.watch("GR" + str(reg) + "=#%d", 'GR', reg)
                 else:
                     self.watch("GR" + str(reg) + "=#%04x", 'GR', reg)
             else:
-                adr = self.m.cast_int(s)
+                adr = self.m.cast_address(s)
                 if adr < 0 or 0xffff < adr:
-                    raise
+                    raise ValueError(s)
                 if self.decimalFlag:
                     self.watch("#%04x" % adr + "=%d", 'memory', adr)
                 else:
                     self.watch("#%04x" % adr + "=%04x", 'memory', adr)
         except ValueError:
-            print >> sys.stderr, ("Warning: Invalid monitor "
-                                  "target is found."
-                                  " %s is ignored." % s)
-
-
-class InvalidOperation(BaseException):
-    def __init__(self, address):
-        self.address = address
+            print("Warning: Invalid monitor "
+                  "target is found."
+                  " %s is ignored." % s, file=sys.stderr)
+
+
+def compile_condition(text, symbols=None):
+    '''
+    ブレークポイントの条件式を、機械を受け取って真偽を返す関数にする
+    使えるもの: GR0〜GR8, SP, PR, OF, SF, ZF, 数値 (10進, #16進),
+    ラベル, [番地] (主記憶の値), 比較演算子, + - & |, and or not, 括弧
+    値はすべて符号なしとして扱う
+    '''
+    import re
+    token = re.compile(r'\s*(?:(#[0-9A-Fa-f]+)|(\d+)|([A-Za-z_]\w*)'
+                       r'|(==|!=|<=|>=|<|>|[-+&|()\[\]]))')
+    words = {'SP': 'm.GR[8]', 'PR': 'm.PR',
+             'OF': 'm.OF', 'SF': 'm.SF', 'ZF': 'm.ZF',
+             'and': 'and', 'or': 'or', 'not': 'not'}
+    for i in range(9):
+        words['GR%d' % i] = 'm.GR[%d]' % i
+    code = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = token.match(text, pos)
+        if match is None:
+            raise ValueError('Invalid condition: %s' % text[pos:])
+        pos = match.end()
+        hexnum, num, word, op = match.groups()
+        if hexnum is not None:
+            code.append(str(int(hexnum[1:], 16)))
+        elif num is not None:
+            code.append(str(int(num)))
+        elif word in words:
+            code.append(words[word])
+        elif word is not None:
+            if symbols is None or word not in symbols:
+                raise ValueError('Undefined label "%s".' % word)
+            code.append(str(symbols[word]))
+        elif op == '[':
+            code.append('m.memory[(')
+        elif op == ']':
+            code.append(') & 0xffff]')
+        else:
+            code.append(op)
+    try:
+        return eval(compile('lambda m: bool(%s)' % ' '.join(code),
+                            '<breakpoint>', 'eval'), {})
+    except SyntaxError:
+        raise ValueError('Invalid condition: %s' % text)
+
+
+class BreakPoint(object):
+    '''
+    ブレークポイント
+    PR がこの番地に来たときだけ呼ばれ、停止するなら True を返す
+    条件を満たした回数 (hits) が after を超えてから停止する
+    '''
+
+    def __init__(self, addr, condition=None, after=0, symbols=None):
+        self.addr = addr
+        self.condition = condition
+        self.after = after
+        self.hits = 0
+        self.test = None
+        if condition is not None:
+            self.test = compile_condition(condition, symbols)
+
+    def __call__(self, machine):
+        if self.test is not None and not self.test(machine):
+            return False
+        self.hits += 1
+        return self.after < self.hits
 
     def __str__(self):
-        return 'Invalid operation is found at #%04x.' % self.address
-
-
-class MachineExit(BaseException):
-    def __init__(self, machine):
-        self.machine = machine
+        s = '#%04x' % self.addr
+        if self.condition is not None:
+            s += ' if ' + self.condition
+        if self.after:
+            s += ' after %d hits' % self.after
+        if self.condition is not None or self.after:
+            s += ' (%d hits)' % self.hits
+        return s
 
 
 class PyComet2(object):
 
+    # 機械の状態はインスタンス辞書ではなくスロットに置く
+    # (サブクラスや利用側が属性を追加できるように __dict__ も残す)
+    __slots__ = ('memory', 'GR', 'PR', 'OF', 'SF', 'ZF',
+                 'call_level', 'step_count', 'step_limit',
+                 'break_points', 'symbols', 'natives', 'input', 'output',
+                 'image_end', 'halted', 'last_stop', 'stop_at',
+                 'is_auto_dump', 'is_count_step', 'monitor', 'dis',
+                 '__dict__', '__weakref__')
+
     # スタックポインタの初期値
     initSP = 0xff00
 
-    def __init__(self):
-        self.inst_list = [nop, ld2, st, lad, ld1,
-                          adda2, suba2, addl2, subl2,
-                          adda1, suba1, addl1, subl1,
-                          and2, or2, xor2, and1, or1, xor1,
-                          cpa2, cpl2, cpa1, cpl1,
-                          sla, sra, sll, srl,
-                          jmi, jnz, jze, jump, jpl, jov,
-                          push, pop, call, ret, svc,
-                          in_, out, rpush, rpop]
+    # 実行時間の上限を確認する間隔 (ステップ数)
+    time_check_interval = 10000
 
-        self.inst_table = {}
-        for ir in self.inst_list:
-            self.inst_table[ir.opcode] = MethodType(ir, self, PyComet2)
+    inst_list = inst_list
+    inst_table = inst_table
 
+    def __init__(self):
         self.is_auto_dump = False
-        self.break_points = []
+        self.is_count_step = False
+        # 番地 -> BreakPoint
+        self.break_points = {}
+        # run_until() の実行中だけ、その stop_at の番地
+        self.stop_at = ()
+        # ラベル -> 番地 (.cas を読み込んだときだけ)
+        self.symbols = {}
+        self.image_end = 0
+        # IN/OUT 命令の入出力先 (None なら標準入出力)
+        self.input = None
+        self.output = None
+        # 番地 -> ネイティブルーチン (natives.py)
+        self.natives = {}
         self.call_level = 0
         self.step_count = 0
+        # 1回の step() で複数ステップ進めるエンジンは、
+        # step_count がこの値を超えないようにする (None なら制限なし)
+        self.step_limit = None
         self.monitor = StatusMonitor(self)
         self.dis = Disassembler(self)
 
@@ -162,10 +279,9 @@ class PyComet2(object):
     def initialize(self):
         # 主記憶 1 word = 2 byte unsigned short
         self.memory = array.array('H', [0] * 65536)
-        # レジスタ unsigned short
-        self.GR = array.array('H', [0] * 9)
-        # スタックポインタ SP = GR[8]
-        self.SP = self.initSP
+        # レジスタファイル unsigned short
+        # GR0〜GR7 とスタックポインタ SP = GR[8]
+        self.GR = array.array('H', [0] * 8 + [self.initSP])
         # プログラムレジスタ
         self.PR = 0
         # Overflow Flag
@@ -174,12 +290,31 @@ class PyComet2(object):
         self.SF = 0
         # Zero Flag
         self.ZF = 1
-        logging.info('Initialize memory and registers.')
+        # run_until() で最後に止まった理由と、停止命令を実行したか
+        self.last_stop = None
+        self.halted = False
+        # logging を読み込んでいなければ、出力先も設定されていない
+        logging = sys.modules.get('logging')
+        if logging is not None:
+            logging.info('Initialize memory and registers.')
 
     @property
     def FR(self):
         return self.OF << 2 | self.SF << 1 | self.ZF
 
+    # 主記憶とレジスタをコピーせずに numpy.uint16 の配列として参照する
+    # (initialize() で配列が作り直されるため、その都度取得すること)
+    @property
+    def memory_view(self):
+        import numpy
+        return numpy.frombuffer(self.memory, dtype=numpy.uint16)
+
+    @property
+    def GR_view(self):
+        import numpy
+        return numpy.frombuffer(self.GR, dtype=numpy.uint16)
+
+    # 命令の実装は GR[8] を直接使う
     def _set_SP(self, value):
         self.GR[8] = value
 
@@ -188,7 +323,31 @@ class PyComet2(object):
 
     SP = property(_get_SP, _set_SP)
 
+    # レジスタ (GR0〜GR7, SP, PR, FR) を1つの配列にして返す
+    def save_registers(self):
+        registers = array.array('H', self.GR)
+        registers.append(self.PR)
+        registers.append(self.FR)
+        return registers
+
+    def load_registers(self, registers):
+        self.GR[:] = registers[:9]
+        self.PR = registers[9]
+        FR = registers[10]
+        self.OF, self.SF, self.ZF = FR >> 2 & 1, FR >> 1 & 1, FR & 1
+
+    # 主記憶・レジスタ・呼び出しの深さ・ステップ数の写し
+    def snapshot(self):
+        return (array.array('H', self.memory), self.save_registers(),
+                self.call_level, self.step_count)
+
+    def restore(self, snapshot):
+        memory, registers, self.call_level, self.step_count = snapshot
+        self.memory[:] = memory
+        self.load_registers(registers)
+
     def set_logging_level(self, lv):
+        import logging
         logging.basicConfig(level=lv)
 
     # PRが指す命令を返す
@@ -199,42 +358,196 @@ class PyComet2(object):
         except KeyError:
             raise InvalidOperation(adr)
 
+    # IN 命令で読み込む1行 (改行文字を含む) を返す
+    # 入力先の readline() が None を返したときは、まだ入力が届いていない
+    def read_line(self):
+        if self.input is None:
+            sys.stderr.write('-> ')
+            sys.stderr.flush()
+            return sys.stdin.readline()
+        line = self.input.readline()
+        if line is None:
+            raise InputNeeded(self.PR)
+        return line
+
+    # OUT 命令で1行出力する
+    def write_line(self, line):
+        if self.output is None:
+            print(line)
+        else:
+            self.output.write(line + '\n')
+
     # 命令を1つ実行
     def step(self):
-        self.get_instruction()()
+        self.get_instruction()(self)
         self.step_count += 1
 
-    def watch(self, variables, decimalFlag=False):
+    def watch(self, variables, decimalFlag=False,
+              max_steps=None, timeout=None,
+              every=None, on_change=False, at=None, output=None):
+        '''
+        1命令ごとに監視対象を表示しながら実行する
+        every を指定すると step_count が every の倍数のときだけ、
+        on_change なら監視対象の値が前回の表示から変わったときだけ、
+        at (番地の集合) を指定すると PR がそのどれかのときだけ表示する
+        output を指定するとそこに書き込む (標準出力なら端末のときだけ毎回
+        flush する)
+        '''
         self.monitor.decimalFlag = decimalFlag
         for v in variables.split(","):
             self.monitor.append(v)
+        line = self.monitor.compile()
+        values = self.monitor.values
+        if output is None:
+            output = sys.stdout
+            flush = output.isatty()
+        else:
+            flush = False
+        write = output.write
 
-        while (True):
-            if self.PR in self.break_points:
-                break
-            else:
-                try:
-                    print self.monitor
-                    sys.stdout.flush()
-                    self.step()
-                except InvalidOperation, e:
-                    print >> sys.stderr, e
-                    self.dump(e.address)
+        budget = self.budget(max_steps, timeout)
+        remaining = 0
+        break_points = self.break_points
+        last = None
+        try:
+            while (True):
+                if self.PR in break_points and break_points[self.PR](self):
                     break
-
-    def run(self):
-        while (True):
-            if self.PR in self.break_points:
+                else:
+                    try:
+                        if ((at is None or self.PR in at) and
+                                (every is None
+                                 or self.step_count % every == 0)):
+                            if on_change:
+                                current = values(self)
+                                if current != last:
+                                    last = current
+                                    write(line(self) + '\n')
+                            else:
+                                write(line(self) + '\n')
+                            if flush:
+                                output.flush()
+                        if budget is not None:
+                            if remaining == 0:
+                                remaining = next(budget)
+                            remaining -= 1
+                        self.step()
+                    except InvalidOperation as e:
+                        print(e, file=sys.stderr)
+                        self.dump(e.address)
+                        break
+        finally:
+            output.flush()
+
+    def run(self, max_steps=None, timeout=None):
+        budget = self.budget(max_steps, timeout)
+        break_points = self.break_points
+        if budget is None:
+            while (True):
+                if self.PR in break_points and break_points[self.PR](self):
+                    break
+                else:
+                    self.step()
+            return
+        # 時刻は time_check_interval ステップごとにしか確認せず、
+        # その間は残りステップ数を数えるだけにする
+        try:
+            for n in budget:
+                end = self.step_count + n
+                self.step_limit = end
+                while self.step_count < end:
+                    if self.PR in break_points and break_points[self.PR](self):
+                        return
+                    else:
+                        self.step()
+        finally:
+            self.step_limit = None
+
+    def run_until(self, max_steps=None, stop_at=None, timeout=None):
+        '''
+        止まるまで実行し、止まった理由を StopReason で返す
+        (MachineExit などの例外は送出しない)
+        max_steps はこの呼び出しで実行するステップ数の上限、
+        stop_at はブレークポイントと同様に実行する前に止まる番地
+        (1つの番地またはその集合)
+        どの理由で止まった後も、もう一度呼べば続きから実行する
+        (ブレークポイントで止まった番地の命令は確認せずに実行する)
+        '''
+        if self.halted:
+            return StopReason(self, StopReason.HALTED)
+        if stop_at is None:
+            stop_at = ()
+        elif isinstance(stop_at, int):
+            stop_at = (stop_at,)
+        break_points = self.break_points
+        last = self.last_stop
+        resume = (last is not None and last.reason == StopReason.BREAKPOINT
+                  and last.address == self.PR)
+        budget = self.budget(max_steps, timeout) or [None]
+        self.stop_at = stop_at
+        try:
+            for n in budget:
+                end = None if n is None else self.step_count + n
+                self.step_limit = end
+                while end is None or self.step_count < end:
+                    PR = self.PR
+                    if resume:
+                        resume = False
+                    elif PR in stop_at or (PR in break_points
+                                           and break_points[PR](self)):
+                        stop = StopReason(self, StopReason.BREAKPOINT)
+                        break
+                    self.step()
+                else:
+                    continue
                 break
-            else:
-                self.step()
+        except MachineExit:
+            stop = StopReason(self, StopReason.HALTED)
+        except BudgetExceeded as e:
+            stop = StopReason(self, StopReason.BUDGET, e)
+        except InvalidOperation as e:
+            stop = StopReason(self, StopReason.INVALID, e)
+        except InputNeeded as e:
+            stop = StopReason(self, StopReason.INPUT, e)
+        except OutputMismatch as e:
+            stop = StopReason(self, StopReason.MISMATCH, e)
+        finally:
+            self.step_limit = None
+            self.stop_at = ()
+        self.last_stop = stop
+        return stop
+
+    def budget(self, max_steps=None, timeout=None):
+        '''
+        次に確認するまでに実行してよいステップ数を順に返すイテレータ
+        上限に達すると BudgetExceeded を送出する
+        '''
+        if max_steps is None and timeout is None:
+            return None
+        return self._budget(max_steps, timeout)
+
+    def _budget(self, max_steps, timeout):
+        limit = None if max_steps is None else self.step_count + max_steps
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            n = None
+            if limit is not None:
+                n = limit - self.step_count
+                if n <= 0:
+                    raise BudgetExceeded(self, BudgetExceeded.STEPS)
+            if deadline is not None:
+                if deadline <= time.time():
+                    raise BudgetExceeded(self, BudgetExceeded.TIME)
+                n = min(n or self.time_check_interval,
+                        self.time_check_interval)
+            yield n
 
     # オブジェクトコードを主記憶に読み込む
     def load(self, filename, quiet=False):
         if not quiet:
-            print >> sys.stderr, 'load %s ...' % filename,
+            print('load %s ...' % filename, end=' ', file=sys.stderr)
         self.initialize()
-        fp = file(filename, 'rb')
+        fp = open(filename, 'rb')
         try:
             tmp = array.array('H')
             tmp.fromfile(fp, 65536)
@@ -244,12 +557,15 @@ class PyComet2(object):
         tmp.byteswap()
         self.PR = tmp[2]
         tmp = tmp[8:]
+        # 読み込んだプログラムの末尾の次の番地
+        self.image_end = len(tmp)
         for i in range(0, len(tmp)):
             self.memory[i] = tmp[i]
         if not quiet:
-            print >> sys.stderr, 'done.'
+            print('done.', file=sys.stderr)
 
     def exit(self):
+        self.halted = True
         raise MachineExit(self)
 
     def cast_int(self, addr):
@@ -258,8 +574,8 @@ class PyComet2(object):
         else:
             return int(addr)
 
-    def dump_memory(self, start_addr=0x0000, lines=0xffff / 8):
-        printable = (string.letters
+    def dump_memory(self, start_addr=0x0000, lines=0xffff // 8):
+        printable = (string.ascii_letters
                      + string.digits
                      + string.punctuation + ' ')
 
@@ -284,13 +600,13 @@ class PyComet2(object):
 
     # 8 * 16 wordsダンプする
     def dump(self, start_addr=0x0000):
-        print self.dump_memory(start_addr, 16),
+        sys.stdout.write(self.dump_memory(start_addr, 16))
 
     def dump_stack(self):
-        print self.dump_memory(self.SP, 16),
+        sys.stdout.write(self.dump_memory(self.SP, 16))
 
-    def dump_to_file(self, filename, lines=0xffff / 8):
-        fp = file(filename, 'w')
+    def dump_to_file(self, filename, lines=0xffff // 8):
+        fp = open(filename, 'w')
         fp.write('Step count: %d\n' % self.step_count)
         fp.write('PR: #%04x\n' % self.PR)
         fp.write('SP: #%04x\n' % self.SP)
@@ -306,27 +622,48 @@ class PyComet2(object):
     def disassemble(self, start_addr=0x0000):
         addr = start_addr
         for addr, dis in self.dis.disassemble(addr, 16):
-            print >> sys.stderr, ('#%04x\t#%04x\t%s'
-                                  % (addr, self.memory[addr], dis))
-
-    def set_break_point(self, addr):
-        if addr in self.break_points:
-            print >> sys.stderr, '#%04x is already set.' % addr
+            print('#%04x\t#%04x\t%s' % (addr, self.memory[addr], dis),
+                  file=sys.stderr)
+
+    # 番地 (#16進, 10進) またはラベルを番地にする
+    def cast_address(self, s):
+        if s in self.symbols:
+            return self.symbols[s]
+        return self.cast_int(s)
+
+    def set_break_point(self, addr, condition=None, after=0):
+        if addr in self.break_points and condition is None and after == 0:
+            print('#%04x is already set.' % addr, file=sys.stderr)
         else:
-            self.break_points.append(addr)
+            self.break_points[addr] = BreakPoint(addr, condition, after,
+                                                 self.symbols)
+
+    # b ADDR [if COND] [after N [hits]]
+    def parse_break_point(self, line):
+        import re
+        match = re.match(r'^b\w*\s+(\S+)(?:\s+if\s+(.+?))?'
+                         r'(?:\s+after\s+(\d+)(?:\s+hits?)?)?\s*$', line)
+        if match is None:
+            raise ValueError(line)
+        addr, condition, after = match.groups()
+        self.set_break_point(self.cast_address(addr), condition,
+                             int(after or 0))
 
     def print_break_points(self):
         if len(self.break_points) == 0:
-            print >> sys.stderr, 'No break points.'
+            print('No break points.', file=sys.stderr)
         else:
-            for i, addr in enumerate(self.break_points):
-                print >> sys.stderr, '%d: #%04x' % (i, addr)
+            for i, addr in enumerate(sorted(self.break_points)):
+                print('%d: %s' % (i, self.break_points[addr]),
+                      file=sys.stderr)
 
     def delete_break_points(self, n):
         if 0 <= n < len(self.break_points):
-            print >> sys.stderr, '#%04x is removed.' % (self.break_points[n])
+            addr = sorted(self.break_points)[n]
+            del self.break_points[addr]
+            print('#%04x is removed.' % addr, file=sys.stderr)
         else:
-            print >> sys.stderr, 'Invalid number is specified.'
+            print('Invalid number is specified.', file=sys.stderr)
 
     def write_memory(self, addr, value):
         self.memory[addr] = value
@@ -361,9 +698,9 @@ class PyComet2(object):
     def wait_for_command(self):
         while True:
             try:
-                line = raw_input('pycomet2> ').strip()
+                line = input_line('pycomet2> ').strip()
             except EOFError:
-                print
+                print()
                 break
             if line == '': continue
             try:
@@ -372,10 +709,10 @@ class PyComet2(object):
                     break
                 elif line[0] == 'b':
                     if 2 <= len(args):
-                        self.set_break_point(self.cast_int(args[1]))
+                        self.parse_break_point(line)
                 elif line[0:2] == 'df':
                     self.dump_to_file(args[1])
-                    print >> sys.stderr, 'dump to', filename
+                    print('dump to', filename, file=sys.stderr)
                 elif line[0:2] == 'di':
                     if len(args) == 1:
                         self.disassemble()
@@ -408,41 +745,84 @@ class PyComet2(object):
                     self.step()
                     self.print_status()
                 else:
-                    print >> sys.stderr, 'Invalid command', args[0]
+                    print('Invalid command', args[0], file=sys.stderr)
             except (IndexError, ValueError):
-                print >> sys.stderr, "Invalid arguments", ', '.join(args[1:])
+                print("Invalid arguments", ', '.join(args[1:]), file=sys.stderr)
             except InvalidOperation as e:
-                print >> sys.stderr, e
+                print(e, file=sys.stderr)
                 self.dump(e.address)
                 break
             except MachineExit as e:
-                if self.is_count_step:
-                    print 'Step count:', self.step_count
-                if self.is_auto_dump:
-                    print >> sys.stderr, "dump last status to last_state.txt"
-                    self.dump_to_file('last_state.txt')
+                self.report_exit()
                 break
 
+    # -c, -d で指定された終了時の出力
+    def report_exit(self):
+        if self.is_count_step:
+            print('Step count:', self.step_count)
+        if self.is_auto_dump:
+            print("dump last status to last_state.txt", file=sys.stderr)
+            self.dump_to_file('last_state.txt')
+
     def print_help(self):
-        print >> sys.stderr, ('b ADDR        '
-                              'Set a breakpoint at specified address.')
-        print >> sys.stderr, 'd NUM         Delete breakpoints.'
-        print >> sys.stderr, ('di ADDR       '
-                              'Disassemble 32 words from specified address.')
-        print >> sys.stderr, 'du ADDR       Dump 128 words of memory.'
-        print >> sys.stderr, 'h             Print help.'
-        print >> sys.stderr, 'i             Print breakpoints.'
-        print >> sys.stderr, 'j ADDR        Set PR to ADDR.'
-        print >> sys.stderr, 'm ADDR VAL    Change the memory at ADDR to VAL.'
-        print >> sys.stderr, 'p             Print register status.'
-        print >> sys.stderr, 'q             Quit.'
-        print >> sys.stderr, 'r             Strat execution of program.'
-        print >> sys.stderr, 's             Step execution.'
-        print >> sys.stderr, 'st            Dump 128 words of stack image.'
+        print('b ADDR        '
+              'Set a breakpoint at specified address.', file=sys.stderr)
+        print('b ADDR if COND [after N hits]', file=sys.stderr)
+        print('              '
+              'Stop at ADDR when COND holds (ex. GR1 == 0, [BUF] != 0)',
+              file=sys.stderr)
+        print('              '
+              'after it has held N times.', file=sys.stderr)
+        print('d NUM         Delete breakpoints.', file=sys.stderr)
+        print('di ADDR       '
+              'Disassemble 32 words from specified address.', file=sys.stderr)
+        print('du ADDR       Dump 128 words of memory.', file=sys.stderr)
+        print('h             Print help.', file=sys.stderr)
+        print('i             Print breakpoints.', file=sys.stderr)
+        print('j ADDR        Set PR to ADDR.', file=sys.stderr)
+        print('m ADDR VAL    Change the memory at ADDR to VAL.', file=sys.stderr)
+        print('p             Print register status.', file=sys.stderr)
+        print('q             Quit.', file=sys.stderr)
+        print('r             Strat execution of program.', file=sys.stderr)
+        print('s             Step execution.', file=sys.stderr)
+        print('st            Dump 128 words of stack image.', file=sys.stderr)
+
+
+def symbol_table(symbols):
+    ''' CASL2.symbols から ラベル -> 番地 の辞書を作る (SCOPE.NAME と NAME) '''
+    table = {}
+    for name, label in symbols.items():
+        table[name] = label.addr
+        table.setdefault(name.split('.')[-1], label.addr)
+    return table
+
+
+def load_program(machine, filename, quiet=False):
+    ''' .cas ならアセンブルして読み込み、ラベルを machine.symbols に登録する '''
+    if not filename.endswith('.cas'):
+        machine.load(filename, quiet)
+        return
+    import verify
+    machine.symbols = symbol_table(verify.load_program(machine, filename))
+
+
+def enable_history():
+    ''' 対話モードのコマンド履歴を .comet2_history に保存する '''
+    import os
+    import readline
+    import atexit
+    histfile = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                            '.comet2_history')
+    try:
+        readline.read_history_file(histfile)
+    except IOError:
+        pass
+    atexit.register(readline.write_history_file, histfile)
 
 
 def main():
-    usage = 'usage: %prog [options] input.com'
+    from optparse import OptionParser
+    usage = 'usage: %prog [options] input.com|input.cas'
     parser = OptionParser(usage)
     parser.add_option('-c', '--count-step', action='store_true',
                       dest='count_step', default=False, help='count step.')
@@ -454,62 +834,213 @@ def main():
     parser.add_option('-w', '--watch', type='string',
                       dest='watchVariables', default='',
                       help='run in watching mode. (ex. -w PR,GR0,GR8,#001f)')
+    parser.add_option('--watch-every', type='int',
+                      dest='watch_every', default=None,
+                      help='in watching mode, print only every N steps.')
+    parser.add_option('--watch-on-change', action='store_true',
+                      dest='watch_on_change', default=False,
+                      help='in watching mode, print only when a watched '
+                           'value changes.')
+    parser.add_option('--watch-at', type='string',
+                      dest='watch_at', default=None,
+                      help='in watching mode, print only when PR is one of '
+                           'the addresses. (ex. --watch-at #0012,LOOP)')
+    parser.add_option('--watch-output', type='string',
+                      dest='watch_output', default=None,
+                      help='write the output of watching mode to the file.')
     parser.add_option('-D', '--Decimal', action='store_true',
                       dest='decimalFlag', default=False,
                       help='watch GR[0-8] and specified address in decimal '
                            'notation. (Effective in watcing mode only)')
+    parser.add_option('--max-steps', type='int',
+                      dest='max_steps', default=None,
+                      help='stop after executing N steps. (with --serve, '
+                           'the limit for each request)')
+    parser.add_option('--timeout', type='float',
+                      dest='timeout', default=None,
+                      help='stop after running for SEC seconds. (with '
+                           '--serve, the limit for each request)')
+    parser.add_option('-i', '--input', type='string',
+                      dest='input', default=None,
+                      help='read input of IN from the file.')
+    parser.add_option('-o', '--output', type='string',
+                      dest='output', default=None,
+                      help='write output of OUT to the file.')
+    parser.add_option('--expect', type='string',
+                      dest='expect', default=None,
+                      help='compare output of OUT with the file line by line '
+                           'and stop at the first difference.')
+    parser.add_option('--no-prompt', action='store_true',
+                      dest='no_prompt', default=False,
+                      help='do not print the prompt for IN.')
+    parser.add_option('--native', type='string', action='append',
+                      dest='natives', default=[],
+                      help='run the subroutine at ADDR with the native '
+                           'routine NAME. (ex. --native MULT@#0012)')
+    parser.add_option('--detect-loops', action='store_true',
+                      dest='detect_loops', default=False,
+                      help='stop when the machine returns to the same state '
+                           'at a backward branch. (see loopcheck.py)')
+    parser.add_option('--coverage', type='string',
+                      dest='coverage', default=None,
+                      help='add the executed addresses and branches to the '
+                           'coverage file. (see cover.py)')
+    parser.add_option('--stats', type='string',
+                      dest='stats', default=None,
+                      help='write statistics of the run to the JSON file. '
+                           '(- for stdout)')
+    parser.add_option('--cost', action='store_true',
+                      dest='cost', default=False,
+                      help='count the cost of each instruction and print it '
+                           'with the step count. (implies -c, see cost.py)')
+    parser.add_option('--cost-model', type='string',
+                      dest='cost_model', default=None,
+                      help='read the cost of each instruction for --cost and '
+                           '--stats from the JSON file. (see cost.py)')
+    parser.add_option('--host-profile', action='store_true',
+                      dest='host_profile', default=False,
+                      help='print where the simulator itself spends its '
+                           'time. (see hostprof.py)')
+    parser.add_option('--serve', action='store_true',
+                      dest='serve', default=False,
+                      help='run as a daemon which accepts requests on a '
+                           'Unix domain socket. (see daemon.py)')
+    parser.add_option('--socket', type='string',
+                      dest='socket', default=None,
+                      help='path of the socket for --serve.')
+    parser.add_option('--workers', type='int',
+                      dest='workers', default=4,
+                      help='number of worker processes for --serve.')
     parser.add_option('-v', '--version', action='store_true',
                       dest='version', default=False,
                       help='display version information.')
     options, args = parser.parse_args()
 
     if options.version:
-        print 'PyCOMET2 version 1.2'
-        print '$Revision: a31dbeeb4d1c $'
-        print 'Copyright (c) 2012, Yasuaki Mitani.'
-        print 'Copyright (c) 2009, Masahiko Nakamoto.'
-        print 'All rights reserved.'
+        print('PyCOMET2 version 1.2')
+        print('$Revision: a31dbeeb4d1c $')
+        print('Copyright (c) 2012, Yasuaki Mitani.')
+        print('Copyright (c) 2009, Masahiko Nakamoto.')
+        print('All rights reserved.')
         sys.exit()
 
+    if options.serve:
+        import daemon
+        max_steps, timeout = options.max_steps, options.timeout
+        if max_steps is None:
+            max_steps = daemon.DEFAULT_MAX_STEPS
+        if timeout is None:
+            timeout = daemon.DEFAULT_TIMEOUT
+        daemon.serve(options.socket or daemon.DEFAULT_SOCKET, options.workers,
+                     max_steps, timeout)
+        return
+
     if len(args) < 1:
         parser.print_help()
         sys.exit()
 
-    comet2 = PyComet2()
+    engine = PyComet2
+    if options.host_profile:
+        from hostprof import instrumented
+        engine = instrumented(engine)
+    if options.detect_loops:
+        from loopcheck import detecting
+        engine = detecting(engine)
+    if options.cost or options.stats is not None:
+        from cost import CostModel, costed
+        try:
+            model = None
+            if options.cost_model is not None:
+                model = CostModel.load(options.cost_model)
+            engine = costed(engine, model)
+        except (IOError, ValueError) as e:
+            parser.error('%s: %s' % (options.cost_model, e))
+    if options.stats is not None:
+        from stats import counted
+        engine = counted(engine)
+    if options.coverage is not None:
+        from cover import covered
+        engine = covered(engine)
+    comet2 = engine()
     comet2.is_auto_dump = options.dump
-    comet2.is_count_step = options.count_step
+    comet2.is_count_step = options.count_step or options.cost
+    if options.input is not None:
+        comet2.input = open_input(options.input)
+    elif options.no_prompt:
+        comet2.input = StdinInput(prompt=None)
+    if options.output is not None:
+        comet2.output = open_output(options.output)
+    expect = None
+    if options.expect is not None:
+        fp = open(options.expect)
+        expect = ExpectedOutput(fp.read(), comet2.output)
+        fp.close()
+        comet2.output = expect
+    mismatch = None
+    if options.natives:
+        from natives import Natives, library
+        natives = Natives()
+        for spec in options.natives:
+            name, addr = spec.split('@')
+            natives.bind(comet2.cast_int(addr), library[name])
+        comet2.natives = natives.resolve()
+    watch_output = None
     try:
         if len(options.watchVariables) != 0:
-            comet2.load(args[0], True)
-            comet2.watch(options.watchVariables, options.decimalFlag)
+            load_program(comet2, args[0], True)
+            at = None
+            if options.watch_at is not None:
+                at = set(comet2.cast_address(s)
+                         for s in options.watch_at.split(','))
+            if options.watch_output is not None:
+                watch_output = open(options.watch_output, 'w', 1 << 16)
+            comet2.watch(options.watchVariables, options.decimalFlag,
+                         options.max_steps, options.timeout,
+                         options.watch_every, options.watch_on_change,
+                         at, watch_output)
         elif options.run:
-            comet2.load(args[0], True)
-            comet2.run()
+            load_program(comet2, args[0], True)
+            comet2.run(options.max_steps, options.timeout)
         else:
-            comet2.load(args[0])
+            enable_history()
+            load_program(comet2, args[0])
             comet2.print_status()
             comet2.wait_for_command()
     except InvalidOperation as e:
-        print >> sys.stderr, e
+        print(e, file=sys.stderr)
         comet2.dump(e.address)
     except MachineExit as e:
-        if comet2.is_count_step:
-            print 'Step count:', comet2.step_count
-        if comet2.is_auto_dump:
-            print >> sys.stderr, "dump last status to last_state.txt"
-            comet2.dump_to_file('last_state.txt')
+        comet2.report_exit()
+        if expect is not None:
+            mismatch = expect.finish()
+            if mismatch is not None:
+                print(mismatch, file=sys.stderr)
+    except BudgetExceeded as e:
+        print(e, file=sys.stderr)
+        comet2.report_exit()
+    except OutputMismatch as e:
+        mismatch = e
+        print(e, file=sys.stderr)
+        comet2.report_exit()
+    finally:
+        if comet2.output is not None:
+            comet2.output.close()
+        if watch_output is not None:
+            watch_output.close()
+        if options.host_profile:
+            comet2.host_profile.report(comet2)
+        if options.stats is not None:
+            comet2.stats.finish(comet2)
+            comet2.stats.save(comet2, options.stats)
+        if options.coverage is not None:
+            from cover import record
+            try:
+                record(comet2, options.coverage)
+            except ValueError as e:
+                print('%s: %s' % (options.coverage, e), file=sys.stderr)
+    if mismatch is not None:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
-    import os
-    import readline
-    histfile = os.path.join(os.path.abspath(os.path.dirname(__file__)),
-                            '.comet2_history')
-    try:
-        readline.read_history_file(histfile)
-    except IOError:
-        pass
-    import atexit
-    atexit.register(readline.write_history_file, histfile)
-    del os, histfile
     main()
@@ -0,0 +1,191 @@
+# ~*~ coding:utf-8 ~*~
+'''
+実行の統計 (pycomet2.py --stats)
+
+  python pycomet2.py -r --stats stats.json prog.com
+
+counted(engine) は、命令表の各命令を数える命令に置き換えたサブクラスを返す。
+統計を取らないときはこのサブクラスを使わないので、通常の実行には
+一切の負担がかからない。
+
+主記憶の読み書きの回数は命令ごとの回数 (READS, WRITES) と命令の実行回数
+から求め、語数が実行ごとに変わる IN / OUT だけは実行時に数える。
+call_level が 0 の RET は戻り番地を読まずに停止するので、READS の分を除く。
+命令の取り出し (フェッチ) は数えない。
+
+命令ごとのコスト (cost.py) も数えていれば、全体とサブルーチンごとの
+コストを cost, subroutines として加える。
+'''
+from __future__ import print_function
+import sys
+import json
+import time
+
+from instructions import instruction
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# 命令コード -> 1回の実行で主記憶を読む / 書く語数 (IN / OUT は別に数える)
+READS = {0x10: 1, 0x20: 1, 0x21: 1, 0x22: 1, 0x23: 1,
+         0x30: 1, 0x31: 1, 0x32: 1, 0x40: 1, 0x41: 1,
+         0x71: 1, 0x81: 1, 0xa1: 8}
+WRITES = {0x11: 1, 0x70: 1, 0x80: 1, 0xa0: 8}
+
+# スタックを伸ばす命令
+PUSHES = ('PUSH', 'CALL', 'RPUSH')
+
+
+class Stats(object):
+    ''' 1回の実行の統計 '''
+
+    def __init__(self):
+        # 命令コード -> 実行回数
+        self.ops = [0] * 256
+        self.max_call_level = 0
+        # SP の最小値 (start() で初期化する)
+        self.min_sp = None
+        self.initial_sp = None
+        # IN / OUT が読み書きした主記憶の語数 (停止した RET の分を除く)
+        self.reads = 0
+        self.writes = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.steps = 0
+        self.start_step = 0
+        self.started = None
+        self.wall_time = 0.0
+
+    def start(self, machine):
+        self.initial_sp = self.min_sp = machine.SP
+        self.max_call_level = max(self.max_call_level, machine.call_level)
+        self.started = timer()
+        self.start_step = machine.step_count
+
+    def finish(self, machine):
+        if self.started is not None:
+            self.wall_time += timer() - self.started
+            self.steps += machine.step_count - self.start_step
+            self.started = None
+
+    def to_dict(self, machine):
+        opnames = {}
+        for opcode, n in enumerate(self.ops):
+            if n:
+                name = machine.inst_table[opcode].opname
+                opnames[name] = opnames.get(name, 0) + n
+        reads = self.reads + sum(n * READS.get(op, 0)
+                                 for op, n in enumerate(self.ops))
+        writes = self.writes + sum(n * WRITES.get(op, 0)
+                                   for op, n in enumerate(self.ops))
+        result = {
+            'steps': self.steps,
+            'wall_time': self.wall_time,
+            'steps_per_sec': (self.steps / self.wall_time
+                              if self.wall_time else None),
+            'opcodes': opnames,
+            'max_call_depth': self.max_call_level,
+            'stack_high_water': (self.initial_sp - self.min_sp
+                                 if self.min_sp is not None else 0),
+            'memory_reads': reads,
+            'memory_writes': writes,
+            'input_bytes': self.input_bytes,
+            'output_bytes': self.output_bytes,
+        }
+        if hasattr(machine, 'cost_by_subroutine'):
+            # cost.costed() で数えたコスト
+            result['cost'] = machine.cost
+            result['subroutines'] = machine.cost_by_subroutine()
+        return result
+
+    def save(self, machine, filename):
+        ''' JSON で書き出す (filename が - なら標準出力) '''
+        data = json.dumps(self.to_dict(machine), indent=1, sort_keys=True,
+                          separators=(',', ': '))
+        if filename == '-':
+            print(data)
+        else:
+            fp = open(filename, 'w')
+            fp.write(data + '\n')
+            fp.close()
+
+
+def count(inst):
+    ''' inst を、実行回数などを数える命令にする '''
+    ir = inst.ir
+    opcode = inst.opcode
+
+    if inst.opname in PUSHES:
+        def counting(machine, *args):
+            stats = machine.stats
+            stats.ops[opcode] += 1
+            try:
+                return ir(machine, *args)
+            finally:
+                if stats.max_call_level < machine.call_level:
+                    stats.max_call_level = machine.call_level
+                if machine.GR[8] < stats.min_sp:
+                    stats.min_sp = machine.GR[8]
+    elif inst.opname in ('IN', 'OUT'):
+        writes = inst.opname == 'IN'
+
+        def counting(machine, s, l):
+            stats = machine.stats
+            stats.ops[opcode] += 1
+            result = ir(machine, s, l)
+            # 長さの語と文字の語
+            if writes:
+                stats.writes += 1 + machine.memory[l]
+            else:
+                stats.reads += 1 + machine.memory[l]
+            return result
+    elif inst.opname == 'RET':
+        def counting(machine, *args):
+            stats = machine.stats
+            stats.ops[opcode] += 1
+            if machine.call_level == 0:
+                # 戻り番地を取り出さずに停止する
+                stats.reads -= 1
+            return ir(machine, *args)
+    else:
+        def counting(machine, *args):
+            machine.stats.ops[opcode] += 1
+            return ir(machine, *args)
+    return instruction(inst.opcode, inst.opname, inst.argtype)(counting)
+
+
+def counted(engine):
+    ''' エンジン engine に統計の記録を加えたサブクラスを返す '''
+
+    class CountedEngine(engine):
+
+        inst_table = dict((code, count(inst))
+                          for code, inst in engine.inst_table.items())
+
+        def __init__(self):
+            self.stats = Stats()
+            engine.__init__(self)
+
+        def load(self, filename, quiet=False):
+            engine.load(self, filename, quiet)
+            self.stats.start(self)
+
+        def read_line(self):
+            line = engine.read_line(self)
+            if line:
+                self.stats.input_bytes += len(line)
+            return line
+
+        def write_line(self, line):
+            self.stats.output_bytes += len(line) + 1
+            engine.write_line(self, line)
+
+        if hasattr(engine, 'fast_forwarded'):
+            def fast_forwarded(self, head, branch, iterations):
+                engine.fast_forwarded(self, head, branch, iterations)
+                # 早送りしたループの命令を繰り返し回数分数える
+                from idioms import decode_loop
+                for inst, args in decode_loop(self, head, branch):
+                    self.stats.ops[inst.opcode] += iterations
+
+    CountedEngine.__name__ = 'Counted' + engine.__name__
+    return CountedEngine
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+'''
+同じプログラムを読み込んだ N 台の COMET II を NumPy の配列で並べて実行する
+
+  python vector.py [-n N] [--max-steps N] [--check] prog.com [case.in ...]
+
+--check は参照実装と、停止の理由・ステップ数・出力に加えて
+GR, PR, SP, フラグ, 主記憶の最終状態を比較する。
+
+主記憶 (N, 65536), レジスタ (N, 9), PR・フラグ (N,) を配列で持ち、
+1回の step() で実行中のすべての機械の命令を1つずつ実行する。
+機械は現在の命令コードごとにまとめ、instructions.py と同じ意味の処理を
+そのまとまりに対して配列演算で行う。分岐先が分かれた機械は
+次の step() で別のまとまりになり、停止した機械は以後実行しない。
+
+instructions.py との違い
+  - ネイティブルーチン (natives.py) とブレークポイントには対応しない
+  - 参照実装で IndexError などになる命令を実行した機械は ERROR で停止する
+    (その機械の状態は参照実装と一致するとは限らない)
+'''
+from __future__ import print_function
+import sys
+from array import array
+from optparse import OptionParser
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import numpy
+
+from pycomet2 import PyComet2
+from channels import BufferOutput
+
+# 機械の状態 (status)
+RUNNING = 0
+HALTED = 1
+INVALID = 2
+STEPS = 3
+ERROR = 4
+STATUS_NAMES = ['running', 'halted', 'invalid', 'steps', 'error']
+
+int64 = numpy.int64
+
+
+def arith_flags(result):
+    ''' flags(result) と同じフラグ (SF の向きも参照実装に合わせる) '''
+    return (result == 0, (result >> 15) & 1 == 0,
+            (result < -32768) | (0x7fff < result))
+
+
+def logical_flags(result):
+    ''' flags(result, logical=True) '''
+    return (result == 0, (result >> 15) & 1 == 0,
+            (result < 0) | (0xffff < result))
+
+
+def signed(v):
+    ''' l2a() '''
+    v = v & 0xffff
+    return v - ((v & 0x8000) << 1)
+
+
+def bit(v, n):
+    ''' get_bit() (n は 0 以上) '''
+    return (v >> numpy.minimum(n, 63)) & 1
+
+
+class VectorComet2(object):
+    ''' N 台の COMET II '''
+
+    def __init__(self, n):
+        self.n = n
+        self.memory = numpy.zeros((n, 0x10000), numpy.uint16)
+        self.GR = numpy.zeros((n, 9), numpy.uint16)
+        self.PR = numpy.zeros(n, int64)
+        self.ZF = numpy.ones(n, int64)
+        self.SF = numpy.zeros(n, int64)
+        self.OF = numpy.zeros(n, int64)
+        self.call_level = numpy.zeros(n, int64)
+        self.step_count = numpy.zeros(n, int64)
+        self.status = numpy.zeros(n, numpy.int8)
+        self.errors = [None] * n
+        # IN/OUT 命令の入出力先 (機械ごと)
+        self.inputs = [StringIO('') for i in range(n)]
+        self.outputs = [BufferOutput() for i in range(n)]
+
+        # 命令コード -> (語数, 処理)
+        self.table = {}
+        for ir in PyComet2.inst_list:
+            size = ir.argtype.size
+            self.table[ir.opcode] = (size, self.handler(ir.opname,
+                                                        ir.argtype.__name__,
+                                                        size))
+
+    @classmethod
+    def from_machine(cls, machine, n):
+        ''' PyComet2 の状態を N 台に複製する '''
+        self = cls(n)
+        self.memory[:] = numpy.frombuffer(machine.memory, numpy.uint16)
+        self.GR[:] = numpy.frombuffer(machine.GR, numpy.uint16)
+        self.PR[:] = machine.PR
+        self.ZF[:], self.SF[:], self.OF[:] = machine.ZF, machine.SF, machine.OF
+        self.call_level[:] = machine.call_level
+        self.step_count[:] = machine.step_count
+        return self
+
+    def to_machine(self, i, machine=None):
+        ''' i 台目の状態を PyComet2 に書き出す '''
+        m = machine or PyComet2()
+        m.memory[:] = array('H', self.memory[i].tobytes())
+        m.GR[:] = array('H', self.GR[i].tobytes())
+        m.PR = int(self.PR[i])
+        m.ZF, m.SF, m.OF = int(self.ZF[i]), int(self.SF[i]), int(self.OF[i])
+        m.call_level = int(self.call_level[i])
+        m.step_count = int(self.step_count[i])
+        return m
+
+    def stop(self, sel, status, error=None):
+        self.status[sel] = status
+        if error is not None:
+            for i in sel:
+                self.errors[i] = error
+
+    def keep(self, sel, ok, error, *fields):
+        ''' ok でない機械を ERROR で停止し、残りの sel と fields を返す '''
+        if ok.all():
+            return (sel,) + fields
+        self.stop(sel[~ok], ERROR, error)
+        return (sel[ok],) + tuple(f[ok] for f in fields)
+
+    def effective(self, sel, adr, x):
+        ''' 実効アドレス '''
+        ea = adr.copy()
+        m = x != 0
+        if m.any():
+            ea[m] = (adr[m] + self.GR[sel[m], x[m]]) & 0xffff
+        return ea
+
+    def set_flags(self, sel, ZF, SF, OF):
+        self.ZF[sel] = ZF
+        self.SF[sel] = SF
+        self.OF[sel] = OF
+
+    def step(self):
+        ''' 実行中のすべての機械で命令を1つ実行し、実行した台数を返す '''
+        idx = numpy.flatnonzero(self.status == RUNNING)
+        if len(idx) == 0:
+            return 0
+        pr = self.PR[idx]
+        idx, pr = self.keep(idx, pr <= 0xffff, 'PR is out of memory.', pr)
+        w0 = self.memory[idx, pr].astype(int64)
+        op = w0 >> 8
+        for code in numpy.unique(op):
+            m = op == code
+            sel, spr, sw0 = idx[m], pr[m], w0[m]
+            entry = self.table.get(int(code))
+            if entry is None:
+                self.stop(sel, INVALID, 'Invalid operation.')
+                continue
+            size, handler = entry
+            sel, spr, sw0 = self.keep(sel, spr + (size - 1) <= 0xffff,
+                                      'Operand is out of memory.', spr, sw0)
+            handler(sel, spr, sw0)
+            done = sel[self.status[sel] == RUNNING]
+            self.step_count[done] += 1
+        return len(idx)
+
+    def run(self, max_steps=None):
+        '''
+        すべての機械が停止するまで実行する
+        max_steps を指定すると、それだけ実行した機械を STEPS で停止する
+        '''
+        if max_steps is not None:
+            limit = self.step_count + max_steps
+        while True:
+            if max_steps is not None:
+                over = (self.status == RUNNING) & (limit <= self.step_count)
+                self.status[over] = STEPS
+            if self.step() == 0:
+                break
+
+    # 命令ごとの処理 ---------------------------------------------------
+
+    def handler(self, opname, argtype, size):
+        if opname in ('LD', 'ADDA', 'SUBA', 'ADDL', 'SUBL',
+                      'AND', 'OR', 'XOR', 'CPA', 'CPL'):
+            return self.alu(opname, argtype, size)
+        if opname in ('JMI', 'JNZ', 'JZE', 'JUMP', 'JPL', 'JOV'):
+            return self.branch(opname)
+        if opname in ('SLA', 'SRA', 'SLL', 'SRL'):
+            return self.shift(opname)
+        return getattr(self, 'op_' + opname.lower())
+
+    def radrx(self, sel, pr, w0):
+        r, x = (w0 >> 4) & 0xf, w0 & 0xf
+        adr = self.memory[sel, pr + 1].astype(int64)
+        return self.keep(sel, (r <= 8) & (x <= 8), 'Invalid register.',
+                         pr, r, adr, x)
+
+    def r1r2(self, sel, pr, w0):
+        r1, r2 = (w0 >> 4) & 0xf, w0 & 0xf
+        return self.keep(sel, (r1 <= 8) & (r2 <= 8), 'Invalid register.',
+                         pr, r1, r2)
+
+    def adrx(self, sel, pr, w0):
+        x = w0 & 0xf
+        adr = self.memory[sel, pr + 1].astype(int64)
+        return self.keep(sel, x <= 8, 'Invalid register.', pr, adr, x)
+
+    def alu(self, opname, argtype, size):
+        def handler(sel, pr, w0):
+            if argtype == 'radrx':
+                sel, pr, r, adr, x = self.radrx(sel, pr, w0)
+                v = self.memory[sel, self.effective(sel, adr, x)]
+            else:
+                sel, pr, r, r2 = self.r1r2(sel, pr, w0)
+                v = self.GR[sel, r2]
+            a = self.GR[sel, r].astype(int64)
+            v = v.astype(int64)
+            if opname in ('CPA', 'CPL'):
+                if opname == 'CPA':
+                    diff = signed(a) - signed(v)
+                else:
+                    diff = a - v
+                self.set_flags(sel, diff == 0, diff < 0, 0)
+            elif opname in ('ADDA', 'SUBA'):
+                if opname == 'ADDA':
+                    result = signed(a) + signed(v)
+                else:
+                    result = signed(a) - signed(v)
+                self.GR[sel, r] = result & 0xffff
+                self.set_flags(sel, *arith_flags(result))
+            elif opname in ('ADDL', 'SUBL'):
+                result = a + v if opname == 'ADDL' else a - v
+                self.GR[sel, r] = result & 0xffff
+                self.set_flags(sel, *logical_flags(result))
+            else:
+                if opname == 'LD':
+                    result = v
+                elif opname == 'AND':
+                    result = a & v
+                elif opname == 'OR':
+                    result = a | v
+                else:
+                    result = a ^ v
+                self.GR[sel, r] = result
+                ZF, SF, OF = arith_flags(result)
+                self.set_flags(sel, ZF, SF, 0)
+            self.PR[sel] = pr + size
+        return handler
+
+    def branch(self, opname):
+        def handler(sel, pr, w0):
+            sel, pr, adr, x = self.adrx(sel, pr, w0)
+            ZF, SF, OF = self.ZF[sel], self.SF[sel], self.OF[sel]
+            if opname == 'JMI':
+                taken = SF == 1
+            elif opname == 'JNZ':
+                taken = ZF == 0
+            elif opname == 'JZE':
+                taken = ZF == 1
+            elif opname == 'JPL':
+                taken = (ZF == 0) & (SF == 0)
+            elif opname == 'JOV':
+                taken = OF == 0
+            else:
+                taken = numpy.ones(len(sel), bool)
+            self.PR[sel] = numpy.where(taken, self.effective(sel, adr, x),
+                                       pr + 2)
+        return handler
+
+    def shift(self, opname):
+        def handler(sel, pr, w0):
+            sel, pr, r, adr, x = self.radrx(sel, pr, w0)
+            v = self.effective(sel, adr, x)
+            if opname == 'SLA':
+                sel, pr, r, v = self.keep(sel, v <= 15, 'Negative shift.',
+                                          pr, r, v)
+            elif opname == 'SLL':
+                sel, pr, r, v = self.keep(sel, v <= 16, 'Negative shift.',
+                                          pr, r, v)
+            u = self.GR[sel, r].astype(int64)
+            p = signed(u)
+            shifted = 0 < v
+            if opname in ('SLA', 'SRA'):
+                if opname == 'SLA':
+                    ans = (p << v) & 0x7fff
+                    of = bit(p, numpy.maximum(15 - v, 0))
+                else:
+                    ans = (p >> numpy.minimum(v, 63)) & 0x7fff
+                    of = bit(p, numpy.maximum(v - 1, 0))
+                ans = ans | (u & 0x8000)
+                ZF, SF, OF = arith_flags(ans)
+            elif opname == 'SLL':
+                ans = (u << v) & 0xffff
+                of = bit(u, numpy.maximum(16 - v, 0))
+                ZF, SF, OF = logical_flags(ans)
+            else:
+                ans = u >> numpy.minimum(v, 63)
+                of = bit(u, numpy.maximum(v - 1, 0))
+                ZF, SF, OF = arith_flags(ans)
+            self.GR[sel, r] = ans
+            self.set_flags(sel, ZF, SF, numpy.where(shifted, of, OF))
+            self.PR[sel] = pr + 2
+        return handler
+
+    def op_nop(self, sel, pr, w0):
+        self.PR[sel] = pr + 1
+
+    def op_st(self, sel, pr, w0):
+        sel, pr, r, adr, x = self.radrx(sel, pr, w0)
+        self.memory[sel, self.effective(sel, adr, x)] = self.GR[sel, r]
+        self.PR[sel] = pr + 2
+
+    def op_lad(self, sel, pr, w0):
+        sel, pr, r, adr, x = self.radrx(sel, pr, w0)
+        self.GR[sel, r] = self.effective(sel, adr, x)
+        self.PR[sel] = pr + 2
+
+    def op_push(self, sel, pr, w0):
+        sel, pr, adr, x = self.adrx(sel, pr, w0)
+        sp = self.GR[sel, 8].astype(int64)
+        sel, pr, adr, x, sp = self.keep(sel, sp != 0, 'Stack overflow.',
+                                        pr, adr, x, sp)
+        self.GR[sel, 8] = sp - 1
+        self.memory[sel, sp - 1] = self.effective(sel, adr, x)
+        self.PR[sel] = pr + 2
+
+    def op_pop(self, sel, pr, w0):
+        r = (w0 >> 4) & 0xf
+        sel, pr, r = self.keep(sel, r <= 8, 'Invalid register.', pr, r)
+        self.GR[sel, r] = self.memory[sel, self.GR[sel, 8]]
+        sp = self.GR[sel, 8].astype(int64)
+        sel, pr, sp = self.keep(sel, sp != 0xffff, 'Stack underflow.',
+                                pr, sp)
+        self.GR[sel, 8] = sp + 1
+        self.PR[sel] = pr + 1
+
+    def op_call(self, sel, pr, w0):
+        sel, pr, adr, x = self.adrx(sel, pr, w0)
+        sp = self.GR[sel, 8].astype(int64)
+        sel, pr, adr, x, sp = self.keep(sel, sp != 0, 'Stack overflow.',
+                                        pr, adr, x, sp)
+        self.GR[sel, 8] = sp - 1
+        self.memory[sel, sp - 1] = pr
+        self.call_level[sel] += 1
+        self.PR[sel] = self.effective(sel, adr, x)
+
+    def op_ret(self, sel, pr, w0):
+        top = self.call_level[sel] == 0
+        if top.any():
+            # 参照実装と同じく、終了する RET も1ステップと数える
+            self.step_count[sel[top]] += 1
+            self.stop(sel[top], HALTED)
+            sel = sel[~top]
+        sp = self.GR[sel, 8].astype(int64)
+        sel, sp = self.keep(sel, sp != 0xffff, 'Stack underflow.', sp)
+        adr = self.memory[sel, sp].astype(int64)
+        self.GR[sel, 8] = sp + 1
+        self.call_level[sel] -= 1
+        self.PR[sel] = adr + 2
+
+    def op_svc(self, sel, pr, w0):
+        pass
+
+    def op_in(self, sel, pr, w0):
+        for i, p in zip(sel, pr):
+            s, l = int(self.memory[i, p + 1]), int(self.memory[i, p + 2])
+            line = self.inputs[i].readline()[:-1][:256]
+            self.memory[i, l] = len(line)
+            if 0x10000 < s + len(line):
+                self.stop([i], ERROR, 'Input is out of memory.')
+                continue
+            self.memory[i, s:s + len(line)] = [ord(c) for c in line]
+            self.PR[i] = p + 3
+
+    def op_out(self, sel, pr, w0):
+        for i, p in zip(sel, pr):
+            s, l = int(self.memory[i, p + 1]), int(self.memory[i, p + 2])
+            length = int(self.memory[i, l])
+            if 0x10000 < s + length:
+                self.stop([i], ERROR, 'Output is out of memory.')
+                continue
+            words = self.memory[i, s:s + length]
+            try:
+                # 参照実装と同じく chr() で文字にする (Python 2 では
+                # 0xff を超える語は ValueError になり、参照実装でも ERROR)
+                line = ''.join(map(chr, words))
+            except ValueError:
+                self.stop([i], ERROR, 'Output is not a character.')
+                continue
+            self.outputs[i].write(line + '\n')
+            self.PR[i] = p + 3
+
+    def op_rpush(self, sel, pr, w0):
+        for k in range(1, 9):
+            sp = self.GR[sel, 8].astype(int64)
+            sel, pr, sp = self.keep(sel, sp != 0, 'Stack overflow.', pr, sp)
+            self.GR[sel, 8] = sp - 1
+            self.memory[sel, sp - 1] = self.GR[sel, k]
+        self.PR[sel] = pr + 1
+
+    def op_rpop(self, sel, pr, w0):
+        for k in range(8, 0, -1):
+            self.GR[sel, k] = self.memory[sel, self.GR[sel, 8]]
+            sp = self.GR[sel, 8].astype(int64)
+            sel, pr, sp = self.keep(sel, sp != 0xffff, 'Stack underflow.',
+                                    pr, sp)
+            self.GR[sel, 8] = sp + 1
+        self.PR[sel] = pr + 1
+
+
+def reference(machine, input_data, max_steps):
+    ''' 参照実装で1つの入力について実行し、(status, step_count, 出力) を返す '''
+    from errors import MachineExit, InvalidOperation, BudgetExceeded
+    machine.input = StringIO(input_data)
+    machine.output = BufferOutput()
+    status = HALTED
+    try:
+        machine.run(max_steps)
+    except MachineExit:
+        pass
+    except InvalidOperation:
+        status = INVALID
+    except BudgetExceeded:
+        status = STEPS
+    except Exception:
+        status = ERROR
+    return status, machine.step_count, machine.output.getvalue()
+
+
+def main():
+    usage = 'usage: %prog [options] input.com|input.cas [case.in ...]'
+    parser = OptionParser(usage)
+    parser.add_option('-n', '--copies', type='int',
+                      dest='copies', default=None,
+                      help='number of machines. (default: number of cases)')
+    parser.add_option('--max-steps', type='int',
+                      dest='max_steps', default=None,
+                      help='stop each machine after executing N steps.')
+    parser.add_option('--check', action='store_true',
+                      dest='check', default=False,
+                      help='compare results with the reference '
+                           'implementation.')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(2)
+
+    from verify import load_program
+    from oracle import diff_states
+    import time
+    machine = PyComet2()
+    load_program(machine, args[0])
+    names = args[1:]
+    inputs = []
+    for filename in names:
+        fp = open(filename)
+        inputs.append(fp.read())
+        fp.close()
+    n = options.copies or len(inputs) or 1
+    vm = VectorComet2.from_machine(machine, n)
+    for i in range(n):
+        vm.inputs[i] = StringIO(inputs[i % len(inputs)] if inputs else '')
+
+    start = time.time()
+    vm.run(options.max_steps)
+    elapsed = time.time() - start
+    total = int(vm.step_count.sum())
+    print('%d machines, %d steps, %.3f s, %.0f steps/s'
+          % (n, total, elapsed, total / max(elapsed, 1e-9)), file=sys.stderr)
+
+    failed = 0
+    expected = {}
+    for i in range(n):
+        case = i % len(inputs) if inputs else None
+        name = names[case] if inputs else '-'
+        result = (int(vm.status[i]), int(vm.step_count[i]),
+                  vm.outputs[i].getvalue())
+        line = '%-8s %10d steps  %s' % (STATUS_NAMES[result[0]],
+                                        result[1], name)
+        diff = None
+        if options.check:
+            if case not in expected:
+                m = PyComet2()
+                load_program(m, args[0])
+                expected[case] = m, reference(
+                    m, inputs[case] if inputs else '', options.max_steps)
+            m, ref = expected[case]
+            # ERROR で停止した機械の状態は参照実装と一致するとは限らない
+            if result == ref and result[0] != ERROR:
+                diff = diff_states(m, vm.to_machine(i))
+            if result == ref and not diff:
+                line += '  ok'
+            elif result == ref:
+                failed += 1
+                line += '  MISMATCH (state)'
+            else:
+                failed += 1
+                line += '  MISMATCH (expected %s, %d steps)' % (
+                    STATUS_NAMES[ref[0]], ref[1])
+        print(line)
+        if diff:
+            for d in str(diff).split('\n'):
+                print('    ' + d)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
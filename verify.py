@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+'''
+参照実装 (PyComet2.step) と高速エンジンを並走させて結果を照合する
+
+  python verify.py [-e ENGINE] [-n N] [prog.cas|prog.com ...]
+
+引数を省略すると tests/ 以下の *.cas をすべて検証する。
+prog.cas と同じ名前の prog.in があれば、それを標準入力として与える。
+prog.out があれば、参照実装の出力がそれと同じかも確かめる
+(命令の実装は参照実装と高速エンジンで共通なので、並走では見つからない)。
+'''
+from __future__ import print_function
+import sys
+import os
+import glob
+import array
+import tempfile
+from optparse import OptionParser
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from pycomet2 import PyComet2
+from errors import InvalidOperation, MachineExit
+from engines import engines, add_engine_option
+
+MASK = 0xffffffffffffffff
+
+
+def word_hash(addr, value):
+    ''' 番地 addr の値 value が主記憶のハッシュ値に寄与する量 '''
+    return (value * (((addr * 0x9e3779b97f4a7c15 + 0x632be59bd9b4e019)
+                      & MASK) | 1)) & MASK
+
+
+class HashedMemory(array.array):
+    '''
+    書き込みのたびにハッシュ値を更新する主記憶
+    ハッシュ値は各語の寄与の和なので、書き込み順序によらず
+    内容が同じなら同じ値になる
+    '''
+
+    def __new__(cls, data):
+        self = array.array.__new__(cls, 'H', data)
+        self.digest = 0
+        for addr, value in enumerate(data):
+            if value != 0:
+                self.digest += word_hash(addr, value)
+        self.digest &= MASK
+        return self
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            addrs = range(*index.indices(len(self)))
+            old = array.array.__getitem__(self, index)
+            array.array.__setitem__(self, index, value)
+            for addr, prev in zip(addrs, old):
+                self.digest = (self.digest - word_hash(addr, prev)
+                               + word_hash(addr, self[addr])) & MASK
+        else:
+            prev = self[index]
+            array.array.__setitem__(self, index, value)
+            if index < 0: index += len(self)
+            self.digest = (self.digest - word_hash(index, prev)
+                           + word_hash(index, value)) & MASK
+
+
+class Side(object):
+    ''' 並走させる機械の片方と、その入出力 '''
+
+    def __init__(self, machine, input_data):
+        self.m = machine
+        self.m.input = StringIO(input_data)
+        self.m.output = StringIO()
+        self.m.memory = HashedMemory(self.m.memory)
+
+    def step(self):
+        ''' 1単位実行し、MachineExit / InvalidOperation を返す '''
+        try:
+            self.m.step()
+        except (MachineExit, InvalidOperation) as e:
+            return e
+        return None
+
+    def state(self):
+        m = self.m
+        return ([('GR%d' % i, m.GR[i]) for i in range(8)]
+                + [('SP', m.SP), ('PR', m.PR),
+                   ('OF', m.OF), ('SF', m.SF), ('ZF', m.ZF),
+                   ('memory', m.memory.digest),
+                   ('output', m.output.getvalue())])
+
+    def snapshot(self):
+        m = self.m
+        return (array.array('H', m.memory), m.memory.digest,
+                m.save_registers(), m.call_level, m.step_count,
+                m.input.tell(), m.output.getvalue())
+
+    def restore(self, snapshot):
+        m = self.m
+        (memory, digest, registers,
+         m.call_level, m.step_count, pos, out) = snapshot
+        array.array.__setitem__(m.memory, slice(0, len(memory)), memory)
+        m.memory.digest = digest
+        m.load_registers(registers)
+        m.input.seek(pos)
+        m.output = StringIO()
+        m.output.write(out)
+        if hasattr(m, 'invalidate'):
+            m.invalidate()
+
+
+class Divergence(object):
+    ''' 最初に結果が食い違った命令 '''
+
+    def __init__(self, step, address, code, differences):
+        self.step = step
+        self.address = address
+        self.code = code
+        # (項目名, 参照実装の値, 高速エンジンの値) のリスト
+        self.differences = differences
+
+    def __str__(self):
+        st = ['Divergence at step %d, #%04x [ %s ]'
+              % (self.step, self.address, self.code)]
+        for name, ref, cand in self.differences:
+            if isinstance(ref, str):
+                st.append('  %-7s %r != %r' % (name, ref, cand))
+            else:
+                st.append('  %-7s #%04x != #%04x' % (name, ref, cand))
+        return '\n'.join(st)
+
+
+class UnexpectedOutput(object):
+    ''' 参照実装の出力が prog.out と違う '''
+
+    def __init__(self, expected, output):
+        self.expected = expected
+        self.output = output
+
+    def __str__(self):
+        return 'Unexpected output %r (expected %r)' % (self.output,
+                                                      self.expected)
+
+
+class Lockstep(object):
+    '''
+    参照実装と高速エンジンを並走させ、
+    interval ステップごとに GR, SP, PR, フラグ, 主記憶のハッシュを照合する
+    '''
+
+    def __init__(self, reference, candidate, interval=1000, input_data=''):
+        self.ref = Side(reference, input_data)
+        self.cand = Side(candidate, input_data)
+        self.interval = interval
+
+    def differences(self):
+        diff = [(name, a, b) for (name, a), (_, b)
+                in zip(self.ref.state(), self.cand.state()) if a != b]
+        if diff and self.ref.m.memory != self.cand.m.memory:
+            for addr in range(len(self.ref.m.memory)):
+                a, b = self.ref.m.memory[addr], self.cand.m.memory[addr]
+                if a != b:
+                    diff.append(('#%04x' % addr, a, b))
+        return [d for d in diff if d[0] != 'memory']
+
+    def advance(self):
+        '''
+        高速エンジンを1単位進め、参照実装を同じステップ数まで進める
+        終了した場合は (参照実装の例外, 高速エンジンの例外) を返す
+        '''
+        cand_exc = self.cand.step()
+        ref_exc = None
+        while ref_exc is None and \
+                self.ref.m.step_count < self.cand.m.step_count:
+            ref_exc = self.ref.step()
+        if cand_exc is not None and ref_exc is None:
+            ref_exc = self.ref.step()
+        return ref_exc, cand_exc
+
+    def locate(self, ref_snapshot, cand_snapshot):
+        ''' 直前の照合点から1単位ずつ実行し直して最初の食い違いを探す '''
+        self.ref.restore(ref_snapshot)
+        self.cand.restore(cand_snapshot)
+        while True:
+            step = self.ref.m.step_count
+            address = self.ref.m.PR
+            code = self.ref.m.dis.dis_inst(address)
+            ref_exc, cand_exc = self.advance()
+            diff = self.differences()
+            if type(ref_exc) != type(cand_exc):
+                diff.insert(0, ('stop', str(type(ref_exc).__name__),
+                                str(type(cand_exc).__name__)))
+            if diff:
+                return Divergence(step, address, code, diff)
+            if ref_exc is not None:
+                return None
+
+    def run(self, max_steps=None):
+        ''' 最後まで実行し、食い違いがあれば Divergence を返す '''
+        snapshots = self.ref.snapshot(), self.cand.snapshot()
+        checkpoint = self.interval
+        while max_steps is None or self.cand.m.step_count < max_steps:
+            ref_exc, cand_exc = self.advance()
+            stopped = ref_exc is not None or cand_exc is not None
+            if stopped or checkpoint <= self.cand.m.step_count:
+                if self.differences() or type(ref_exc) != type(cand_exc):
+                    return self.locate(*snapshots)
+                if stopped:
+                    return None
+                snapshots = self.ref.snapshot(), self.cand.snapshot()
+                checkpoint = self.cand.m.step_count + self.interval
+        return None
+
+
+def load_program(machine, filename):
+    '''
+    .cas はアセンブルしてから読み込む
+    アセンブルした場合はシンボル表 (CASL2.symbols) を返す
+    '''
+    if os.path.splitext(filename)[1] != '.cas':
+        machine.load(filename, True)
+        return {}
+    from pycasl2 import CASL2
+    fd, com = tempfile.mkstemp(suffix='.com')
+    os.close(fd)
+    try:
+        casl2 = CASL2()
+        casl2.write(com, casl2.assemble(filename))
+        machine.load(com, True)
+    finally:
+        os.remove(com)
+    return casl2.symbols
+
+
+def verify(filename, engine, interval=1000, max_steps=None, natives=None):
+    '''
+    filename のプログラムを参照実装と engine で並走させる
+    natives (natives.Natives) を指定すると、高速エンジン側でだけ
+    ネイティブルーチンを使う
+    '''
+    input_data = ''
+    infile = os.path.splitext(filename)[0] + '.in'
+    if os.path.exists(infile):
+        input_data = open(infile).read()
+    expected = None
+    outfile = os.path.splitext(filename)[0] + '.out'
+    if os.path.exists(outfile):
+        expected = open(outfile).read()
+    reference, candidate = PyComet2(), engines[engine]()
+    load_program(reference, filename)
+    symbols = load_program(candidate, filename)
+    if natives is not None:
+        candidate.natives = natives.resolve(symbols)
+    lockstep = Lockstep(reference, candidate, interval, input_data)
+    divergence = lockstep.run(max_steps)
+    if divergence is None and expected is not None:
+        output = lockstep.ref.m.output.getvalue()
+        if output != expected:
+            return UnexpectedOutput(expected, output)
+    return divergence
+
+
+def main():
+    usage = 'usage: %prog [options] [input.cas|input.com ...]'
+    parser = OptionParser(usage)
+    add_engine_option(parser, 'cache',
+                      'engine to verify against the reference.')
+    parser.add_option('-n', '--interval', type='int',
+                      dest='interval', default=1000,
+                      help='compare states every N steps.')
+    parser.add_option('-m', '--max-steps', type='int',
+                      dest='max_steps', default=None,
+                      help='stop verification after N steps.')
+    parser.add_option('-N', '--native', type='string', action='append',
+                      dest='natives', default=[],
+                      help='replace the subroutine NAME with the native '
+                           'routine of the same name. (ex. -N MULT)')
+    options, args = parser.parse_args()
+
+    natives = None
+    if options.natives:
+        from natives import Natives, library
+        natives = Natives()
+        for name in options.natives:
+            natives.bind(name, library[name])
+
+    if len(args) == 0:
+        tests = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'tests')
+        args = sorted(glob.glob(os.path.join(tests, '*.cas')))
+
+    failed = 0
+    for filename in args:
+        try:
+            divergence = verify(filename, options.engine,
+                                options.interval, options.max_steps,
+                                natives)
+        except SystemExit:
+            # アセンブルできないプログラムは検証の対象外
+            print('skipped %s' % filename, file=sys.stderr)
+            continue
+        if divergence is None:
+            print('ok      %s' % filename, file=sys.stderr)
+        else:
+            failed += 1
+            print('FAILED  %s' % filename, file=sys.stderr)
+            print(divergence, file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()